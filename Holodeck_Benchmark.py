@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy
+import Holodeck_HelperFunctions
+import Holodeck_SyntheticData
+
+
+# Helper function which scans a raw log the way the parser originally did (reading every line into memory and testing
+# each one for the tracked object names), returning the number of relevant lines
+def scan_raw_log_readlines(path, object_names):
+    count = 0
+    with open(path, 'rb') as fp:
+        for line in fp.readlines():
+            if line.startswith('-') or any(name in line for name in object_names):
+                count += 1
+    return count
+
+
+# Helper function which scans a raw log line by line without holding it in memory, returning the number of relevant
+# lines
+def scan_raw_log_iterate(path, object_names):
+    count = 0
+    with open(path, 'rb') as fp:
+        for line in fp:
+            if line.startswith('-') or any(name in line for name in object_names):
+                count += 1
+    return count
+
+
+# Helper function which scans a raw log with the memory-mapped scanner used by the parser, returning the number of
+# relevant lines
+def scan_raw_log_mmap(path, object_names):
+    count = 0
+    for _ in Holodeck_HelperFunctions.iter_raw_log_lines(path, object_names):
+        count += 1
+    return count
+
+
+# The raw log scanners compared by the benchmark, in the order they are reported
+raw_log_scanners = [('readlines', scan_raw_log_readlines),
+                    ('iterate', scan_raw_log_iterate),
+                    ('mmap', scan_raw_log_mmap)]
+
+
+# Helper function which times a function of no arguments, returning the best time of repeats runs and the result of
+# the last run
+def time_best(function, repeats):
+    best = None
+    result = None
+    for _ in range(0, repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+# Helper function which gets the (stored) size of an input file, which may be inside an archive
+def get_file_size(path):
+    return Holodeck_HelperFunctions.get_input_file_stat(path)[0]
+
+
+# Helper function which makes a benchmark result (rows and bytes may be None if they don't apply) and logs it
+def make_result(name, seconds, rows, size):
+    result = {'name': name, 'seconds': seconds, 'rows': rows, 'bytes': size,
+              'rows_per_second': rows / seconds if rows is not None and seconds > 0 else None,
+              'mb_per_second': size / seconds / 1e6 if size is not None and seconds > 0 else None}
+    logging.info("%-20s %8.3f s %12s rows/s %10s MB/s %10s rows" % (
+        name, seconds,
+        '%.0f' % result['rows_per_second'] if result['rows_per_second'] is not None else '-',
+        '%.1f' % result['mb_per_second'] if result['mb_per_second'] is not None else '-',
+        rows if rows is not None else '-'))
+    return result
+
+
+# Helper function which times each raw log scanner on the file at path, keeping the best of repeats runs. The results
+# are returned as a list of result dicts (see make_result).
+def benchmark_raw_log_scan(path, repeats=3):
+    object_names = [Holodeck_HelperFunctions.path_object_name, Holodeck_HelperFunctions.look_object_name]
+    size = os.path.getsize(path)
+    results = []
+    for name, scanner in raw_log_scanners:
+        seconds, lines = time_best(lambda: scanner(path, object_names), repeats)
+        results.append(make_result('scan_' + name, seconds, lines, size))
+    return results
+
+
+# Helper function which times the cataloging of the files and each parser over every file it applies to in the catalog
+# (keeping the best of repeats runs), and returns a list of result dicts (see make_result). The summary files are
+# cached before the file parsers are timed, so their times don't include summary parsing.
+def benchmark_parsers(files, repeats=3):
+    results = []
+    seconds, (individuals, excluded, non_matching) = time_best(
+        lambda: Holodeck_HelperFunctions.catalog_files(files, 1, True), repeats)
+    results.append(make_result('catalog_files', seconds, len(files), None))
+
+    trials = [(individual.subject_id, trial) for individual in individuals for trial in individual.trials]
+    summary_paths = sorted(set(path for subject_id, trial in trials
+                               for path in [trial.study_summary, trial.test_summary, trial.practice_summary] if path))
+
+    def parse_summaries():
+        return sum(len(Holodeck_HelperFunctions.parse_summary_file(path)[1]) for path in summary_paths)
+    seconds, rows = time_best(parse_summaries, repeats)
+    results.append(make_result('parse_summary_file', seconds, rows,
+                               sum(get_file_size(path) for path in summary_paths)))
+
+    Holodeck_HelperFunctions.summary_cache.max_size = max(Holodeck_HelperFunctions.summary_cache.max_size,
+                                                          len(summary_paths))
+    for path in summary_paths:
+        Holodeck_HelperFunctions.get_summary(path)
+
+    # Each parser with the (path, summary path) pairs of the trial files it applies to
+    raw_files = [(path, summary_path) for subject_id, trial in trials
+                 for path, summary_path in [(trial.study_path, trial.study_summary),
+                                            (trial.test_path, trial.test_summary),
+                                            (trial.practice_path, trial.practice_summary)] if path]
+    parsers = [('parse_path_file', Holodeck_HelperFunctions.parse_path_file, raw_files),
+               ('parse_look_file', Holodeck_HelperFunctions.parse_look_file, raw_files),
+               ('parse_test_2d_file', Holodeck_HelperFunctions.parse_test_2d_file,
+                [(trial.test_2d, trial.study_summary) for subject_id, trial in trials if trial.test_2d]),
+               ('parse_test_vr_file', Holodeck_HelperFunctions.parse_test_vr_file,
+                [(trial.test_vr, trial.study_summary) for subject_id, trial in trials if trial.test_vr])]
+    for name, parser, parser_files in parsers:
+        def parse_all():
+            return sum(sum(1 for _ in parser(path, 'benchmark', 0, summary_path))
+                       for path, summary_path in parser_files)
+        seconds, rows = time_best(parse_all, repeats)
+        results.append(make_result(name, seconds, rows, sum(get_file_size(path) for path, _ in parser_files)))
+    return results
+
+
+# scipy is optional; it is only needed to check the path distances against the scipy function they replaced
+try:
+    from scipy.spatial import distance
+except ImportError:
+    distance = None
+
+
+# Representative steps between consecutive samples for check_distances: (name, standard deviation of the step, offset
+# of the positions from the origin). They cover walking and looking around the environment, standing still, tiny and
+# large steps, and positions far from the origin.
+distance_check_cases = [('walk', 0.05, 30.0), ('still', 0.0, 30.0), ('tiny', 1e-7, 30.0), ('jump', 100.0, 30.0),
+                        ('far', 0.05, 1e6)]
+
+
+# Helper function which checks the distances computed by TrajectoryTracker (in NumPy, summing in numpy.longdouble)
+# against scipy.spatial.distance.euclidean (which computed them before they were vectorized) on random walks of the
+# distance_check_cases. It returns a list of dicts with the number of samples, the number of distances which differ,
+# and the largest difference in units in the last place, and logs a warning for each case with differences. None is
+# returned if scipy isn't installed.
+def check_distances(samples=100000, seed=0):
+    if distance is None:
+        logging.info("scipy is not installed; skipping the distance check.")
+        return None
+    rng = numpy.random.RandomState(seed)
+    results = []
+    for name, step, offset in distance_check_cases:
+        positions = offset + numpy.cumsum(rng.normal(0, step, (samples, 3)), axis=0) if step else \
+            numpy.full((samples, 3), offset)
+        tracker = Holodeck_HelperFunctions.TrajectoryTracker(Holodeck_HelperFunctions.SummaryType.study_practice,
+                                                             (), ())
+        computed = tracker.update(range(0, samples), positions)[4]
+        expected = numpy.array([0.0] + [distance.euclidean(a, b) for a, b in zip(positions[:-1], positions[1:])])
+        differences = numpy.abs(computed - expected) / numpy.spacing(numpy.maximum(expected, 1e-300))
+        result = {'name': 'distance_' + name, 'samples': samples, 'mismatches': int((computed != expected).sum()),
+                  'max_ulps': float(differences.max())}
+        if result['mismatches']:
+            logging.warning("Distance check %s: %d of %d distances differ from scipy (at most %.1f ulps)."
+                            % (name, result['mismatches'], samples, result['max_ulps']))
+        else:
+            logging.info("Distance check %s: all %d distances match scipy." % (name, samples))
+        results.append(result)
+    return results
+
+
+def main():
+    # Parse inputs
+    parser = argparse.ArgumentParser(
+        description='This script benchmarks the scanning of raw Unity logs for the lines of the tracked objects and ' +
+                    'the cataloging and parsing of Holodeck Navigation Task data, reporting rows/sec and MB/sec for ' +
+                    'each scanner and parser. A synthetic raw log and dataset are generated (with a fixed seed, so ' +
+                    'runs are comparable) unless an existing raw log or dataset is given.')
+    parser.add_argument('--dataset', default=None,
+                        help='The path to an existing folder of data to benchmark instead of a synthetic dataset.')
+    parser.add_argument('--raw_log', default=None,
+                        help='The path to an existing raw log to compare the raw log scanners on instead of a ' +
+                             'synthetic one.')
+    parser.add_argument('--raw_log_seconds', default=600, type=int,
+                        help='The length in seconds of the synthetic raw log the scanners are compared on ' +
+                             '(default=600).')
+    parser.add_argument('--subjects', default=3, type=int,
+                        help='The number of subjects in the synthetic dataset (default=3).')
+    parser.add_argument('--trials', default=4, type=int,
+                        help='The number of trials per subject in the synthetic dataset (default=4).')
+    parser.add_argument('--seconds', default=60, type=int,
+                        help='The length in seconds of each synthetic raw log (default=60).')
+    parser.add_argument('--samples_per_second', default=90, type=int,
+                        help='The number of samples per second of the synthetic raw logs (default=90).')
+    parser.add_argument('--other_objects', default=20, type=int,
+                        help='The number of untracked objects logged each sample in the synthetic raw logs ' +
+                             '(default=20).')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='The random seed of the synthetic dataset (default=0).')
+    parser.add_argument('--repeats', default=3, type=int,
+                        help='The number of times each benchmark is repeated; the best time is reported (default=3).')
+    parser.add_argument('--output', default=None,
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--log_level', default=20, type=int,
+                        help='Logging level of the application (default=20/INFO). ' +
+                             'See https://docs.python.org/2/library/logging.html#levels for more info.')
+
+    args = parser.parse_args()
+
+    # Configure the output logger
+    logging.basicConfig(format="%(levelname)s (%(asctime)s): %(message)s", level=args.log_level)
+
+    temp_directory = tempfile.mkdtemp(prefix='holodeck_benchmark_')
+    try:
+        raw_log = args.raw_log
+        if not raw_log:
+            raw_log = os.path.join(temp_directory, 'RawLog_Synthetic.txt')
+            logging.info("Generating synthetic raw log (%d seconds at %d samples per second)." %
+                         (args.raw_log_seconds, args.samples_per_second))
+            Holodeck_SyntheticData.write_raw_log(raw_log, args.raw_log_seconds, args.samples_per_second,
+                                                 args.other_objects, seed=args.seed)
+        logging.info("Scanning %s (%.1f MB)." % (raw_log, os.path.getsize(raw_log) / 1e6))
+        results = benchmark_raw_log_scan(raw_log, args.repeats)
+
+        if args.dataset:
+            files = Holodeck_HelperFunctions.discover_files(args.dataset)
+        else:
+            # The dataset gets its own directory so the synthetic raw log isn't cataloged with it
+            dataset_directory = os.path.join(temp_directory, 'dataset')
+            logging.info(("Generating synthetic dataset (%d subjects, %d trials, %d seconds at %d samples per " +
+                          "second).") % (args.subjects, args.trials, args.seconds, args.samples_per_second))
+            Holodeck_SyntheticData.write_dataset(dataset_directory, args.subjects, args.trials, args.seconds,
+                                                 args.samples_per_second, args.other_objects, args.seed)
+            files = Holodeck_HelperFunctions.discover_files(dataset_directory)
+        logging.info("Benchmarking %d files (%.1f MB)." %
+                     (len(files), sum(get_file_size(path) for path in files) / 1e6))
+        results.extend(benchmark_parsers(files, args.repeats))
+
+        distance_check = check_distances(seed=args.seed)
+
+        if args.output:
+            with open(args.output, 'wb') as fp:
+                json.dump({'arguments': vars(args), 'results': results, 'distance_check': distance_check}, fp,
+                          indent=1, sort_keys=True)
+            logging.info("Results written to %s." % args.output)
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+if __name__ == '__main__':
+    main()
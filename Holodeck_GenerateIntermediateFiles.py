@@ -1,305 +1,445 @@
 import os
+import json
 import logging
 import argparse
 import datetime
+import collections
+import cProfile
+import multiprocessing
 import Holodeck_HelperFunctions
 
-# Parse inputs
-parser = argparse.ArgumentParser(
-    description='This script will take a folder containing subject data for the Holodeck Navigation Task and ' +
-                'generate CSV files containing the meta-data of interest as requested by the script options. The ' +
-                'default is for all data to be generated in a folder adjacent to this script tagged with the current ' +
-                'data and time. To speed processing, this can be restricted to particular subsets of the meta-data. ' +
-                'If any one option is given to specify a subset of processing, the script will, by default, exclude ' +
-                'subsets of data not included as options.')
-parser.add_argument('path', help='The full input path to the folder containing the data to be parsed.')
-parser.add_argument('--full_study_path', dest='full_study_path', action='store_true',
-                    help='Generates study_path.csv containing relevant study path variables.')
-parser.set_defaults(full_study_path=False)
-parser.add_argument('--full_study_look', dest='full_study_look', action='store_true',
-                    help='Generates study_look.csv containing relevant study look variables.')
-parser.set_defaults(full_study_look=False)
-parser.add_argument('--full_test_path', dest='full_test_path', action='store_true',
-                    help='Generates test_path.csv containing relevant test path variables.')
-parser.set_defaults(full_test_path=False)
-parser.add_argument('--full_test_look', dest='full_test_look', action='store_true',
-                    help='Generates test_look.csv containing relevant test look variables.')
-parser.set_defaults(full_test_look=False)
-parser.add_argument('--full_practice_path', dest='full_practice_path', action='store_true',
-                    help='Generates practice_path.csv containing relevant practice path variables.')
-parser.set_defaults(full_practice_path=False)
-parser.add_argument('--full_practice_look', dest='full_practice_look', action='store_true',
-                    help='Generates practice_look.csv containing relevant practice look variables.')
-parser.set_defaults(full_practice_look=False)
-parser.add_argument('--full_test_2d', dest='full_test_2d', action='store_true',
-                    help='Generates 2d_test.csv containing relevant 2D test results.')
-parser.set_defaults(full_test_2d=False)
-parser.add_argument('--full_test_vr', dest='full_test_vr', action='store_true',
-                    help='Generates vr_test.csv containing relevant 2D test results.')
-parser.set_defaults(full_test_vr=False)
-
-parser.add_argument('--exclude_incomplete_trials', dest='exclude_incomplete_trials', action='store_true',
-                    help='Exclude any trials that don\'t have all expected files in a trial (default=True).')
-parser.set_defaults(exclude_incomplete_trials=True)
-
-parser.add_argument('--min_num_trials', default=4, type=int,
-                    help='Minimum number of valid, complete trials necessary to include subject in output (default=1).')
-
-parser.add_argument('--log_level', default=20, type=int,
-                    help='Logging level of the application (default=20/INFO). ' +
-                         'See https://docs.python.org/2/library/logging.html#levels for more info.')
-parser.set_defaults(log_level=20)
-
-args = parser.parse_args()
-
-# Configure the output logger
-logging.basicConfig(format="%(levelname)s (%(asctime)s): %(message)s", level=args.log_level)
-
-# Handle case where no optional arguments excluding processing are provided in which case all optional
-# args are assumed to be true (for convenience)
-if not (args.full_study_path or args.full_study_look or args.full_test_path or
-        args.full_test_look or args.full_practice_path or args.full_practice_look or
-        args.full_test_2d or args.full_test_vr):
-    args.full_study_path = True
-    args.full_study_look = True
-    args.full_test_path = True
-    args.full_test_look = True
-    args.full_practice_path = True
-    args.full_practice_look = True
-    args.full_test_2d = True
-    args.full_test_vr = True
-    logging.info("No command line arguments found. Defaulting all true.")
-
-logging.info("Done parsing command line arguments.")
-
-# Populate list of files, recursively
-files = []
-for walk_root, walk_dirs, walk_files in os.walk(args.path):
-    for f in walk_files:
-        files.append(os.path.join(walk_root, f))
-
-# Check if there aren't any files and early stop if there aren't
-if not files:
-    logging.error("No files found in directory. Closing without creation of output files.")
-    exit()
-
-logging.info("Found %d files. Attempting to catalog filenames by Individual, Trial, and Phase" % len(files))
-
-# Stores filenames for individuals in a data structure for easy handling
-individuals, excluded, non_matching = Holodeck_HelperFunctions.catalog_files(files,
-                                                                             args.min_num_trials,
-                                                                             args.exclude_incomplete_trials)
-
-logging.info(("Done cataloging files. %d individuals found which conform to the trial minimum (%d). " +
-              "%d files not matching any expected filename format. %d files excluded on input criteria.")
-             % (len(individuals), args.min_num_trials, len(non_matching), len(excluded)))
-
-# In debug mode, print excluded files
-for filename in excluded:
-    logging.debug("%s was excluded." % filename)
-
-# Create the output directory
-output_directory = os.path.join(os.getcwd(), datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-try:
-    os.mkdir(output_directory)
-    logging.info("Output directory (%s) created." % output_directory)
-except OSError, e:
-    if e.errno != 17:
-        raise
+
+def main():
+    # Parse inputs
+    parser = argparse.ArgumentParser(
+        description='This script will take a folder containing subject data for the Holodeck Navigation Task and ' +
+                    'generate CSV files containing the meta-data of interest as requested by the script options. ' +
+                    'The default is for all data to be generated in a folder adjacent to this script tagged with the ' +
+                    'current data and time. To speed processing, this can be restricted to particular subsets of the ' +
+                    'meta-data. If any one option is given to specify a subset of processing, the script will, by ' +
+                    'default, exclude subsets of data not included as options.')
+    parser.add_argument('path', nargs='?',
+                        help='The full input path to the folder containing the data to be parsed. Zip and ' +
+                             'tar archives in the folder (or an archive given as the path) are read in ' +
+                             'place without extracting them. Not needed with --write_layout.')
+    parser.add_argument('--full_study_path', dest='full_study_path', action='store_true',
+                        help='Generates study_path.csv containing relevant study path variables.')
+    parser.set_defaults(full_study_path=False)
+    parser.add_argument('--full_study_look', dest='full_study_look', action='store_true',
+                        help='Generates study_look.csv containing relevant study look variables.')
+    parser.set_defaults(full_study_look=False)
+    parser.add_argument('--full_test_path', dest='full_test_path', action='store_true',
+                        help='Generates test_path.csv containing relevant test path variables.')
+    parser.set_defaults(full_test_path=False)
+    parser.add_argument('--full_test_look', dest='full_test_look', action='store_true',
+                        help='Generates test_look.csv containing relevant test look variables.')
+    parser.set_defaults(full_test_look=False)
+    parser.add_argument('--full_practice_path', dest='full_practice_path', action='store_true',
+                        help='Generates practice_path.csv containing relevant practice path variables.')
+    parser.set_defaults(full_practice_path=False)
+    parser.add_argument('--full_practice_look', dest='full_practice_look', action='store_true',
+                        help='Generates practice_look.csv containing relevant practice look variables.')
+    parser.set_defaults(full_practice_look=False)
+    parser.add_argument('--full_test_2d', dest='full_test_2d', action='store_true',
+                        help='Generates 2d_test.csv containing relevant 2D test results.')
+    parser.set_defaults(full_test_2d=False)
+    parser.add_argument('--full_test_vr', dest='full_test_vr', action='store_true',
+                        help='Generates vr_test.csv containing relevant 2D test results.')
+    parser.set_defaults(full_test_vr=False)
+    parser.add_argument('--full_test_vr_events', dest='full_test_vr_events', action='store_true',
+                        help='Generates vr_test_events.csv containing every placement event of every VR test item. ' +
+                             'This output is not generated by default.')
+    parser.set_defaults(full_test_vr_events=False)
+    parser.add_argument('--full_trial_summary', dest='full_trial_summary', action='store_true',
+                        help='Generates trial_summary.csv containing the totals of each phase of each trial (path ' +
+                             'length, duration, room transitions, items clicked, and time in each room color).')
+    parser.set_defaults(full_trial_summary=False)
+    parser.add_argument('--full_room_visits', dest='full_room_visits', action='store_true',
+                        help='Generates room_visits.csv containing the start, end, duration and path length of every ' +
+                             'room visit (split where items are clicked) of each phase of each trial.')
+    parser.set_defaults(full_room_visits=False)
+
+    parser.add_argument('--exclude_incomplete_trials', dest='exclude_incomplete_trials', action='store_true',
+                        help='Exclude any trials that don\'t have all expected files in a trial (default=True).')
+    parser.set_defaults(exclude_incomplete_trials=True)
+
+    parser.add_argument('--min_num_trials', default=4, type=int,
+                        help='Minimum number of valid, complete trials necessary to include subject in output ' +
+                             '(default=1).')
+
+    parser.add_argument('--include', action='append', default=None, metavar='GLOB',
+                        help='Only search for input files matching this glob, given relative to the input path with ' +
+                             '/ separators (e.g. "0*/Study/*") or as a file name pattern. Directories which can\'t ' +
+                             'contain matching files are not searched. Can be given more than once.')
+
+    parser.add_argument('--exclude', action='append', default=None, metavar='GLOB',
+                        help='Skip files and directories matching this glob (relative to the input path, or a name ' +
+                             'pattern). Can be given more than once.')
+
+    parser.add_argument('--discovery_threads', default=1, type=int,
+                        help='Number of threads used to search the top level (subject) directories of the input ' +
+                             'path for input files, which helps on network file systems (default=1).')
+
+    parser.add_argument('--format', dest='output_format', default='csv', choices=['csv', 'npy'],
+                        help='Format of the output tables. csv writes one CSV file per table; npy writes one ' +
+                             'directory per table with a memory-mappable .npy file per column and a schema.json, ' +
+                             'with subject ids and room colors stored as integer codes (default=csv).')
+
+    parser.add_argument('--compress_output', default=None,
+                        choices=list(Holodeck_HelperFunctions.compression_formats),
+                        help='Compress the csv output tables as they are written (adding .gz, .bz2 or .xz to their ' +
+                             'names). Compressed input files (.gz, .bz2 and .xz) are always read transparently ' +
+                             '(default=no compression).')
+
+    parser.add_argument('--partition_by', default=None,
+                        choices=list(Holodeck_HelperFunctions.partition_columns),
+                        help='Split each csv output table into shards by subject (or by subject and trial), ' +
+                             'written to <table>/subject=<id>[/trial=<number>]/part-N.csv, with a shards.json ' +
+                             'index of every shard\'s row count and time range (default=one file per table).')
+
+    parser.add_argument('--partition_rows', default=Holodeck_HelperFunctions.default_partition_rows, type=int,
+                        help='Maximum number of rows in a shard written with --partition_by (default=%d).'
+                             % Holodeck_HelperFunctions.default_partition_rows)
+
+    parser.add_argument('--resample_hz', default=None, type=float,
+                        help='Resample the path and look outputs to this many samples per second instead of ' +
+                             'writing every logged frame. Positions are interpolated, rooms and items clicked are ' +
+                             'carried forward from the last logged frame, and distances and times are recomputed ' +
+                             'between the resampled points (default=every frame).')
+
+    parser.add_argument('--resample_quaternions', default='slerp', choices=['slerp', 'nearest'],
+                        help='How orientations are resampled with --resample_hz: spherical interpolation (slerp) ' +
+                             'or the nearest logged frame (default=slerp).')
+
+    parser.add_argument('--layout', default=None,
+                        help='A JSON (or, with PyYAML installed, YAML) file describing the environment layout: the ' +
+                             'rooms (label, test_boundary, study_boundary) and the items (test_label, study_label, ' +
+                             'test_location, study_location, room). Use --write_layout to get the built in layout ' +
+                             'as a starting point (default=the built in layout).')
+
+    parser.add_argument('--write_layout', metavar='PATH', default=None,
+                        help='Write the built in environment layout to this JSON file and exit.')
+
+    parser.add_argument('--incremental', metavar='OUTPUT_DIRECTORY', default=None,
+                        help='Update an existing output directory instead of creating a new one. Only trials whose ' +
+                             'files are new or have changed since the last run (according to the manifest.json in ' +
+                             'the directory) are parsed, and their rows replace any previous rows in the outputs.')
+
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of worker processes used to parse trials in parallel. The output is identical ' +
+                             'to a run with a single worker. Use 0 for one worker per CPU (default=1).')
+
+    parser.add_argument('--prefetch_depth', default=0, type=int,
+                        help='Number of input files read ahead (in catalog order) by background threads while the ' +
+                             'current file is parsed. Only used without --workers, as worker processes already ' +
+                             'overlap reading with parsing. Use 0 to disable prefetching (default=0).')
+
+    parser.add_argument('--prefetch_memory', default=256, type=int,
+                        help='Maximum number of megabytes of prefetched file contents held in memory (default=256).')
+
+    parser.add_argument('--prefetch_threads', default=2, type=int,
+                        help='Number of background threads reading files ahead (default=2).')
+
+    parser.add_argument('--writer_queue_size', default=16, type=int,
+                        help='Maximum number of row batches queued for each output\'s background writer before ' +
+                             'parsing waits for it to catch up (default=16).')
+
+    parser.add_argument('--summary_cache_size', default=32, type=int,
+                        help='Maximum number of parsed summary files kept in memory for reuse across outputs ' +
+                             '(default=32).')
+
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Write run_report.json to the output directory with the wall and CPU time of each ' +
+                             'stage (discovery, cataloging, summary parsing, each parser, writing), the bytes read, ' +
+                             'the rows written, the time spent on each subject, and the slowest files.')
+    parser.set_defaults(profile=False)
+
+    parser.add_argument('--profile_slowest', default=10, type=int,
+                        help='Number of slowest files listed in run_report.json (default=10).')
+
+    parser.add_argument('--cprofile', dest='cprofile', action='store_true',
+                        help='Run the main process under cProfile and write the statistics to run_profile.prof in ' +
+                             'the output directory (they can be read with the pstats module).')
+    parser.set_defaults(cprofile=False)
+
+    parser.add_argument('--log_level', default=20, type=int,
+                        help='Logging level of the application (default=20/INFO). ' +
+                             'See https://docs.python.org/2/library/logging.html#levels for more info.')
+    parser.set_defaults(log_level=20)
+
+    args = parser.parse_args()
+
+    # Configure the output logger
+    logging.basicConfig(format="%(levelname)s (%(asctime)s): %(message)s", level=args.log_level)
+
+    # Write the built in layout instead of parsing if requested (no input path is needed to do so)
+    if args.write_layout:
+        with open(args.write_layout, 'wb') as fp:
+            json.dump(Holodeck_HelperFunctions.default_environment_layout.to_dict(), fp, indent=1)
+        logging.info("Built in environment layout written to %s." % args.write_layout)
+        return
+
+    if args.path is None:
+        parser.error('too few arguments')
+
+    # Time the stages of the run (and optionally profile the whole of it)
+    profile = Holodeck_HelperFunctions.RunProfile(args.profile_slowest)
+    profiler = None
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # Handle case where no optional arguments excluding processing are provided in which case all optional
+    # args are assumed to be true (for convenience)
+    if not (args.full_study_path or args.full_study_look or args.full_test_path or
+            args.full_test_look or args.full_practice_path or args.full_practice_look or
+            args.full_test_2d or args.full_test_vr or args.full_test_vr_events or args.full_trial_summary or
+            args.full_room_visits):
+        args.full_study_path = True
+        args.full_study_look = True
+        args.full_test_path = True
+        args.full_test_look = True
+        args.full_practice_path = True
+        args.full_practice_look = True
+        args.full_test_2d = True
+        args.full_test_vr = True
+        args.full_trial_summary = True
+        args.full_room_visits = True
+        logging.info("No command line arguments found. Defaulting all true.")
+
+    if args.incremental and args.output_format != 'csv':
+        parser.error('--incremental is only supported with --format csv.')
+    if args.compress_output and args.output_format != 'csv':
+        parser.error('--compress_output is only supported with --format csv.')
+    if args.compress_output and args.incremental:
+        parser.error('--incremental is not supported with --compress_output.')
+    if args.partition_by and args.output_format != 'csv':
+        parser.error('--partition_by is only supported with --format csv.')
+    if args.partition_by and args.incremental:
+        parser.error('--incremental is not supported with --partition_by.')
+    if args.partition_rows <= 0:
+        parser.error('--partition_rows must be greater than 0.')
+    if args.resample_hz is not None and args.resample_hz <= 0:
+        parser.error('--resample_hz must be greater than 0.')
+
+    layout = None
+    if args.layout:
+        try:
+            layout = Holodeck_HelperFunctions.load_environment_layout(args.layout)
+        except (IOError, ValueError), e:
+            parser.error('Could not load the layout file %s (%s).' % (args.layout, e))
+        except Holodeck_HelperFunctions.LogParseError, e:
+            parser.error(str(e))
+        Holodeck_HelperFunctions.set_environment_layout(layout)
+
+    Holodeck_HelperFunctions.summary_cache.max_size = args.summary_cache_size
+    Holodeck_HelperFunctions.resample_hz = args.resample_hz
+    Holodeck_HelperFunctions.resample_quaternions = args.resample_quaternions
+
+    logging.info("Done parsing command line arguments.")
+
+    # Populate list of input files, recursively
+    with profile.stage('discovery'):
+        files = Holodeck_HelperFunctions.discover_files(args.path, args.include, args.exclude, args.discovery_threads)
+
+    # Check if there aren't any files and early stop if there aren't
+    if not files:
+        logging.error("No files found in directory. Closing without creation of output files.")
+        return
+
+    logging.info("Found %d files. Attempting to catalog filenames by Individual, Trial, and Phase" % len(files))
+
+    # Stores filenames for individuals in a data structure for easy handling
+    with profile.stage('cataloging'):
+        individuals, excluded, non_matching = Holodeck_HelperFunctions.catalog_files(files,
+                                                                                     args.min_num_trials,
+                                                                                     args.exclude_incomplete_trials)
+
+    logging.info(("Done cataloging files. %d individuals found which conform to the trial minimum (%d). " +
+                  "%d files not matching any expected filename format. %d files excluded on input criteria.")
+                 % (len(individuals), args.min_num_trials, len(non_matching), len(excluded)))
+
+    # In debug mode, print excluded files
+    for filename in excluded:
+        logging.debug("%s was excluded." % filename)
+
+    # Create the output directory (a new one tagged with the current date and time unless an existing directory is
+    # being updated incrementally)
+    if args.incremental:
+        output_directory = os.path.abspath(args.incremental)
+    else:
+        output_directory = os.path.join(os.getcwd(), datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    try:
+        os.mkdir(output_directory)
+        logging.info("Output directory (%s) created." % output_directory)
+    except OSError, e:
+        if e.errno != 17:
+            raise
+        else:
+            logging.info("Output directory (%s) already exists. Continuing..." % output_directory)
+
+    # Determine the outputs to generate and which of them need to be parsed for each trial
+    output_names = [name for name in Holodeck_HelperFunctions.output_files if getattr(args, 'full_' + name)]
+    manifest = None
+    trial_outputs = dict()
+    replaced_trials = set()
+    if args.incremental:
+        manifest = Holodeck_HelperFunctions.OutputManifest(output_directory)
+        # Rows resampled differently or parsed with a different layout can't be mixed in the same outputs (the
+        # built in layout is recorded as None)
+        layout_settings = layout.to_dict() if layout else None
+        if layout_settings == Holodeck_HelperFunctions.default_environment_layout.to_dict():
+            layout_settings = None
+        settings = {'resample_hz': args.resample_hz, 'resample_quaternions': args.resample_quaternions,
+                    'layout': layout_settings}
+        if manifest.outputs and manifest.settings != settings:
+            parser.error('The outputs in %s were generated with different settings (--resample_hz %s '
+                         '--resample_quaternions %s%s).' % (output_directory, manifest.settings['resample_hz'],
+                                                            manifest.settings['resample_quaternions'],
+                                                            ' and a different --layout' if
+                                                            manifest.settings['layout'] != settings['layout'] else ''))
+        manifest.settings = settings
+        # Outputs already in the directory are always kept up to date
+        output_names = [name for name in Holodeck_HelperFunctions.output_files
+                        if name in output_names or name in manifest.outputs]
+        existing_outputs = [name for name in output_names if name in manifest.outputs]
+        # Rows can only be added to outputs which have the current columns
+        for name in existing_outputs:
+            filename, header = Holodeck_HelperFunctions.output_files[name]
+            if Holodeck_HelperFunctions.read_output_header(output_directory, filename) != header:
+                parser.error('%s in %s has different columns than this version writes. Regenerate it without '
+                             '--incremental.' % (filename, output_directory))
+        trial_outputs, replaced_trials = manifest.update(individuals, output_names)
+        logging.info("Incremental update: %d of %d trials need parsing, %d trials replaced or removed."
+                     % (len([key for key in trial_outputs if trial_outputs[key]]), len(trial_outputs),
+                        len(replaced_trials)))
+        # Remove the rows of changed and removed trials from the existing outputs before new rows are appended
+        if replaced_trials:
+            for name in existing_outputs:
+                removed = Holodeck_HelperFunctions.remove_trial_rows(
+                    output_directory, Holodeck_HelperFunctions.output_files[name][0], replaced_trials)
+                logging.info("Removed %d rows of replaced trials from %s." % (removed, name))
     else:
-        logging.info("Output directory (%s) already exists. Continuing..." % output_directory)
-
-logging.info("Creating output files.")
-
-# Generate variable references for the csv writers
-full_study_path_writer = None
-full_study_look_writer = None
-full_test_path_writer = None
-full_test_look_writer = None
-full_practice_path_writer = None
-full_practice_look_writer = None
-full_test_2d_writer = None
-full_test_vr_writer = None
-
-output_file_pointers = []
-output_file_pointer = None
-
-# Create the appropriate output files for the options requested and write their headers
-if args.full_study_path:
-    full_study_path_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "study_path.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time",
-                                                   "x", "y",
-                                                   "z", "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_study_look:
-    full_study_look_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "study_look.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time",
-                                                   "x", "y",
-                                                   "z", "w", "euler_x",
-                                                   "euler_y", "euler_z",
-                                                   "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_test_path:
-    full_test_path_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "test_path.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time", "x",
-                                                   "y",
-                                                   "z", "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_test_look:
-    full_test_look_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "test_look.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time", "x",
-                                                   "y",
-                                                   "z", "w", "euler_x",
-                                                   "euler_y", "euler_z",
-                                                   "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_practice_path:
-    full_practice_path_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "practice_path.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time",
-                                                   "x",
-                                                   "y",
-                                                   "z", "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_practice_look:
-    full_practice_look_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "practice_look.csv",
-                                                  ["subject_id",
-                                                   "trial_number", "time",
-                                                   "x",
-                                                   "y",
-                                                   "z", "w", "euler_x",
-                                                   "euler_y", "euler_z",
-                                                   "room_by_order",
-                                                   "room_by_color",
-                                                   "items_clicked",
-                                                   "distance_from_last_point",
-                                                   "time_since_last_point"])
-output_file_pointers.append(output_file_pointer)
-if args.full_test_2d:
-    full_test_2d_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "2d_test.csv",
-                                                  ["subject_id", "trial_number",
-                                                   "item_id",
-                                                   "x_placed", "y_placed",
-                                                   "x_expected", "y_expected",
-                                                   "order_clicked_study",
-                                                   "expected_room_by_order",
-                                                   "expected_room_by_color",
-                                                   "actual_room_by_order",
-                                                   "actual_room_by_color"])
-output_file_pointers.append(output_file_pointer)
-if args.full_test_vr:
-    full_test_vr_writer, output_file_pointer = \
-        Holodeck_HelperFunctions.make_output_file(output_directory,
-                                                  "vr_test.csv",
-                                                  ["subject_id", "trial_number",
-                                                   "item_id",
-                                                   "x_placed", "y_placed",
-                                                   "x_expected", "y_expected",
-                                                   "order_clicked_study",
-                                                   "expected_room_by_order",
-                                                   "expected_room_by_color",
-                                                   "actual_room_by_order",
-                                                   "actual_room_by_color",
-                                                   "number_of_replacements",
-                                                   "time_placed"])
-output_file_pointers.append(output_file_pointer)
-
-logging.info("Parsing input files.")
-
-# Parse each individual and contribute their data to the appropriate file if possible
-count = 1
-for individual in individuals:
-    logging.info("Parsing Individual %s (%d/%d)." % (individual.subject_id, count, len(individuals)))
-    count += 1
-    trial_count = 1
-    for trial in individual.trials:
-        logging.info("Parsing Trial %d (%d/%d)." % (trial.num, trial_count, len(individual.trials)))
-        trial_count += 1
-        if args.full_study_path:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.study_path, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.path_file,
-                                                          full_study_path_writer,
-                                                          trial.study_summary)
-        if args.full_study_look:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.study_look, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.look_file,
-                                                          full_study_look_writer,
-                                                          trial.study_summary)
-        if args.full_test_path:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.test_path, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.path_file,
-                                                          full_test_path_writer,
-                                                          trial.test_summary)
-        if args.full_test_look:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.test_look, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.look_file,
-                                                          full_test_look_writer,
-                                                          trial.test_summary)
-        if args.full_practice_path:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.practice_path, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.path_file,
-                                                          full_practice_path_writer,
-                                                          trial.practice_summary)
-        if args.full_practice_look:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.practice_look, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.look_file,
-                                                          full_practice_look_writer,
-                                                          trial.practice_summary)
-        if args.full_test_2d:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.test_2d, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.test_file_2d,
-                                                          full_test_2d_writer,
-                                                          trial.study_summary)
-        if args.full_test_vr:
-            Holodeck_HelperFunctions.parse_file_and_write(trial.test_vr, individual.subject_id, trial.num,
-                                                          Holodeck_HelperFunctions.FileType.test_file_vr,
-                                                          full_test_vr_writer,
-                                                          trial.study_summary)
-
-logging.info("Done parsing input files.")
-
-logging.info("Closing output files.")
-
-# Close all writers if they were opened
-for pointer in output_file_pointers:
-    Holodeck_HelperFunctions.close_writer(pointer)
-
-logging.info('Parsing complete.')
+        existing_outputs = []
+
+    logging.info("Creating output files.")
+
+    # Create the appropriate output files for the options requested and write their headers. Each output is written by
+    # its own background writer.
+    writers = dict()
+    for name in output_names:
+        filename, header = Holodeck_HelperFunctions.output_files[name]
+        writers[name] = Holodeck_HelperFunctions.make_async_output_file(
+            name, output_directory, filename, header, append=name in existing_outputs,
+            output_format=args.output_format, max_queued_batches=args.writer_queue_size,
+            compression=args.compress_output, partition_by=args.partition_by, partition_rows=args.partition_rows)
+
+    # Generate the parsing jobs for each individual and trial in catalog order
+    trial_jobs = dict()
+    jobs = []
+    for individual in individuals:
+        for trial in individual.trials:
+            key = (individual.subject_id, trial.num)
+            trial_jobs[key] = Holodeck_HelperFunctions.get_trial_parse_jobs(individual.subject_id, trial,
+                                                                            trial_outputs.get(key, writers))
+            jobs.extend(trial_jobs[key])
+
+    # The decompressed copies of compressed tar archives are removed once the jobs reading them are done
+    archive_releaser = Holodeck_HelperFunctions.ArchiveReleaser(jobs)
+
+    # Parse the jobs in this process or spread them over a pool of worker processes. Workers return shard files of row
+    # batches in job order, so rows are always written in catalog order and the output is identical.
+    pool = None
+    shards = None
+    prefetcher = None
+    if args.workers == 0:
+        args.workers = multiprocessing.cpu_count()
+    if args.workers > 1:
+        logging.info("Parsing input files with %d worker processes." % args.workers)
+        pool = multiprocessing.Pool(args.workers, initializer=Holodeck_HelperFunctions.initialize_worker,
+                                    initargs=(args.log_level, args.summary_cache_size, args.resample_hz,
+                                              args.resample_quaternions, layout))
+        shards = pool.imap(Holodeck_HelperFunctions.run_parse_job, jobs)
+    else:
+        logging.info("Parsing input files.")
+        if args.prefetch_depth > 0:
+            logging.info("Prefetching up to %d files (%d MB) ahead with %d threads."
+                         % (args.prefetch_depth, args.prefetch_memory, args.prefetch_threads))
+            prefetcher = Holodeck_HelperFunctions.FilePrefetcher([job.path for job in jobs], args.prefetch_depth,
+                                                                 args.prefetch_memory * 1024 * 1024,
+                                                                 args.prefetch_threads)
+
+    # Parse each individual and contribute their data to the appropriate file if possible
+    try:
+        count = 1
+        for individual in individuals:
+            logging.info("Parsing Individual %s (%d/%d)." % (individual.subject_id, count, len(individuals)))
+            count += 1
+            trial_count = 1
+            for trial in individual.trials:
+                logging.info("Parsing Trial %d (%d/%d)." % (trial.num, trial_count, len(individual.trials)))
+                trial_count += 1
+                for job in trial_jobs[(individual.subject_id, trial.num)]:
+                    if shards:
+                        with profile.stage('waiting_for_workers'):
+                            shard_path, record = next(shards)
+                        batches = Holodeck_HelperFunctions.read_parse_job_shard(shard_path)
+                    else:
+                        data = None
+                        if prefetcher:
+                            with profile.stage('waiting_for_prefetch'):
+                                data = prefetcher.get()
+                        record = Holodeck_HelperFunctions.make_job_record(job)
+                        batches = Holodeck_HelperFunctions.profile_batches(
+                            Holodeck_HelperFunctions.parse_job(job, data), record)
+                    for index, rows in batches:
+                        with profile.stage('writing'):
+                            writers[job.output_names[index]].writerows(rows)
+                        profile.add_rows(job.output_names[index], len(rows))
+                    profile.add_job(record)
+                    archive_releaser.job_done(job)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if prefetcher:
+            prefetcher.close()
+            prefetcher.log_statistics()
+
+    logging.info("Done parsing input files.")
+
+    Holodeck_HelperFunctions.summary_cache.log_statistics()
+
+    logging.info("Closing output files.")
+
+    # Write any rows still queued and close all writers
+    with profile.stage('writing'):
+        for name in output_names:
+            writers[name].close()
+
+    # Index the shards of the partitioned outputs
+    if args.partition_by:
+        Holodeck_HelperFunctions.write_shard_index(output_directory, collections.OrderedDict(
+            (name, writers[name].writer) for name in output_names))
+        logging.info("Shard index saved (%s)." % os.path.join(output_directory,
+                                                              Holodeck_HelperFunctions.shard_index_filename))
+
+    # Record the files which produced the outputs so the next incremental run can skip them
+    if manifest:
+        manifest.save()
+        logging.info("Manifest saved (%s)." % os.path.join(output_directory, manifest.filename))
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_directory, 'run_profile.prof'))
+        logging.info("cProfile statistics saved (%s)." % os.path.join(output_directory, 'run_profile.prof'))
+
+    if args.profile:
+        profile.write_report(os.path.join(output_directory, 'run_report.json'), arguments=vars(args))
+        logging.info("Run report saved (%s)." % os.path.join(output_directory, 'run_report.json'))
+
+    logging.info('Parsing complete.')
+
+
+if __name__ == '__main__':
+    main()
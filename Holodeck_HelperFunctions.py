@@ -2,12 +2,31 @@ import os
 import csv
 import logging
 import re
+import fnmatch
 import datetime
 import time
 import math
+import collections
+import contextlib
+import itertools
+import multiprocessing.pool
+import tempfile
+import atexit
+import shutil
+import threading
+import Queue
+import cStringIO
+import cPickle
+import hashlib
+import json
+import struct
+import mmap
+import zlib
+import bz2
+import zipfile
+import tarfile
 import numpy
 from enum import Enum
-from scipy.spatial import distance
 
 test_skip_lines = 124
 
@@ -68,6 +87,7 @@ class Individual:
 class Trial:
     def __init__(self):
         self.num = -1  # The trial number
+        self.subject_id = None  # string of the subject id of the individual the trial belongs to
         # The paths to the associated files
         self.study_path = None
         self.study_look = None
@@ -95,7 +115,11 @@ class Trial:
                  self.practice_look, self.practice_summary, self.test_2d, self.test_vr]
         return filter(None, files)
 
-    def all_trial_dates_match(self):
+    # Helper function to check that the files of each phase have the same date/time. The dates can be looked up in a
+    # dict of path->datetime (such as the one made by catalog_files) instead of being parsed from the filenames.
+    def all_trial_dates_match(self, dates=None):
+        if dates is None:
+            dates = dict()
         files = [[self.study_path, self.study_look, self.study_summary],
                  [self.test_path, self.test_look, self.test_summary],
                  [self.practice_path, self.practice_look, self.practice_summary]]
@@ -105,143 +129,121 @@ class Trial:
             for f in file_set:
                 if f:
                     if not root_date:
-                        root_date = extract_date_time_from_filename_custom(f)
+                        root_date = dates.get(f) or extract_date_time_from_filename_custom(f)
                     else:
-                        current_date = extract_date_time_from_filename_custom(f)
+                        current_date = dates.get(f) or extract_date_time_from_filename_custom(f)
                         if not root_date == current_date:
                             match = False
                             break
         return match
 
 
+# The regular expressions used to find the date/time in a filename (the 2D test format and the Unity format)
+re_test_time = re.compile(r"(\d\d\d\d)-(\d\d)-(\d\d)_(\d\d)-(\d\d)-(\d\d)-([AP]M)")
+re_nav_time = re.compile(r"(\d\d)_(\d\d)_(\d\d)_(\d\d)-(\d\d)-(\d\d\d\d)")
+
+
 # Helper function which will extract a datetime object given two possible formats of datetime strings (the formats
-# which are used by the Unity program and the 2D test program
+# which are used by the Unity program and the 2D test program). None is returned if neither format is found.
 def extract_date_time_from_filename_custom(filename):
     # 15_04_56_20-01-2016 , raw log
     # 2016-01-20_03-16-31-PM , test
-    # Use a regular expression to find the file format portion of the filename
-    re_test_time = re.compile("(\d\d\d\d-\d\d-\d\d_\d\d-\d\d-\d\d-[AP]M)")
-    re_nav_time = re.compile("\d\d_\d\d_\d\d_\d\d-\d\d-\d\d\d\d")
-
-    # Determine which format is being used and parse it
-    datetime_val = None
-    if re_test_time.search(filename):
-        datetime_val = time.strptime(re_test_time.findall(filename)[0], "%Y-%m-%d_%I-%M-%S-%p")
-    if re_nav_time.search(filename):
-        datetime_val = time.strptime(re_nav_time.findall(filename)[0], "%H_%M_%S_%d-%m-%Y")
-
-    # Convert the time struct to a datetime and return it
-    return datetime.datetime.fromtimestamp(time.mktime(datetime_val))
+    # The raw log format takes precedence if both are present
+    match = re_nav_time.search(filename)
+    if match:
+        hour, minute, second, day, month, year = [int(value) for value in match.groups()]
+        return datetime.datetime(year, month, day, hour, minute, second)
+    match = re_test_time.search(filename)
+    if match:
+        year, month, day, hour, minute, second = [int(value) for value in match.groups()[0:6]]
+        if not 1 <= hour <= 12:
+            raise ValueError("The hour of a 12 hour time must be between 1 and 12 (%s)." % filename)
+        return datetime.datetime(year, month, day, hour % 12 + (12 if match.group(7) == 'PM' else 0), minute, second)
+    return None
+
+
+# The kinds of input files, in the order they are cataloged, and the regular expressions which match their file names
+file_kind_patterns = [('raw', re.compile('RawLog.*')),
+                      ('summary', re.compile('SummaryLog.*')),
+                      ('test2d', re.compile('GMDA.*_Raw\.csv'))]
+
+# The regular expression which splits a path on both Windows and POSIX separators
+re_path_separator = re.compile(r'[\\/]')
+
+
+# Helper function which gets the name of the file at path, whether it is a Windows or POSIX path
+def get_path_basename(path):
+    return re_path_separator.split(path)[-1]
+
+# The phases which are searched for in the paths of raw and summary files
+file_phases = ['practice', 'study', 'test']
+
+# The metadata of an input file, parsed once from its path (see get_file_record). phases holds every phase named in
+# the path of a raw or summary file (it is empty for 2D test files).
+FileRecord = collections.namedtuple('FileRecord', ['path', 'kind', 'phases', 'subject_id', 'datetime'])
+
+
+# Helper function which parses the path of an input file into a FileRecord, or returns None if the path doesn't match
+# any expected filename format
+def get_file_record(path):
+    basename = get_path_basename(path)
+    for kind, pattern in file_kind_patterns:
+        if pattern.match(basename):
+            break
+    else:
+        return None
+    if kind == 'test2d':
+        # The 2D test program puts the subject id at a fixed location in the basename
+        subject_id = basename[5:8]
+        phases = ()
+    else:
+        subject_id_split = basename.split('_')
+        if len(subject_id_split) < 2:
+            return None
+        subject_id = subject_id_split[1][3:]
+        path_lower = path.lower()
+        phases = tuple(phase for phase in file_phases if phase in path_lower)
+    date_time = extract_date_time_from_filename_custom(path)
+    if date_time is None:
+        return None
+    return FileRecord(path, kind, phases, subject_id, date_time)
 
 
 # should produce Individual list filled according to input restrictions
 def catalog_files(files, min_num_trials, exclude_incomplete_trials):
-    # First, isolate each file type we care about
-    raw_files = []
-    summary_files = []
-    test_2d_raw_files = []
     non_matching_files = []
     other_files = []
 
-    # Generate regular expressions to determine if a particular file is of a particular type
-    re_raw = re.compile('C:.*\\\RawLog.*')
-    re_summary = re.compile('C:.*\\\SummaryLog.*')
-    re_test_2d_raw = re.compile('C:.*\\\GMDA.*_Raw\.csv')
-
-    # Search all the files and classify them by type
+    # Parse every path into a record once, keeping the records of each kind in input order
+    records_by_kind = dict((kind, []) for kind, pattern in file_kind_patterns)
     for f in files:
-        if re_raw.match(f):
-            raw_files.append(f)
-        elif re_summary.match(f):
-            summary_files.append(f)
-        elif re_test_2d_raw.match(f):
-            test_2d_raw_files.append(f)
-        else:
+        record = get_file_record(f)
+        if record is None:
             non_matching_files.append(f)
+        else:
+            records_by_kind[record.kind].append(record)
 
-    # Generate dictionary of individuals for various phases (practice, study, test)
+    # Group the records by individual and phase type (practice, study, test and their summaries, and test2d)
     subject_dict = dict()
-    search_subtypes = ['practice', 'study', 'test']
-    store_subtypes = ['practice', 'study', 'test']
-    for f in raw_files:
-        subtype_found = False
-        for search, store in zip(search_subtypes, store_subtypes):
-            # Extract the subject id from the basename for the file
-            basename = os.path.basename(f)
-            subject_id_split = basename.split('_')
-            subject_id = subject_id_split[1][3:]
-            # Search for the particular file subtype and store it in the dictionary if it is found
-            search_lower = search.lower()
-            store_lower = store.lower()
-            if search_lower in f.lower():
-                subtype_found = True
-                if subject_id in subject_dict:
-                    # If the subject is already in the dictionary
-                    if store_lower in subject_dict[subject_id]:
-                        # If the subtype is already in the dictionary, append the current file to that list
-                        subject_dict[subject_id][store_lower].append(f)
-                    else:
-                        # If the subtype is not in the dictionary, add it and add the current file to the list
-                        subject_dict[subject_id][store_lower] = [f]
-                else:
-                    # If the subject isn't in the dictionary, add them and add the subtype field
-                    subject_dict[subject_id] = dict()
-                    subject_dict[subject_id][store_lower] = [f]
-        if not subtype_found:
-            # If the file had been classified as a raw file type but wasn't added to any field, add it to other_files
-            other_files.append(f)
-
-    # Generate dictionary of summary files for individuals for various phases (practice, study, test)
-    search_subtypes = ['practice', 'study', 'test']
-    store_subtypes = ['practice_summary', 'study_summary', 'test_summary']
-    for f in summary_files:
-        subtype_found = False
-        for search, store in zip(search_subtypes, store_subtypes):
-            # Extract the subject id from the basename for the file
-            basename = os.path.basename(f)
-            subject_id_split = basename.split('_')
-            subject_id = subject_id_split[1][3:]
-            # Search for the particular file subtype and store it in the dictionary if it is found
-            search_lower = search.lower()
-            store_lower = store.lower()
-            if search_lower in f.lower():
-                subtype_found = True
-                if subject_id in subject_dict:
-                    # If the subject is already in the dictionary
-                    if store_lower in subject_dict[subject_id]:
-                        # If the subtype is already in the dictionary, append the current file to that list
-                        subject_dict[subject_id][store_lower].append(f)
-                    else:
-                        # If the subtype is not in the dictionary, add it and add the current file to the list
-                        subject_dict[subject_id][store_lower] = [f]
-                else:
-                    # If the subject isn't in the dictionary, add them and add the subtype field
-                    subject_dict[subject_id] = dict()
-                    subject_dict[subject_id][store_lower] = [f]
-        if not subtype_found:
-            # If the file had been classified as a raw file type but wasn't added to any field, add it to other_files
-            other_files.append(f)
-
-    # Search for the 2D files and add them to the data structure
-    store_string = 'test2d'
-    for f in test_2d_raw_files:
-        # Once again, extract subject id by location in basename string
-        basename = os.path.basename(f)
-        subject_id = basename[5:8]
-        # Find subject in dictionary
-        if subject_id in subject_dict:
-            if store_string in subject_dict[subject_id]:
-                # If the subject and test2d list are present, add the file to that list
-                subject_dict[subject_id][store_string].append(f)
+    for kind, pattern in file_kind_patterns:
+        for record in records_by_kind[kind]:
+            if kind == 'test2d':
+                stores = ['test2d']
+            elif kind == 'summary':
+                stores = [phase + '_summary' for phase in record.phases]
             else:
-                # If the subject is there but the test2d list isn't, add the list and the file
-                subject_dict[subject_id][store_string] = [f]
-        else:
-            # If subject isn't there, add them, then add the test2d list and file
-            subject_dict[subject_id] = dict()
-            subject_dict[subject_id][store_string] = [f]
+                stores = list(record.phases)
+            if not stores:
+                # If the file had been classified as a raw file type but wasn't added to any field, add it to
+                # other_files
+                other_files.append(record.path)
+                continue
+            phase_types = subject_dict.setdefault(record.subject_id, dict())
+            for store in stores:
+                phase_types.setdefault(store, []).append(record)
 
     individuals = []
+    dates = dict()
 
     # Sort files in each phase according to file date/time
     for subject_id in subject_dict:
@@ -249,52 +251,41 @@ def catalog_files(files, min_num_trials, exclude_incomplete_trials):
         new_individual = Individual()
         new_individual.subject_id = subject_id
         new_individual.trials = []
-        # Create a temporary variable for determining the max number of trials in any given phase type
-        max_trial_phase_count = 0
-        # Iterate through the phase types, sort the files by date/time (to get order), and generate Trial objects
-        for phase_type in subject_dict[subject_id]:
-            dates = []
-            # If the current phase type has more files than any other, set the max_trial_phase_count to that length
-            if len(subject_dict[subject_id][phase_type]) > max_trial_phase_count:
-                max_trial_phase_count = len(subject_dict[subject_id][phase_type])
-
-            # For the files in this phase type, extract the file date/time as a datetime object and add it to dates list
-            for f in subject_dict[subject_id][phase_type]:
-                dates.append(extract_date_time_from_filename_custom(f))
-            # Zip the datetimes and filenames
-            zipped = zip(dates, subject_dict[subject_id][phase_type])
-            # If there's more than one file in the list, sort it
-            if len(zipped) >= 2:
-                # Sort by Year, Month, Day, Hour, Minute, Second
-                sorted_zipped = sorted(zipped, key=lambda x: datetime.datetime.strftime(x[0], "%Y %m %d %H %M %S"))
-                # Extract the sorted data back into the structure
-                dates, subject_dict[subject_id][phase_type] = zip(*sorted_zipped)
+        # Sort the records of each phase type by date/time (to get order, keeping the input order of equal times) and
+        # keep their paths
+        phase_files = dict()
+        for phase_type, records in subject_dict[subject_id].iteritems():
+            records.sort(key=lambda r: r.datetime)
+            phase_files[phase_type] = [record.path for record in records]
+            dates.update((record.path, record.datetime) for record in records)
+        # The number of trials is the largest number of files in any given phase type
+        max_trial_phase_count = max(len(paths) for paths in phase_files.values())
         # Iterate through each element in each phase type, creating trials that unify them all
         for i in range(0, max_trial_phase_count):
             # Create a new trial with the correct number
             new_trial = Trial()
             new_trial.num = i
+            new_trial.subject_id = subject_id
             # Extract practice, study, test, test2d, and testvr files from the data structure (if they are available)
             # and add them to the trial object.
-            if ('practice' in subject_dict[subject_id]) and len(subject_dict[subject_id]['practice']) > i:
-                new_trial.practice_path = subject_dict[subject_id]['practice'][i]
-                new_trial.practice_look = subject_dict[subject_id]['practice'][i]
-            if ('study' in subject_dict[subject_id]) and len(subject_dict[subject_id]['study']) > i:
-                new_trial.study_path = subject_dict[subject_id]['study'][i]
-                new_trial.study_look = subject_dict[subject_id]['study'][i]
-            if ('test' in subject_dict[subject_id]) and len(subject_dict[subject_id]['test']) > i:
-                new_trial.test_path = subject_dict[subject_id]['test'][i]
-                new_trial.test_look = subject_dict[subject_id]['test'][i]
-            if ('test2d' in subject_dict[subject_id]) and len(subject_dict[subject_id]['test2d']) > i:
-                new_trial.test_2d = subject_dict[subject_id]['test2d'][i]
-            if ('test_summary' in subject_dict[subject_id]) and len(subject_dict[subject_id]['test_summary']) > i:
-                new_trial.test_vr = subject_dict[subject_id]['test_summary'][i]
-                new_trial.test_summary = subject_dict[subject_id]['test_summary'][i]
-            if ('study_summary' in subject_dict[subject_id]) and len(subject_dict[subject_id]['study_summary']) > i:
-                new_trial.study_summary = subject_dict[subject_id]['study_summary'][i]
-            if ('practice_summary' in subject_dict[subject_id]) and len(
-                    subject_dict[subject_id]['practice_summary']) > i:
-                new_trial.practice_summary = subject_dict[subject_id]['practice_summary'][i]
+            if len(phase_files.get('practice', [])) > i:
+                new_trial.practice_path = phase_files['practice'][i]
+                new_trial.practice_look = phase_files['practice'][i]
+            if len(phase_files.get('study', [])) > i:
+                new_trial.study_path = phase_files['study'][i]
+                new_trial.study_look = phase_files['study'][i]
+            if len(phase_files.get('test', [])) > i:
+                new_trial.test_path = phase_files['test'][i]
+                new_trial.test_look = phase_files['test'][i]
+            if len(phase_files.get('test2d', [])) > i:
+                new_trial.test_2d = phase_files['test2d'][i]
+            if len(phase_files.get('test_summary', [])) > i:
+                new_trial.test_vr = phase_files['test_summary'][i]
+                new_trial.test_summary = phase_files['test_summary'][i]
+            if len(phase_files.get('study_summary', [])) > i:
+                new_trial.study_summary = phase_files['study_summary'][i]
+            if len(phase_files.get('practice_summary', [])) > i:
+                new_trial.practice_summary = phase_files['practice_summary'][i]
 
             # Check if trial should be excluded based on the input criteria and trial status
             if exclude_incomplete_trials and not new_trial.is_complete():
@@ -303,7 +294,7 @@ def catalog_files(files, min_num_trials, exclude_incomplete_trials):
                 continue
             else:
                 # If it should not be excluded, add it to the individual
-                if new_trial.all_trial_dates_match():
+                if new_trial.all_trial_dates_match(dates):
                     new_individual.trials.append(new_trial)
                 else:
                     logging.error(("Error: In cataloging trials a trial was found to have non-matching dates " +
@@ -321,48 +312,1582 @@ def catalog_files(files, min_num_trials, exclude_incomplete_trials):
     return individuals, excluded_files, non_matching_files
 
 
-# Helper function which will make a csv writer reference to be passed around for file writing
-def make_output_file(directory, filename, header):
-    output = open(os.path.join(directory, filename), 'wb')
+# The scandir function used to list directories. It is built into Python 3.5+; on Python 2 the scandir package
+# (pip install scandir) is needed for it. Without it, directories are listed with os.listdir, which needs two extra
+# stats for every entry, and a warning is logged (once) when discovery starts.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+_scandir_warning_logged = False
+
+
+# Helper function which lists a directory as (name, is_dir) pairs sorted by name. Symbolic links to directories are
+# left out (like os.walk, discovery doesn't follow them). A directory which can't be listed is skipped with a warning
+# (os.walk skips them silently), and an empty list is returned for it.
+def _list_directory(path):
+    entries = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                is_dir = entry.is_dir()
+                if not (is_dir and entry.is_symlink()):
+                    entries.append((entry.name, is_dir))
+        else:
+            for name in os.listdir(path):
+                full_path = os.path.join(path, name)
+                is_dir = os.path.isdir(full_path)
+                if not (is_dir and os.path.islink(full_path)):
+                    entries.append((name, is_dir))
+    except OSError as e:
+        logging.warning("The directory %s could not be listed (%s). Skipping..." % (path, e))
+        return []
+    entries.sort()
+    return entries
+
+
+# Helper function which checks if the parts of a relative path match the parts of a glob pattern split on '/', where
+# each part is matched with fnmatch and a '**' part matches any number of parts. If partial is True, the path is a
+# directory and the check is whether anything inside it could match.
+def _glob_parts_match(path_parts, pattern_parts, partial=False):
+    if not pattern_parts:
+        return not path_parts
+    if pattern_parts[0] == '**':
+        return any(_glob_parts_match(path_parts[i:], pattern_parts[1:], partial) for i in range(0, len(path_parts) + 1))
+    if not path_parts:
+        return partial
+    return fnmatch.fnmatchcase(path_parts[0], pattern_parts[0]) and \
+        _glob_parts_match(path_parts[1:], pattern_parts[1:], partial)
+
+
+# Helper function which checks if a relative path (as a list of parts) matches any of the glob patterns. Patterns
+# without a '/' are matched against the name only. If partial is True, the path is a directory and the check is
+# whether anything inside it could match a pattern (patterns without a '/' could match anywhere).
+def _glob_match_any(path_parts, patterns, partial=False):
+    for pattern in patterns:
+        if '/' not in pattern:
+            if partial or fnmatch.fnmatchcase(path_parts[-1], pattern):
+                return True
+        elif _glob_parts_match(path_parts, pattern.strip('/').split('/'), partial):
+            return True
+    return False
+
+
+# Helper function which checks if the name of a file is one of the input file names (a RawLog, SummaryLog or
+# GMDA*_Raw.csv file), regardless of the operating system's path separators
+def is_input_file_name(path):
+    name = get_path_basename(path)
+    return any(pattern.match(name) for kind, pattern in file_kind_patterns)
+
+
+# The regular expression which matches the names of the zip and tar archives which can be read like directories
+re_archive_name = re.compile(r'.*\.(zip|tar|tgz|tbz2|tar\.gz|tar\.bz2)$', re.IGNORECASE)
+
+# The regular expression which splits a path inside an archive into the path of the archive and the member's name
+re_archive_path = re.compile(r'^(.*?\.(?:zip|tar|tgz|tbz2|tar\.gz|tar\.bz2))[\\/](.+)$', re.IGNORECASE)
+
+
+# This object reads the members of a zip or tar archive without extracting them. The archive's index is read once,
+# and each member is opened as its own stream (zip members are decompressed as they are read, and plain tar members
+# are read in place). Compressed tars can't be read at random, so the input files in them (see is_input_file_name) are
+# decompressed once, in a single pass in archive order while the index is read, into a temporary file from which they
+# are read like the members of a plain tar. The temporary file is removed by close (see release_archive_index), or
+# when the process which made it exits.
+class ArchiveIndex:
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = zipfile.is_zipfile(path)
+        self.members = collections.OrderedDict()  # name -> (size, mtime)
+        if self.is_zip:
+            self.archive = zipfile.ZipFile(path)
+            for info in self.archive.infolist():
+                if not info.filename.endswith('/'):
+                    self.members[info.filename] = (info.file_size, time.mktime(info.date_time + (0, 0, -1)))
+        else:
+            self.is_compressed = not path.lower().endswith('.tar')
+            self.data_path = path  # the file the members are read from
+            self.offsets = dict()  # name -> offset of the member's data in data_path
+            if self.is_compressed:
+                self._decompress_members()
+            else:
+                archive = tarfile.open(path)
+                try:
+                    for info in archive.getmembers():
+                        if info.isfile():
+                            self.members[info.name] = (info.size, float(info.mtime))
+                            self.offsets[info.name] = info.offset_data
+                finally:
+                    archive.close()
+
+    # Helper function which streams through a compressed tar once, copying the data of each of its input files into a
+    # temporary file (owned by this process, as worker processes may inherit the index)
+    def _decompress_members(self):
+        handle, self.data_path = tempfile.mkstemp(prefix='holodeck_archive_', suffix='.tmp')
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+        with os.fdopen(handle, 'wb') as destination:
+            archive = tarfile.open(self.path, 'r|*')
+            try:
+                for info in archive:
+                    if info.isfile():
+                        self.members[info.name] = (info.size, float(info.mtime))
+                        if is_input_file_name(info.name):
+                            self.offsets[info.name] = destination.tell()
+                            shutil.copyfileobj(archive.extractfile(info), destination, 1 << 20)
+            finally:
+                archive.close()
+
+    # Helper function which opens a member of the archive as a read-only file-like object
+    def open(self, name):
+        if name not in self.members:
+            raise IOError("%s is not in the archive %s." % (name, self.path))
+        if self.is_zip:
+            # The archive was opened by name, so each member gets its own file handle (and can be read from any thread)
+            return self.archive.open(name)
+        if name not in self.offsets:
+            raise IOError("%s in the archive %s is not an input file, so it was not decompressed." % (name, self.path))
+        fp = open(self.data_path, 'rb')
+        fp.seek(self.offsets[name])
+        return ArchiveMemberFile(fp, self.members[name][0])
+
+    # Helper function which removes the temporary file of the decompressed members of a compressed tar
+    def close(self):
+        if not self.is_zip and self.is_compressed and self.owner_pid == os.getpid() and \
+                os.path.exists(self.data_path):
+            try:
+                os.remove(self.data_path)
+            except OSError:
+                pass
+
+
+# This object is a read-only file-like object over the next size bytes of a file (an archive member), which closes the
+# file when it is closed
+class ArchiveMemberFile:
+    def __init__(self, file_pointer, size):
+        self.file_pointer = file_pointer
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file_pointer.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file_pointer.close()
+
+
+# The ArchiveIndex of each archive read so far, by path
+_archive_indices = dict()
+_archive_indices_lock = threading.Lock()
+
+
+# Helper function which gets the (cached) ArchiveIndex of the archive at path
+def get_archive_index(path):
+    with _archive_indices_lock:
+        if path not in _archive_indices:
+            _archive_indices[path] = ArchiveIndex(path)
+        return _archive_indices[path]
+
+
+# Helper function which drops the cached ArchiveIndex of the archive at path, removing its temporary file (if it is a
+# compressed tar). The archive is indexed again if it is read later.
+def release_archive_index(path):
+    with _archive_indices_lock:
+        index = _archive_indices.pop(path, None)
+    if index is not None:
+        index.close()
+
+
+# Helper function which gets the set of paths of the archives a ParseJob reads files from
+def get_job_archives(job):
+    return set(archive_path for archive_path, member in
+               [split_archive_path(path) for path in [job.path, job.summary_file_path] if path]
+               if archive_path is not None)
+
+
+# This object releases the ArchiveIndex of each archive (see release_archive_index) as soon as the last of a list of
+# ParseJobs which read from it is done. Archives none of the jobs read from are released right away.
+class ArchiveReleaser:
+    def __init__(self, jobs):
+        self.remaining_jobs = collections.Counter()
+        for job in jobs:
+            self.remaining_jobs.update(get_job_archives(job))
+        with _archive_indices_lock:
+            unused = [path for path in _archive_indices if path not in self.remaining_jobs]
+        for path in unused:
+            release_archive_index(path)
+
+    # Helper function which records that a job is done, releasing the archives no other job reads from
+    def job_done(self, job):
+        for path in get_job_archives(job):
+            self.remaining_jobs[path] -= 1
+            if self.remaining_jobs[path] == 0:
+                release_archive_index(path)
+
+
+# Helper function which splits the path of an input file inside an archive (the path of the archive followed by the
+# name of the member, as if the archive were a directory) into the path of the archive and the member name. (None,
+# None) is returned for paths which aren't inside an archive.
+def split_archive_path(path):
+    match = re_archive_path.match(path)
+    if match is None or not os.path.isfile(match.group(1)):
+        return None, None
+    return match.group(1), match.group(2).replace('\\', '/')
+
+
+# Helper function which opens an input file (which may be inside an archive, see split_archive_path) as a read-only
+# binary stream, without decompressing it
+def open_input_stream(path):
+    archive_path, member = split_archive_path(path)
+    if archive_path is not None:
+        return get_archive_index(archive_path).open(member)
+    return open(path, 'rb')
+
+
+# Helper function which gets the size and modification time of an input file, from the index of its archive if it is
+# inside one (see split_archive_path)
+def get_input_file_stat(path):
+    archive_path, member = split_archive_path(path)
+    if archive_path is not None:
+        return get_archive_index(archive_path).members[member]
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+# Helper function which adds the input files in the archive at root/parts (read as if it were a directory) to files,
+# applying the include and exclude globs as _discover_directory does. The number of other files skipped is returned.
+def _discover_archive(root, parts, include, exclude, files):
+    skipped = 0
+    archive_path = os.path.join(root, *parts)
+    try:
+        members = get_archive_index(archive_path).members
+    except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError) as e:
+        logging.warning("The archive %s could not be read (%s). Skipping..." % (archive_path, e))
+        return 1
+    for name in members:
+        member_parts = parts + name.split('/')
+        # The member and the directories it is in (inside the archive) are checked against the exclude globs
+        if exclude and any(_glob_match_any(member_parts[0:i], exclude)
+                           for i in range(len(parts) + 1, len(member_parts) + 1)):
+            continue
+        if is_input_file_name(name) and (not include or _glob_match_any(member_parts, include)):
+            files.append(archive_path + os.sep + name)
+        else:
+            skipped += 1
+    return skipped
+
+
+# Helper function which walks the directory at root (with parts as its path relative to the discovery root), adding
+# the input files found to files. Directories and files matching an exclude glob are skipped, as are directories in
+# which no include glob can match. Zip and tar archives are walked as if they were directories. The number of other
+# files skipped is returned.
+def _discover_directory(root, parts, include, exclude, files):
+    skipped = 0
+    for name, is_dir in _list_directory(os.path.join(root, *parts)):
+        entry_parts = parts + [name]
+        if exclude and _glob_match_any(entry_parts, exclude):
+            continue
+        if is_dir:
+            if not include or _glob_match_any(entry_parts, include, partial=True):
+                skipped += _discover_directory(root, entry_parts, include, exclude, files)
+        elif re_archive_name.match(name):
+            if not include or _glob_match_any(entry_parts, include, partial=True):
+                skipped += _discover_archive(root, entry_parts, include, exclude, files)
+        elif is_input_file_name(name) and (not include or _glob_match_any(entry_parts, include)):
+            files.append(os.path.join(root, *entry_parts))
+        else:
+            skipped += 1
+    return skipped
+
+
+# Helper function which finds the input files (see is_input_file_name) under the directory at root. include and
+# exclude are lists of glob patterns matched against paths relative to root with '/' separators (or just the name,
+# for patterns without a '/'); only files matching an include pattern (if any are given) and no exclude pattern are
+# found, and directories which can't contain such files are never listed. If threads is more than 1, the top level
+# directories (one per subject) are walked in parallel threads, which helps on file systems with slow directory
+# listings. The files are returned in the same (sorted) order either way. Zip and tar archives (including root itself)
+# are read as if they were directories, and the paths of the files in them are the path of the archive followed by
+# the name of the member (see split_archive_path).
+def discover_files(root, include=None, exclude=None, threads=1):
+    global _scandir_warning_logged
+    if scandir is None and not _scandir_warning_logged:
+        logging.warning("The scandir package is not installed, so directories are listed with the slower os.listdir. " +
+                        "Install it with pip install scandir for faster discovery.")
+        _scandir_warning_logged = True
+
+    if os.path.isfile(root) and re_archive_name.match(root):
+        files = []
+        _discover_archive(os.path.dirname(root), [os.path.basename(root)], include, exclude, files)
+        return files
+
+    files = []
+    top_level_directories = []
+    skipped = 0
+    for name, is_dir in _list_directory(root):
+        if exclude and _glob_match_any([name], exclude):
+            continue
+        if is_dir or re_archive_name.match(name):
+            if not include or _glob_match_any([name], include, partial=True):
+                top_level_directories.append(name)
+        elif is_input_file_name(name) and (not include or _glob_match_any([name], include)):
+            files.append(os.path.join(root, name))
+        else:
+            skipped += 1
+
+    def discover_top_level_directory(name):
+        directory_files = []
+        if os.path.isdir(os.path.join(root, name)):
+            directory_skipped = _discover_directory(root, [name], include, exclude, directory_files)
+        else:
+            directory_skipped = _discover_archive(root, [name], include, exclude, directory_files)
+        return directory_files, directory_skipped
+
+    if threads > 1 and len(top_level_directories) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(threads, len(top_level_directories)))
+        try:
+            results = pool.map(discover_top_level_directory, top_level_directories)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [discover_top_level_directory(name) for name in top_level_directories]
+    for directory_files, directory_skipped in results:
+        files.extend(directory_files)
+        skipped += directory_skipped
+
+    logging.debug("Discovery skipped %d files which aren't input files." % skipped)
+    return files
+
+
+# The output files which can be generated, keyed by name (the command line option is full_<name>), in the order they
+# are created. Each entry is the filename and the header row of the file.
+path_output_header = ["subject_id", "trial_number", "time", "x", "y", "z", "room_by_order", "room_by_color",
+                      "items_clicked", "distance_from_last_point", "time_since_last_point"]
+look_output_header = ["subject_id", "trial_number", "time", "x", "y", "z", "w", "euler_x", "euler_y", "euler_z",
+                      "room_by_order", "room_by_color", "items_clicked", "distance_from_last_point",
+                      "time_since_last_point", "heading", "angular_speed"]
+output_files = collections.OrderedDict([
+    ('study_path', ('study_path.csv', path_output_header)),
+    ('study_look', ('study_look.csv', look_output_header)),
+    ('test_path', ('test_path.csv', path_output_header)),
+    ('test_look', ('test_look.csv', look_output_header)),
+    ('practice_path', ('practice_path.csv', path_output_header)),
+    ('practice_look', ('practice_look.csv', look_output_header)),
+    ('test_2d', ('2d_test.csv', ["subject_id", "trial_number", "item_id", "x_placed", "y_placed", "x_expected",
+                                 "y_expected", "order_clicked_study", "expected_room_by_order",
+                                 "expected_room_by_color", "actual_room_by_order", "actual_room_by_color"])),
+    ('test_vr', ('vr_test.csv', ["subject_id", "trial_number", "item_id", "x_placed", "y_placed", "x_expected",
+                                 "y_expected", "order_clicked_study", "expected_room_by_order",
+                                 "expected_room_by_color", "actual_room_by_order", "actual_room_by_color",
+                                 "number_of_replacements", "time_placed"])),
+    ('test_vr_events', ('vr_test_events.csv', ["subject_id", "trial_number", "item_id", "event_number", "event_type",
+                                               "time", "x", "y", "actual_room_by_order", "actual_room_by_color"])),
+    ('trial_summary', ('trial_summary.csv', ["subject_id", "trial_number", "phase", "samples", "duration",
+                                             "path_length", "room_transitions", "items_clicked"] +
+                       ["time_in_" + label for label in context_labels])),
+    ('room_visits', ('room_visits.csv', ["subject_id", "trial_number", "phase", "room_by_order", "room_by_color",
+                                         "items_clicked", "start_time", "end_time", "duration", "samples",
+                                         "path_length"]))])
+
+
+# The lzma module (built into Python 3.3+ and available as the backports.lzma package for Python 2) is needed for xz
+# compression. Without it, xz files can't be read or written.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# The level used to compress gzip output files (zlib's default, a good tradeoff of speed and size)
+gzip_compress_level = 6
+
+# The supported compression formats: name -> (file extension, compressor factory, decompressor factory). The gzip
+# compressors read and write the gzip container (zlib window bits + 16).
+compression_formats = collections.OrderedDict([
+    ('gzip', ('.gz', lambda: zlib.compressobj(gzip_compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+              lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))),
+    ('bz2', ('.bz2', bz2.BZ2Compressor, bz2.BZ2Decompressor))])
+if lzma is not None:
+    compression_formats['xz'] = ('.xz', lzma.LZMACompressor, lzma.LZMADecompressor)
+
+# The compression formats of input files by file extension (xz files are recognized even without the lzma module, so
+# they fail to parse with an explanation instead of being read as plain text)
+input_compression_extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+# The errors raised while decompressing a corrupt or truncated compressed file
+decompression_errors = (zlib.error, IOError, EOFError)
+if lzma is not None:
+    decompression_errors += (lzma.LZMAError,)
+
+
+# This object is a write-only file which compresses what is written to it as a single stream (see
+# compression_formats). Writes are gathered into blocks of output_buffer_size bytes before they are compressed, as the
+# csv writer writes one row at a time. Opening an existing file with mode 'ab' appends a new stream, which readers of
+# all the formats treat as a continuation of the file.
+class CompressedOutputFile:
+    def __init__(self, path, compression, mode='wb'):
+        self.file_pointer = open(path, mode)
+        self.compressor = compression_formats[compression][1]()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= output_buffer_size:
+            self._compress_buffer()
+
+    # Helper function which compresses the buffered writes into the file
+    def _compress_buffer(self):
+        if self.buffer:
+            self.file_pointer.write(self.compressor.compress(''.join(self.buffer)))
+            self.buffer = []
+            self.buffered = 0
+
+    # Helper function which compresses the buffered writes (the end of the stream is only written by close)
+    def flush(self):
+        self._compress_buffer()
+        self.file_pointer.flush()
+
+    def close(self):
+        if self.file_pointer.closed:
+            return
+        self._compress_buffer()
+        self.file_pointer.write(self.compressor.flush())
+        self.file_pointer.close()
+
+
+# Helper function which will make a csv writer reference to be passed around for file writing. If append is True and
+# the file already exists, rows are added to the end of it instead (and the header is not written again). If
+# output_format is 'npy', a ColumnarWriter is made instead (it is both the writer and the file pointer). If compression
+# is given (see compression_formats), the csv file is compressed and its extension is added to the filename. If
+# partition_by is given, a PartitionedWriter is made instead, which writes csv shards of at most partition_rows rows.
+def make_output_file(directory, filename, header, append=False, output_format='csv', compression=None,
+                     partition_by=None, partition_rows=None):
+    if output_format == 'npy':
+        writer = ColumnarWriter(directory, os.path.splitext(filename)[0], header)
+        return writer, writer
+    if partition_by is not None:
+        writer = PartitionedWriter(directory, os.path.splitext(filename)[0], header, partition_by,
+                                   partition_rows or default_partition_rows, compression)
+        return writer, writer
+    path = os.path.join(directory, filename)
+    if compression is not None:
+        path += compression_formats[compression][0]
+    exists = append and os.path.exists(path)
+    if compression is not None:
+        output = CompressedOutputFile(path, compression, 'ab' if exists else 'wb')
+    else:
+        output = open(path, 'ab' if exists else 'wb', output_buffer_size)
     writer = csv.writer(output)
-    writer.writerow(header)
+    if not exists:
+        writer.writerow(header)
     return writer, output
 
 
-# Enum representing the four possible file types
+# The size of the write buffer of each output file
+output_buffer_size = 1024 * 1024
+
+
+# This object writes the rows of one output table from a background thread, so the parsing thread never waits on a
+# flush of the file. Batches of rows are handed over through a queue of at most max_queued_batches batches (the rows
+# must not be changed after they are queued); when the queue is full, writerows blocks until the writer catches up, and
+# the number of times that happened is logged with the rows queued and written when the writer is closed. Errors raised
+# while writing are raised again by the next call to writerows, flush, or close.
+class AsyncTableWriter:
+    def __init__(self, name, writer, file_pointer, max_queued_batches=16):
+        self.name = name
+        self.writer = writer
+        self.file_pointer = file_pointer
+        self.queue = Queue.Queue(max(max_queued_batches, 1))
+        self.rows_queued = 0
+        self.rows_written = 0
+        self.full_queue_waits = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._write_batches, name='writer-' + name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Helper function run by the background thread which writes batches until it is handed None
+    def _write_batches(self):
+        while True:
+            rows = self.queue.get()
+            try:
+                if rows is None:
+                    return
+                # After an error, the remaining batches are dropped
+                if self.error is None:
+                    self.writer.writerows(rows)
+                    self.rows_written += len(rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    # Helper function which raises an error from the background thread (once)
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # Helper function which queues a batch of rows to be written
+    def writerows(self, rows):
+        self._raise_error()
+        if self.closed:
+            raise ValueError("The %s writer is closed." % self.name)
+        self.rows_queued += len(rows)
+        try:
+            self.queue.put_nowait(rows)
+        except Queue.Full:
+            self.full_queue_waits += 1
+            self.queue.put(rows)
+
+    # Helper function which queues a single row to be written
+    def writerow(self, row):
+        self.writerows([row])
+
+    # Helper function which waits until every queued row has been written and flushes the file
+    def flush(self):
+        self.queue.join()
+        self._raise_error()
+        if hasattr(self.file_pointer, 'flush'):
+            self.file_pointer.flush()
+
+    # Helper function which writes the remaining queued rows, stops the background thread, and closes the file
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.file_pointer.close()
+        self.log_statistics()
+        self._raise_error()
+
+    # Helper function to log the queued/written row counters and how often writerows had to wait for the writer
+    def log_statistics(self):
+        logging.info("Writer %s: %d rows queued, %d rows written, waited on a full queue %d times."
+                     % (self.name, self.rows_queued, self.rows_written, self.full_queue_waits))
+
+
+# Helper function which makes an output file (see make_output_file) and an AsyncTableWriter to write it. Closing the
+# AsyncTableWriter closes the file.
+def make_async_output_file(name, directory, filename, header, append=False, output_format='csv', max_queued_batches=16,
+                           compression=None, partition_by=None, partition_rows=None):
+    writer, file_pointer = make_output_file(directory, filename, header, append, output_format, compression,
+                                            partition_by, partition_rows)
+    return AsyncTableWriter(name, writer, file_pointer, max_queued_batches)
+
+
+# The type of each output column in the columnar (npy) format. 'category' columns are dictionary encoded as integer
+# codes. Integer columns which can be empty (None) store -1 instead.
+output_column_types = {
+    'subject_id': 'category', 'trial_number': 'int64', 'time': 'int64', 'x': 'float64', 'y': 'float64',
+    'z': 'float64', 'w': 'float64', 'euler_x': 'float64', 'euler_y': 'float64', 'euler_z': 'float64',
+    'room_by_order': 'int64', 'room_by_color': 'category', 'items_clicked': 'int64',
+    'distance_from_last_point': 'float64', 'time_since_last_point': 'int64', 'item_id': 'category',
+    'x_placed': 'float64', 'y_placed': 'float64', 'x_expected': 'float64', 'y_expected': 'float64',
+    'order_clicked_study': 'int64', 'expected_room_by_order': 'int64', 'expected_room_by_color': 'category',
+    'actual_room_by_order': 'int64', 'actual_room_by_color': 'category', 'number_of_replacements': 'float64',
+    'time_placed': 'int64', 'event_number': 'int64', 'event_type': 'category', 'phase': 'category',
+    'samples': 'int64', 'duration': 'int64', 'path_length': 'float64', 'room_transitions': 'int64',
+    'start_time': 'int64', 'end_time': 'int64', 'heading': 'float64', 'angular_speed': 'float64'}
+output_column_types.update(('time_in_' + label, 'int64') for label in context_labels)
+
+# The size of the header reserved at the start of every npy column file (a multiple of 64 so the data stays aligned)
+npy_header_size = 128
+
+
+# Helper function which writes a version 1.0 npy header of exactly npy_header_size bytes describing a 1-d array
+def _write_npy_header(fp, dtype, length):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (numpy.lib.format.dtype_to_descr(dtype),
+                                                                         length)
+    preamble = numpy.lib.format.MAGIC_PREFIX + b'\x01\x00' + struct.pack('<H', npy_header_size - 10)
+    fp.write(preamble + header.ljust(npy_header_size - len(preamble) - 1).encode('latin1') + b'\n')
+
+
+# This object is a batch of output rows stored as one array per column (a struct of arrays) keyed by the header names,
+# which takes a fraction of the memory of a list of boxed values per row. Numeric columns are NumPy arrays of the
+# column's type (see output_column_types) which grow geometrically as rows are appended, and category columns (such as
+# subject_id and room_by_color) are stored as int32 codes into a list of interned strings. Iterating a batch yields its
+# rows as lists (the same rows the parsers produce one at a time), so a batch can be handed to any writer. Columns
+# can't hold empty (None) values.
+class ColumnBatch:
+    def __init__(self, header, capacity=1024):
+        self.header = list(header)
+        self.types = [output_column_types.get(name, 'float64') for name in self.header]
+        self.dtypes = [numpy.dtype('int32') if column_type == 'category' else numpy.dtype(column_type)
+                       for column_type in self.types]
+        self.arrays = [numpy.empty(max(capacity, 1), dtype) for dtype in self.dtypes]
+        self.dictionaries = [[] for _ in self.header]
+        self.codes = [dict() for _ in self.header]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    # Helper function which makes room for count more rows, doubling the capacity of the arrays as needed
+    def _reserve(self, count):
+        capacity = len(self.arrays[0])
+        if self.length + count <= capacity:
+            return
+        while capacity < self.length + count:
+            capacity *= 2
+        for i, array in enumerate(self.arrays):
+            grown = numpy.empty(capacity, array.dtype)
+            grown[0:self.length] = array[0:self.length]
+            self.arrays[i] = grown
+
+    # Helper function which gets the code of a category value, interning it if it is new
+    def _code(self, i, value):
+        code = self.codes[i].get(value)
+        if code is None:
+            code = self.codes[i][value] = len(self.dictionaries[i])
+            self.dictionaries[i].append(value)
+        return code
+
+    # Helper function which encodes the values of a category column (a single value for every row or an array of
+    # values) as codes
+    def _encode(self, i, values):
+        if isinstance(values, basestring):
+            return self._code(i, values)
+        unique_values, inverse = numpy.unique(numpy.asarray(values, dtype=object), return_inverse=True)
+        return numpy.array([self._code(i, value) for value in unique_values], dtype=numpy.int32)[inverse]
+
+    # Helper function which appends count rows given as a dict of column name -> array of count values (or a single
+    # value for every row)
+    def append_columns(self, count, columns):
+        self._reserve(count)
+        for i, name in enumerate(self.header):
+            values = columns[name]
+            if self.types[i] == 'category':
+                values = self._encode(i, values)
+            self.arrays[i][self.length:self.length + count] = values
+        self.length += count
+
+    # Helper function which appends the rows of another batch with the same header
+    def extend(self, other):
+        self._reserve(len(other))
+        for i in range(0, len(self.header)):
+            values = other.arrays[i][0:len(other)]
+            if self.types[i] == 'category':
+                translation = numpy.array([self._code(i, value) for value in other.dictionaries[i]] or [0],
+                                          dtype=numpy.int32)
+                values = translation[values]
+            self.arrays[i][self.length:self.length + len(other)] = values
+        self.length += len(other)
+
+    # Helper function which gets the values of a column as an array (the codes, for category columns)
+    def column(self, name):
+        return self.arrays[self.header.index(name)][0:self.length]
+
+    # Helper function which gets the values of a column as a list of Python values
+    def get_values(self, name):
+        i = self.header.index(name)
+        if self.types[i] == 'category':
+            return [self.dictionaries[i][code] for code in self.arrays[i][0:self.length].tolist()]
+        return self.arrays[i][0:self.length].tolist()
+
+    def __iter__(self):
+        for row in itertools.izip(*[self.get_values(name) for name in self.header]):
+            yield list(row)
+
+    # Only the used part of the arrays is pickled (batches are sent between processes)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = [array[0:self.length].copy() for array in self.arrays]
+        return state
+
+
+# This object is a drop in replacement for a csv writer which stores a table in a columnar binary format: a directory
+# with one npy file per column and a schema.json describing the columns. Rows are appended to the column files as they
+# are written, so the table is never held in memory, and the column files can be loaded with
+# numpy.load(path, mmap_mode='r') without copying (see load_columnar_output).
+class ColumnarWriter:
+    def __init__(self, directory, table, header):
+        self.directory = os.path.join(directory, table)
+        self.table = table
+        self.header = list(header)
+        self.types = [output_column_types.get(name, 'float64') for name in self.header]
+        self.dtypes = [numpy.dtype('int32') if column_type == 'category' else numpy.dtype(column_type)
+                       for column_type in self.types]
+        self.dictionaries = [collections.OrderedDict() for _ in self.header]
+        self.rows = 0
+        if not os.path.isdir(self.directory):
+            os.mkdir(self.directory)
+        self.files = []
+        for name, dtype in zip(self.header, self.dtypes):
+            fp = open(os.path.join(self.directory, name + '.npy'), 'wb')
+            _write_npy_header(fp, dtype, 0)
+            self.files.append(fp)
+
+    # Helper function which converts the values of a column to an array of its type
+    def _encode(self, i, values):
+        if self.types[i] == 'category':
+            dictionary = self.dictionaries[i]
+            codes = []
+            for value in values:
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                codes.append(code)
+            return numpy.array(codes, dtype=self.dtypes[i])
+        if self.dtypes[i].kind == 'i':
+            return numpy.array([-1 if value is None else value for value in values], dtype=self.dtypes[i])
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype=self.dtypes[i])
+
+    def writerows(self, rows):
+        if not rows:
+            return
+        if isinstance(rows, ColumnBatch):
+            # The columns of a batch are written as they are (category codes are translated to this table's codes)
+            for i, name in enumerate(self.header):
+                values = rows.column(name)
+                if self.types[i] == 'category':
+                    values = self._encode(i, rows.dictionaries[rows.header.index(name)])[values]
+                values.astype(self.dtypes[i]).tofile(self.files[i])
+        else:
+            for i, values in enumerate(zip(*rows)):
+                self._encode(i, values).tofile(self.files[i])
+        self.rows += len(rows)
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    # Helper function which finalizes the column headers with the number of rows and writes the schema
+    def close(self):
+        if not self.files:
+            return
+        for fp, dtype in zip(self.files, self.dtypes):
+            fp.seek(0)
+            _write_npy_header(fp, dtype, self.rows)
+            fp.close()
+        self.files = []
+        columns = []
+        for name, column_type, dtype, dictionary in zip(self.header, self.types, self.dtypes, self.dictionaries):
+            column = {'name': name, 'file': name + '.npy', 'dtype': numpy.lib.format.dtype_to_descr(dtype)}
+            if column_type == 'category':
+                column['dictionary'] = list(dictionary)
+            elif dtype.kind == 'i':
+                column['null'] = -1
+            columns.append(column)
+        with open(os.path.join(self.directory, 'schema.json'), 'wb') as fp:
+            json.dump({'table': self.table, 'rows': self.rows, 'columns': columns}, fp, indent=1)
+
+
+# The maximum number of rows in a shard written by a PartitionedWriter
+default_partition_rows = 1000000
+
+# The columns of the partitions a PartitionedWriter can split a table by
+partition_columns = collections.OrderedDict([('subject', ['subject_id']), ('trial', ['subject_id', 'trial_number'])])
+
+# The name given to each partition column in the directory names of the shards
+partition_directory_names = {'subject_id': 'subject', 'trial_number': 'trial'}
+
+# The (start, end) columns which give the time range of the rows of a table, in order of preference
+time_range_columns = [('time', 'time'), ('start_time', 'end_time'), ('time_placed', 'time_placed')]
+
+# The name of the index of the shards of a partitioned output directory (see write_shard_index)
+shard_index_filename = 'shards.json'
+
+
+# This object is a drop in replacement for a csv writer which splits a table into csv shards by subject (or by subject
+# and trial). The shards of a partition are written to <table>/subject=<subject_id>[/trial=<trial_number>]/part-N.csv
+# (each with the header row), and a new shard is started whenever a shard reaches max_rows rows. Only the current
+# shard is open, so a partition whose rows are not contiguous gets a new shard each time its rows come back. A record
+# of every shard (its path relative to directory, partition values, row count and time range) is kept in shards.
+class PartitionedWriter:
+    def __init__(self, directory, table, header, partition_by='subject', max_rows=default_partition_rows,
+                 compression=None):
+        self.directory = directory
+        self.table = table
+        self.header = list(header)
+        self.partition_by = partition_by
+        self.max_rows = max(max_rows, 1)
+        self.compression = compression
+        self.key_indices = [self.header.index(name) for name in partition_columns[partition_by]]
+        self.time_indices = None
+        for start, end in time_range_columns:
+            if start in self.header and end in self.header:
+                self.time_indices = (self.header.index(start), self.header.index(end))
+                break
+        self.shards = []
+        self.part_numbers = dict()  # partition key -> number of the next shard of the partition
+        self.key = None
+        self.shard = None
+        self.writer = None
+        self.file_pointer = None
+        self.rows = 0
+
+    # Helper function which closes the current shard, if there is one
+    def _close_shard(self):
+        if self.file_pointer is not None:
+            self.file_pointer.close()
+        self.writer = None
+        self.file_pointer = None
+        self.shard = None
+
+    # Helper function which starts the next shard of a partition
+    def _open_shard(self, key):
+        self._close_shard()
+        part_number = self.part_numbers.get(key, 0)
+        self.part_numbers[key] = part_number + 1
+        names = [partition_directory_names[name] for name in partition_columns[self.partition_by]]
+        relative_directory = os.path.join(self.table, *['%s=%s' % (name, value) for name, value in zip(names, key)])
+        if not os.path.isdir(os.path.join(self.directory, relative_directory)):
+            os.makedirs(os.path.join(self.directory, relative_directory))
+        self.writer, self.file_pointer = make_output_file(os.path.join(self.directory, relative_directory),
+                                                          'part-%05d.csv' % part_number, self.header,
+                                                          compression=self.compression)
+        path = os.path.join(relative_directory, 'part-%05d.csv' % part_number)
+        if self.compression is not None:
+            path += compression_formats[self.compression][0]
+        self.shard = collections.OrderedDict([('path', path.replace(os.sep, '/'))])
+        self.shard.update(zip(partition_columns[self.partition_by], key))
+        self.shard.update([('rows', 0), ('min_time', None), ('max_time', None)])
+        self.shards.append(self.shard)
+        self.key = key
+
+    # Helper function which writes rows (all of the same partition) to the current shard, starting new shards as needed
+    def _write_partition(self, key, rows):
+        start = 0
+        while start < len(rows):
+            if self.shard is None or key != self.key or self.shard['rows'] >= self.max_rows:
+                self._open_shard(key)
+            shard_rows = rows[start:start + self.max_rows - self.shard['rows']]
+            self.writer.writerows(shard_rows)
+            self.shard['rows'] += len(shard_rows)
+            if self.time_indices is not None:
+                times = [row[i] for row in shard_rows for i in self.time_indices if row[i] is not None]
+                if times and (self.shard['min_time'] is None or min(times) < self.shard['min_time']):
+                    self.shard['min_time'] = min(times)
+                if times and (self.shard['max_time'] is None or max(times) > self.shard['max_time']):
+                    self.shard['max_time'] = max(times)
+            start += len(shard_rows)
+
+    def writerows(self, rows):
+        for key, partition_rows in itertools.groupby(rows, lambda row: tuple(row[i] for i in self.key_indices)):
+            self._write_partition(key, list(partition_rows))
+        self.rows += len(rows)
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def close(self):
+        self._close_shard()
+
+
+# Helper function which writes the index of the shards of the partitioned tables (a dictionary of output name ->
+# PartitionedWriter) in directory, which lists each table's shards with their row counts and time ranges
+def write_shard_index(directory, tables):
+    index = collections.OrderedDict()
+    for name, writer in tables.items():
+        index[name] = collections.OrderedDict([('table', writer.table), ('partition_by', writer.partition_by),
+                                               ('max_rows', writer.max_rows), ('rows', writer.rows),
+                                               ('header', writer.header), ('shards', writer.shards)])
+    with open(os.path.join(directory, shard_index_filename), 'wb') as fp:
+        json.dump(index, fp, indent=1)
+
+
+# Helper function which returns the paths of the shards of an output (by name, see output_files) in a partitioned
+# output directory, optionally only those of a subject (and trial)
+def find_shards(directory, name, subject_id=None, trial_number=None):
+    with open(os.path.join(directory, shard_index_filename), 'rb') as fp:
+        index = json.load(fp)
+    return [os.path.join(directory, *shard['path'].split('/')) for shard in index[name]['shards']
+            if (subject_id is None or shard['subject_id'] == subject_id) and
+            (trial_number is None or shard.get('trial_number') == trial_number)]
+
+
+# Helper function which loads a table written by a ColumnarWriter. It returns the schema and a dictionary of column
+# name -> array (memory mapped unless mmap_mode is None); category columns are returned as their integer codes, which
+# index into the column's 'dictionary' in the schema.
+def load_columnar_output(directory, table, mmap_mode='r'):
+    with open(os.path.join(directory, table, 'schema.json'), 'rb') as fp:
+        schema = json.load(fp)
+    columns = collections.OrderedDict()
+    for column in schema['columns']:
+        columns[column['name']] = numpy.load(os.path.join(directory, table, column['file']), mmap_mode=mmap_mode)
+    return schema, columns
+
+
+# Helper function which returns the header row of a csv output file (None if the file is empty)
+def read_output_header(directory, filename):
+    with open(os.path.join(directory, filename), 'rb') as fp:
+        return next(csv.reader(fp), None)
+
+
+# Helper function which removes the rows of the given trials (a set of (subject_id, trial_number) string tuples) from a
+# csv output file, keeping the header and all other rows as they were
+def remove_trial_rows(directory, filename, trial_keys):
+    path = os.path.join(directory, filename)
+    temporary_path = path + '.tmp'
+    removed = 0
+    with open(path, 'rb') as source, open(temporary_path, 'wb') as destination:
+        writer = csv.writer(destination)
+        for i, row in enumerate(csv.reader(source)):
+            if i > 0 and (row[0], row[1]) in trial_keys:
+                removed += 1
+            else:
+                writer.writerow(row)
+    # Windows will not rename over an existing file
+    os.remove(path)
+    os.rename(temporary_path, path)
+    return removed
+
+
+# Helper function which computes the sha1 hex digest of the contents of a file
+def get_file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with contextlib.closing(open_input_stream(path)) as fp:
+        block = fp.read(block_size)
+        while block:
+            digest.update(block)
+            block = fp.read(block_size)
+    return digest.hexdigest()
+
+
+# This object records, for an output directory, the input files (path, size, modification time and content hash) which
+# produced the rows of each subject/trial, along with the outputs which were generated. It is used to update the output
+# directory incrementally by parsing only the trials whose files are new or have changed.
+class OutputManifest:
+    filename = 'manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.outputs = []  # names (from output_files) of the outputs in the directory
+        self.trials = dict()  # (subject_id, trial_number) -> list of file records (path, size, mtime, sha1)
+        self.settings = {'resample_hz': None, 'resample_quaternions': 'slerp',  # the options the rows depend on
+                         'layout': None}
+        path = os.path.join(directory, self.filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                data = json.load(fp)
+            self.outputs = data['outputs']
+            self.settings.update(data.get('settings', dict()))
+            for trial in data['trials']:
+                self.trials[(trial['subject_id'], trial['trial_number'])] = trial['files']
+
+    # Helper function which returns the record for a file, only hashing its contents if its size or modification time
+    # differ from the previous record
+    @staticmethod
+    def get_file_record(path, previous_record=None):
+        size, mtime = get_input_file_stat(path)
+        if previous_record and previous_record['path'] == path and previous_record['size'] == size and \
+                previous_record['mtime'] == mtime:
+            return previous_record
+        return {'path': path, 'size': size, 'mtime': mtime, 'sha1': get_file_hash(path)}
+
+    # Helper function which compares the cataloged individuals with the manifest and records their current files. It
+    # returns a dictionary of (subject_id, trial_number) -> names of the outputs which must be parsed for that trial,
+    # and the set of (subject_id, trial_number) string tuples whose rows must be removed from the existing outputs.
+    def update(self, individuals, output_names):
+        new_outputs = [name for name in output_names if name not in self.outputs]
+        existing_outputs = [name for name in output_names if name in self.outputs]
+        outputs_to_parse = dict()
+        replaced_trials = set()
+        trials = dict()
+        for individual in individuals:
+            for trial in individual.trials:
+                key = (individual.subject_id, trial.num)
+                previous_records = dict((record['path'], record) for record in self.trials.get(key, []))
+                records = [self.get_file_record(path, previous_records.get(path))
+                           for path in sorted(set(trial.get_full_file_list()))]
+                trials[key] = records
+                # The trial is unchanged if it has the same files with the same contents
+                changed = [(r['path'], r['sha1']) for r in records] != \
+                          sorted((r['path'], r['sha1']) for r in previous_records.values())
+                if changed and key in self.trials:
+                    replaced_trials.add((key[0], str(key[1])))
+                outputs_to_parse[key] = new_outputs + (existing_outputs if changed else [])
+        # Trials which are no longer in the catalog have their rows removed
+        for key in self.trials:
+            if key not in trials:
+                replaced_trials.add((key[0], str(key[1])))
+        self.trials = trials
+        self.outputs = list(output_names)
+        return outputs_to_parse, replaced_trials
+
+    # Helper function which writes the manifest to the output directory
+    def save(self):
+        path = os.path.join(self.directory, self.filename)
+        with open(path + '.tmp', 'wb') as fp:
+            json.dump({'outputs': self.outputs, 'settings': self.settings,
+                       'trials': [{'subject_id': key[0], 'trial_number': key[1], 'files': self.trials[key]}
+                                  for key in sorted(self.trials)]}, fp, indent=1, sort_keys=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+
+# Enum representing the possible file types (a vr test file can also be parsed into its full event timeline, and the
+# path of a raw Unity file can also be summarized into the trial summary and room visit aggregates)
 class FileType(Enum):
     path_file = 1
     look_file = 2
     test_file_2d = 3
     test_file_vr = 4
+    test_file_vr_events = 5
+    trial_summary = 6
+    room_visits = 7
 
 
-# Helper function which can be used externally to parse any given file type into the appropriate output format
-# then write those rows to the appropriate output file
-def parse_file_and_write(path, subject_id, trial_num, file_type, output_file_writer, summary_file_path):
+# The number of rows which are buffered for each output before they are written
+write_batch_size = 10000
+
+
+# Helper function which parses a file as one or more file types and yields (index, rows) tuples, where rows is a batch
+# of about batch_size rows belonging to file_types[index] (a list of rows, or a ColumnBatch for the path and look
+# outputs; either can be given to writerows). A raw Unity file requested as both a path_file and a
+# look_file is only read once, and its rows are streamed so memory use does not depend on the length of the file. If
+# the file does not parse, the failure is logged and no further rows are produced. If the contents of the file have
+# already been read (see FilePrefetcher), they can be given as data. The phase (study, test or practice) of a raw Unity
+# file is written to its trial summary and room visit rows.
+def parse_file(path, subject_id, trial_num, file_types, summary_file_path, batch_size=None, data=None, phase=None):
     # Check for empty path
     if not path:
-        return []
+        return
+    if batch_size is None:
+        batch_size = write_batch_size
 
     try:
-        rows = []
-        if file_type == FileType.path_file:
-            rows = parse_path_file(path, subject_id, trial_num, summary_file_path)
-        elif file_type == FileType.look_file:
-            rows = parse_look_file(path, subject_id, trial_num, summary_file_path)
-        elif file_type == FileType.test_file_2d:
-            rows = parse_test_2d_file(path, subject_id, trial_num, summary_file_path)
-        elif file_type == FileType.test_file_vr:
-            rows = parse_test_vr_file(path, subject_id, trial_num, summary_file_path)
-        else:
-            logging.error("Error: The parse_file function 'type' parameter was not a recognized type.")
-        if rows:
-            output_file_writer.writerows(rows)
+        # Each file type is mapped to the index of its output and fed into a stream of (file_type, rows) tuples
+        indices = dict((file_type, i) for i, file_type in enumerate(file_types))
+        streams = []
+        raw_file_types = [FileType.path_file, FileType.look_file, FileType.trial_summary, FileType.room_visits]
+        if any(file_type in indices for file_type in raw_file_types):
+            aggregate = FileType.trial_summary in indices or FileType.room_visits in indices
+            streams.append(parse_raw_file_columns(path, subject_id, trial_num, summary_file_path,
+                                                  parse_path=FileType.path_file in indices,
+                                                  parse_look=FileType.look_file in indices, data=data,
+                                                  resample_hz=resample_hz, resample_quaternions=resample_quaternions,
+                                                  aggregate=aggregate, phase=phase))
+        if FileType.test_file_2d in indices:
+            streams.append([(FileType.test_file_2d,
+                             list(parse_test_2d_file(path, subject_id, trial_num, summary_file_path, data)))])
+        if FileType.test_file_vr in indices or FileType.test_file_vr_events in indices:
+            streams.append((file_type, [row]) for file_type, row in
+                           parse_test_vr_events(path, subject_id, trial_num, summary_file_path,
+                                                parse_results=FileType.test_file_vr in indices,
+                                                parse_events=FileType.test_file_vr_events in indices, data=data))
+        for file_type in file_types:
+            if file_type not in FileType:
+                logging.error("Error: The parse_file function 'type' parameter was not a recognized type.")
+
+        # Batch up the chunks of rows for each output (lists of rows, or ColumnBatches for the raw Unity outputs) and
+        # yield each batch when it is full (a raw Unity file produces both aggregates, even if only one is requested)
+        batches = [None for _ in file_types]
+        for file_type, chunk in itertools.chain(*streams):
+            if file_type not in indices:
+                continue
+            index = indices[file_type]
+            if batches[index] is None:
+                batches[index] = chunk
+            else:
+                batches[index].extend(chunk)
+            if len(batches[index]) >= batch_size:
+                yield index, batches[index]
+                batches[index] = None
+        for index, batch in enumerate(batches):
+            if batch:
+                yield index, batch
     except LogParseError as e:
         logging.warning("Subject %s, Trial %d, (%s) did not parse successfully (Exception: %s). Skipping..."
                         % (subject_id, trial_num, path, e.message))
 
 
+# Helper function which can be used externally to parse any given file type into the appropriate output format
+# then write those rows to the appropriate output file
+def parse_file_and_write(path, subject_id, trial_num, file_type, output_file_writer, summary_file_path):
+    for index, rows in parse_file(path, subject_id, trial_num, (file_type,), summary_file_path):
+        output_file_writer.writerows(rows)
+
+
+# Helper function which parses a raw Unity file as both a path file and a look file and writes the rows to the
+# appropriate output files. If path_file and look_file are the same file (as they are in trials produced by
+# catalog_files), the file is only read and parsed once. Either writer may be None to skip that output.
+def parse_raw_file_and_write(path_file, look_file, subject_id, trial_num, path_file_writer, look_file_writer,
+                             summary_file_path):
+    writers = {'path': path_file_writer, 'look': look_file_writer}
+    for job in get_raw_file_jobs(path_file, look_file, subject_id, trial_num, summary_file_path,
+                                 'path' if path_file_writer else None, 'look' if look_file_writer else None):
+        for index, rows in parse_job(job):
+            writers[job.output_names[index]].writerows(rows)
+
+
+# A unit of parsing work: the file at path is parsed as each of the file_types, and the resulting rows belong (in the
+# same order) to the outputs in output_names. Jobs are plain tuples so they can be sent to worker processes.
+ParseJob = collections.namedtuple('ParseJob', ['path', 'subject_id', 'trial_num', 'file_types', 'summary_file_path',
+                                               'output_names', 'phase'])
+ParseJob.__new__.__defaults__ = (None,)  # only raw Unity files have a phase
+
+
+# Helper function which runs a ParseJob, yielding (index, rows) batches where index is the position of the output in
+# job.output_names (see parse_file). The contents of the job's file can be given as data if they have already been read.
+def parse_job(job, data=None):
+    return parse_file(job.path, job.subject_id, job.trial_num, job.file_types, job.summary_file_path, data=data,
+                      phase=job.phase)
+
+
+# Helper function which runs a ParseJob in a worker process. The batches are written to a temporary shard file, so
+# that neither the worker nor the parent needs to hold all the rows of a job in memory, and the path of the shard is
+# returned along with the profile record of the job (see make_job_record). The parent reads the batches back in job
+# order with read_parse_job_shard.
+def run_parse_job(job):
+    record = make_job_record(job)
+    handle, shard_path = tempfile.mkstemp(prefix='holodeck_', suffix='.shard')
+    fp = os.fdopen(handle, 'wb')
+    try:
+        for batch in profile_batches(parse_job(job), record):
+            cPickle.dump(batch, fp, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        fp.close()
+    return shard_path, record
+
+
+# Helper function which yields the (index, rows) batches stored in a shard file by run_parse_job, removing the file
+# when it has been read
+def read_parse_job_shard(shard_path):
+    fp = open(shard_path, 'rb')
+    try:
+        while True:
+            try:
+                yield cPickle.load(fp)
+            except EOFError:
+                break
+    finally:
+        fp.close()
+        os.remove(shard_path)
+
+
+# Helper function which produces the jobs for a raw Unity path and look file pair of a phase. A None output name skips
+# that output. The trial summary and room visit aggregates are computed from the path file.
+def get_raw_file_jobs(path_file, look_file, subject_id, trial_num, summary_file_path, path_output, look_output,
+                      phase=None, summary_output=None, visits_output=None):
+    path_outputs = [(file_type, name) for file_type, name in [(FileType.path_file, path_output),
+                                                              (FileType.trial_summary, summary_output),
+                                                              (FileType.room_visits, visits_output)]
+                    if name is not None]
+    look_outputs = [(FileType.look_file, look_output)] if look_output is not None else []
+    if path_file == look_file:
+        # The same file provides both outputs, so it is only parsed once
+        file_outputs = [(path_file, path_outputs + look_outputs)]
+    else:
+        file_outputs = [(path_file, path_outputs), (look_file, look_outputs)]
+
+    jobs = []
+    for path, outputs in file_outputs:
+        if path and outputs:
+            jobs.append(ParseJob(path, subject_id, trial_num, tuple(file_type for file_type, name in outputs),
+                                 summary_file_path, tuple(name for file_type, name in outputs), phase))
+    return jobs
+
+
+# Helper function which produces, in output order, the jobs needed to generate the requested outputs (names from
+# output_files) for a trial
+def get_trial_parse_jobs(subject_id, trial, output_names):
+    def output(name):
+        return name if name in output_names else None
+
+    jobs = []
+    # Path and look outputs (and the aggregates of the path) come from the same raw file, so each raw file is parsed
+    # once for all of them
+    jobs.extend(get_raw_file_jobs(trial.study_path, trial.study_look, subject_id, trial.num, trial.study_summary,
+                                  output('study_path'), output('study_look'), 'study', output('trial_summary'),
+                                  output('room_visits')))
+    jobs.extend(get_raw_file_jobs(trial.test_path, trial.test_look, subject_id, trial.num, trial.test_summary,
+                                  output('test_path'), output('test_look'), 'test', output('trial_summary'),
+                                  output('room_visits')))
+    jobs.extend(get_raw_file_jobs(trial.practice_path, trial.practice_look, subject_id, trial.num,
+                                  trial.practice_summary, output('practice_path'), output('practice_look'), 'practice',
+                                  output('trial_summary'), output('room_visits')))
+    if trial.test_2d and output('test_2d'):
+        jobs.append(ParseJob(trial.test_2d, subject_id, trial.num, (FileType.test_file_2d,), trial.study_summary,
+                             ('test_2d',)))
+    # The vr test results and the vr test event timeline come from a single pass over the same file
+    vr_outputs = [(file_type, name) for file_type, name in [(FileType.test_file_vr, output('test_vr')),
+                                                            (FileType.test_file_vr_events, output('test_vr_events'))]
+                  if name]
+    if trial.test_vr and vr_outputs:
+        jobs.append(ParseJob(trial.test_vr, subject_id, trial.num, tuple(file_type for file_type, name in vr_outputs),
+                             trial.study_summary, tuple(name for file_type, name in vr_outputs)))
+    return jobs
+
+
+# pandas is optional; without it load_trial can only return NumPy structured arrays
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# PyYAML is only needed to read YAML layout files (see load_environment_layout)
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Helper function which converts the rows of an output table (a list of rows or a ColumnBatch) into a NumPy structured
+# array with a field per column of header. Numeric fields have the column's type (see output_column_types) with empty
+# (None) values stored as -1 in integer fields and NaN in float fields, and category fields are strings.
+def make_structured_array(header, rows):
+    types = [output_column_types.get(name, 'float64') for name in header]
+    columns = []
+    for i, (name, column_type) in enumerate(zip(header, types)):
+        if isinstance(rows, ColumnBatch):
+            values = rows.column(name)
+            if column_type == 'category':
+                values = numpy.array(rows.dictionaries[rows.header.index(name)] or [''], dtype=str)[values]
+        else:
+            values = [row[i] for row in rows]
+            if column_type == 'category':
+                values = numpy.array(['' if value is None else value for value in values], dtype=str)
+            elif numpy.dtype(column_type).kind == 'i':
+                values = numpy.array([-1 if value is None else value for value in values], dtype=column_type)
+            else:
+                values = numpy.array([numpy.nan if value is None else value for value in values], dtype=column_type)
+        columns.append(values)
+    dtype = [(name, column_values.dtype if column_type == 'category' else numpy.dtype(column_type))
+             for name, column_type, column_values in zip(header, types, columns)]
+    array = numpy.empty(len(rows), dtype=dtype)
+    for name, values in zip(header, columns):
+        array[name] = values
+    return array
+
+
+# Helper function which parses the files of a trial (from catalog_files or iter_individuals) directly into memory
+# instead of writing them to output files. It returns an OrderedDict of table name (the names of output_files; all of
+# them by default) -> NumPy structured array with the same columns as the output file (see make_structured_array), or
+# pandas DataFrames (with category columns as pandas categoricals) if as_dataframes is True. Tables whose file is
+# missing from the trial are empty. The rows are identical to the rows written by Holodeck_GenerateIntermediateFiles.py
+# (including resampling, see resample_hz).
+def load_trial(trial, tables=None, as_dataframes=False):
+    if tables is None:
+        tables = list(output_files)
+    for name in tables:
+        if name not in output_files:
+            raise ValueError("Unknown table '%s' (expected one of %s)." % (name, ', '.join(output_files)))
+    if as_dataframes and pandas is None:
+        raise ImportError("pandas is required to load trials as DataFrames.")
+
+    # Gather the batches of each table (lists of rows are joined into one list, ColumnBatches into one batch)
+    table_rows = dict((name, []) for name in tables)
+    for job in get_trial_parse_jobs(trial.subject_id, trial, tables):
+        for index, rows in parse_job(job):
+            name = job.output_names[index]
+            if isinstance(rows, ColumnBatch) and not isinstance(table_rows[name], ColumnBatch):
+                table_rows[name] = rows
+            else:
+                table_rows[name].extend(rows)
+
+    arrays = collections.OrderedDict()
+    for name in tables:
+        header = output_files[name][1]
+        array = make_structured_array(header, table_rows[name])
+        if as_dataframes:
+            array = pandas.DataFrame.from_records(array, columns=header)
+            for column in header:
+                if output_column_types.get(column) == 'category':
+                    array[column] = array[column].astype('category')
+        arrays[name] = array
+    return arrays
+
+
+# Helper function which finds and catalogs the input files under root (see discover_files and catalog_files) and
+# yields the cataloged individuals one at a time, so each one's trials can be loaded with load_trial. Incomplete trials
+# are excluded by default, like the --exclude_incomplete_trials default of Holodeck_GenerateIntermediateFiles.py.
+def iter_individuals(root, min_num_trials=4, exclude_incomplete_trials=True, include=None, exclude=None, threads=1):
+    files = discover_files(root, include, exclude, threads)
+    individuals, excluded, non_matching = catalog_files(files, min_num_trials, exclude_incomplete_trials)
+    for individual in individuals:
+        yield individual
+
+
+# Helper function which gets the CPU time (user and system) used by this process so far
+def get_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+# Helper function which makes the profile record of a ParseJob, which is filled in as the job runs (see
+# profile_batches) and added to the run report (see RunProfile.add_job)
+def make_job_record(job):
+    return {'path': job.path, 'subject_id': job.subject_id, 'trial_number': job.trial_num,
+            'file_types': [file_type.name for file_type in job.file_types], 'bytes': get_input_file_stat(job.path)[0],
+            'rows': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'summary_wall_seconds': 0.0,
+            'summary_cpu_seconds': 0.0, 'summary_bytes': 0, 'summary_files': 0}
+
+
+# Helper function which yields the (index, rows) batches of a ParseJob (see parse_job), adding the time spent
+# producing them, the part of that time spent parsing summary files (and their number and size), and the number of
+# rows to the job record
+def profile_batches(batches, record):
+    batches = iter(batches)
+    while True:
+        summary_wall = summary_cache.parse_wall_seconds
+        summary_cpu = summary_cache.parse_cpu_seconds
+        summary_bytes = summary_cache.parse_bytes
+        summary_files = summary_cache.misses
+        wall, cpu = time.time(), get_cpu_time()
+        batch = next(batches, None)
+        record['wall_seconds'] += time.time() - wall
+        record['cpu_seconds'] += get_cpu_time() - cpu
+        record['summary_wall_seconds'] += summary_cache.parse_wall_seconds - summary_wall
+        record['summary_cpu_seconds'] += summary_cache.parse_cpu_seconds - summary_cpu
+        record['summary_bytes'] += summary_cache.parse_bytes - summary_bytes
+        record['summary_files'] += summary_cache.misses - summary_files
+        if batch is None:
+            return
+        record['rows'] += len(batch[1])
+        yield batch
+
+
+# This object collects the wall and CPU time spent in each stage of a run (discovery, cataloging, summary parsing,
+# each parser, writing, ...), the bytes read, the rows written to each output, and the time spent on each parse job, and
+# produces the run report (see get_report)
+class RunProfile:
+    def __init__(self, slowest_count=10):
+        self.slowest_count = slowest_count
+        self.stages = collections.OrderedDict()
+        self.jobs = []
+        self.rows_written = collections.OrderedDict()
+        self.bytes_read = 0
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_time()
+
+    # Helper function which adds time spent (count times) to a stage
+    def add(self, name, wall_seconds, cpu_seconds, count=1):
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'count': 0})
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['count'] += count
+
+    # Context manager which adds the time spent in its block to a stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.time(), get_cpu_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - wall, get_cpu_time() - cpu)
+
+    # Helper function which adds a finished job record (see make_job_record) to the report. The time spent parsing
+    # summary files is counted in the summary_parsing stage and the rest in the stage of the job's file types.
+    def add_job(self, record):
+        self.jobs.append(record)
+        self.add('parse:' + '+'.join(record['file_types']),
+                 record['wall_seconds'] - record['summary_wall_seconds'],
+                 record['cpu_seconds'] - record['summary_cpu_seconds'])
+        if record['summary_files']:
+            self.add('summary_parsing', record['summary_wall_seconds'], record['summary_cpu_seconds'],
+                     record['summary_files'])
+        self.bytes_read += record['bytes'] + record['summary_bytes']
+
+    # Helper function which counts rows written to an output
+    def add_rows(self, output_name, count):
+        self.rows_written[output_name] = self.rows_written.get(output_name, 0) + count
+
+    # Helper function which produces the run report as a dict which can be written as JSON
+    def get_report(self):
+        subjects = collections.OrderedDict()
+        for record in self.jobs:
+            subject = subjects.setdefault(record['subject_id'], {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0,
+                                                                 'rows': 0, 'jobs': 0})
+            for key in ['wall_seconds', 'cpu_seconds', 'bytes', 'rows']:
+                subject[key] += record[key]
+            subject['jobs'] += 1
+        children_times = os.times()[2:4]
+        return {'wall_seconds': time.time() - self.start_wall,
+                'cpu_seconds': get_cpu_time() - self.start_cpu,
+                'worker_cpu_seconds': children_times[0] + children_times[1],
+                'stages': self.stages,
+                'bytes_read': self.bytes_read,
+                'rows_written': self.rows_written,
+                'jobs': len(self.jobs),
+                'subjects': subjects,
+                'slowest_files': sorted(self.jobs, key=lambda r: r['wall_seconds'], reverse=True)[0:self.slowest_count]}
+
+    # Helper function which writes the run report (along with any extra fields given) to a JSON file
+    def write_report(self, path, **extra):
+        report = self.get_report()
+        report.update(extra)
+        with open(path, 'wb') as fp:
+            json.dump(report, fp, indent=1)
+
+
+# Helper function which gets the compression format of an input file from its extension (None if it isn't compressed)
+def get_input_compression(path):
+    return input_compression_extensions.get(os.path.splitext(path)[1].lower())
+
+
+# Helper function which checks whether a decompressor has reached the end of its stream. The Python 2 zlib and bz2
+# decompressors don't say so directly, but past the end of the stream the zlib decompressor keeps any more data as
+# unused_data and the bz2 decompressor raises EOFError.
+def _decompressor_finished(decompressor):
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    try:
+        decompressor.decompress('\0')
+    except EOFError:
+        return True
+    except (zlib.error, IOError):
+        return False
+    return bool(decompressor.unused_data)
+
+
+# Helper function which decompresses a compressed file (or the file-like object of its contents) a block at a time,
+# yielding the decompressed blocks. Files made of several concatenated streams (such as appended output files) are
+# decompressed stream by stream. A file which ends in the middle of a stream raises EOFError (see
+# decompression_errors).
+def iter_decompressed_blocks(file_pointer, compression, block_size=1 << 20):
+    if compression not in compression_formats:
+        raise LogParseError("Reading %s files requires the lzma module (backports.lzma on Python 2)." % compression)
+    make_decompressor = compression_formats[compression][2]
+    decompressor = None
+    while True:
+        block = file_pointer.read(block_size)
+        if not block:
+            if decompressor is not None and not _decompressor_finished(decompressor):
+                raise EOFError("Compressed data ended before the end of the stream")
+            return
+        while block:
+            if decompressor is None:
+                decompressor = make_decompressor()
+            try:
+                decompressed = decompressor.decompress(block)
+            except EOFError:
+                # The previous stream ended exactly at the end of the last block, and a new one starts here
+                decompressor = None
+                continue
+            if decompressed:
+                yield decompressed
+            # Anything after the end of a stream belongs to the next one
+            block = decompressor.unused_data
+            if block:
+                decompressor = None
+
+
+# Helper function which opens an input file for reading, or wraps its contents in a file-like object if they have
+# already been read (see FilePrefetcher). Compressed files (see get_input_compression) and files inside archives (see
+# split_archive_path) are read into memory. A corrupt or truncated compressed file raises LogParseError.
+def open_input_file(path, data=None):
+    compression = get_input_compression(path)
+    in_archive = data is None and split_archive_path(path)[0] is not None
+    if compression is None and not in_archive:
+        return cStringIO.StringIO(data) if data is not None else open(path, 'rb')
+    file_pointer = cStringIO.StringIO(data) if data is not None else open_input_stream(path)
+    try:
+        if compression is None:
+            return cStringIO.StringIO(file_pointer.read())
+        return cStringIO.StringIO(''.join(iter_decompressed_blocks(file_pointer, compression)))
+    except decompression_errors as e:
+        raise LogParseError("The compressed file %s could not be read (%s)." % (path, e))
+    finally:
+        file_pointer.close()
+
+
+# This object reads the contents of a sequence of files ahead of their use in background reader threads, so the reads
+# overlap with parsing. Files are read in order, at most depth files ahead of the one being consumed, and new reads
+# only start while less than max_bytes are held in memory (a single file larger than that is still read on its own).
+# The consumer takes the contents of each file, in order, with get.
+class FilePrefetcher:
+    def __init__(self, paths, depth=4, max_bytes=256 * 1024 * 1024, threads=2):
+        self.paths = list(paths)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.contents = dict()
+        self.next_index = 0
+        self.consumed = 0
+        self.bytes_in_flight = 0
+        self.bytes_read = 0
+        self.waits = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._read_files) for _ in range(0, max(threads, 1))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # Helper function run by each reader thread which claims the next file to read whenever there is room ahead of the
+    # consumer and stores its contents (or None if it couldn't be read, in which case the parser reads it itself)
+    def _read_files(self):
+        while True:
+            with self.condition:
+                while not self.closed and self.next_index < len(self.paths) and \
+                        (self.next_index - self.consumed >= self.depth or
+                         (self.bytes_in_flight >= self.max_bytes and self.next_index > self.consumed)):
+                    self.condition.wait()
+                if self.closed or self.next_index >= len(self.paths):
+                    return
+                index = self.next_index
+                self.next_index += 1
+            try:
+                with contextlib.closing(open_input_stream(self.paths[index])) as fp:
+                    data = fp.read()
+            except (IOError, OSError):
+                data = None
+            with self.condition:
+                self.contents[index] = data
+                if data is not None:
+                    self.bytes_in_flight += len(data)
+                    self.bytes_read += len(data)
+                self.condition.notify_all()
+
+    # Helper function which returns the contents of the next file (blocking until they have been read) and frees its
+    # place in the queue. None is returned for files which couldn't be read.
+    def get(self):
+        with self.condition:
+            index = self.consumed
+            if index >= len(self.paths):
+                raise IndexError("All prefetched files have been consumed.")
+            if index not in self.contents:
+                self.waits += 1
+            while index not in self.contents:
+                # Wait with a timeout so the main thread stays responsive to interrupts
+                self.condition.wait(0.5)
+            data = self.contents.pop(index)
+            if data is not None:
+                self.bytes_in_flight -= len(data)
+            self.consumed += 1
+            self.condition.notify_all()
+            return data
+
+    # Helper function which stops the reader threads and drops any contents not yet consumed
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.contents.clear()
+            self.bytes_in_flight = 0
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    # Helper function to log how much was read ahead and how often the consumer had to wait for a read
+    def log_statistics(self):
+        logging.info("Prefetch: %d of %d files read ahead (%.1f MB), consumer waited on %d reads."
+                     % (self.next_index, len(self.paths), self.bytes_read / 1e6, self.waits))
+
+
+# Helper function which sets up a worker process so it logs, caches, resamples and uses the environment layout like the
+# main process
+def initialize_worker(log_level, summary_cache_size, resample_rate=None, resample_method='slerp', layout=None):
+    global resample_hz, resample_quaternions
+    logging.basicConfig(format="%(levelname)s (%(asctime)s): %(message)s", level=log_level)
+    summary_cache.max_size = summary_cache_size
+    resample_hz = resample_rate
+    resample_quaternions = resample_method
+    if layout is not None:
+        set_environment_layout(layout)
+
+
 # This Exception object is a specialized exception for use internally
 class LogParseError(Exception):
     def __init__(self, *args, **kwargs):
@@ -379,12 +1904,11 @@ class SummaryType(Enum):
 
 # This helper function will parse a summary file of either type and return summary type, times, event types,
 # object names (in the format of the summary type), and location (if test type, the placed location, if study/practice
-# type, the location the object was when clicked)
-def parse_summary_file(path):
-    # Read the entire file into memory
-    fp = open(path, 'rb')
-    data = fp.readlines()
-    fp.close()
+# type, the location the object was when clicked). If the contents of the file have already been read (see
+# FilePrefetcher), they can be given as data.
+def parse_summary_file(path, data=None):
+    # Stream the file line by line rather than reading it all into memory
+    fp = open_input_file(path, data)
 
     times = []
     event_types = []
@@ -394,15 +1918,19 @@ def parse_summary_file(path):
     t0 = 0
 
     summary_type = SummaryType.unknown
-    # Detect which type of summary file this is (study/practice or test)
-    if any(['ChangeTextureEvent_ObjectClicked' in line for line in data]):
-        summary_type = SummaryType.study_practice
-    elif any(['Object_Placed' in line for line in data]):
-        summary_type = SummaryType.test
+    # Detect which type of summary file this is (study/practice or test); a study/practice event anywhere in the file
+    # takes precedence over a test event
+    for line in fp:
+        if 'ChangeTextureEvent_ObjectClicked' in line:
+            summary_type = SummaryType.study_practice
+            break
+        elif 'Object_Placed' in line:
+            summary_type = SummaryType.test
+    fp.seek(0)
 
     # This line_count business just skips the first line of the data (or can be reconfigured to skip more if necessary
     line_count = 0
-    for line in data:
+    for line in fp:
         if line_count == 0:
             line_count += 1
             continue
@@ -430,8 +1958,9 @@ def parse_summary_file(path):
                 event_types.append(split_str[0].strip())
                 object_types.append(split_str[1].strip())
                 locations.append(get_location_by_name(split_str[1].strip(), test2d=False))
+    fp.close()
 
-    expected_elements = len(study_labels)
+    expected_elements = len(environment_layout.study_labels)
     if 'practice' in path.lower():
         expected_elements /= 2
     if len(times) < expected_elements:
@@ -440,36 +1969,521 @@ def parse_summary_file(path):
     return summary_type, times, event_types, object_types, locations
 
 
-# Special parser for path files (Raw Unity)
-# should produce lines with following format
-# subject_id,trial_number,time,x,y,z,room_by_order,room_by_color,items_clicked,distance_from_last_point,time_since_last_point
-def parse_path_file(path, subject_id, trial_number, summary_file_path):
-    # Read the entire file into memory
-    fp = open(path, 'rb')
-    data = fp.readlines()
-    fp.close()
+# Helper function which generates the context_color->context_order mapping via the order of item clicks in a summary
+# (the path of the summary file is only used in the error raised for an unknown item)
+def get_context_color_order_mapping(summary_object_types, path=None):
+    previous_context_color = None
+    context_color_order_mapping = dict()
+    context_order_counter = 0
+    for object_type in summary_object_types:
+        if object_type.strip() not in environment_layout.study_location_rooms:
+            raise LogParseError("The summary file %s contains an unknown item (%s)." % (path, object_type))
+        current_context_color = environment_layout.study_location_rooms[object_type.strip()]
+        if not previous_context_color:
+            previous_context_color = current_context_color
+            context_color_order_mapping[current_context_color] = context_order_counter
+        if not (previous_context_color == current_context_color):
+            context_order_counter += 1
+            if not (current_context_color in context_color_order_mapping):
+                context_color_order_mapping[current_context_color] = context_order_counter
+        previous_context_color = current_context_color
+    return context_color_order_mapping
 
-    # Get data from associated summary file
-    summary_type, summary_times, summary_event_types, summary_object_types, summary_locations = parse_summary_file(
-        summary_file_path)
-    summary_index_tracker = 0
 
-    # Initialize time and vector variables
-    t0 = 0
-    prev_t = 0
-    tn = 0
-    prev_v = []
-    count = 0
+# Read-only dictionary used so that cached summary data can be shared safely between all the outputs of a trial
+class FrozenDict(collections.Mapping):
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'FrozenDict(%r)' % self._data
+
+
+# Immutable parsed summary file (see parse_summary_file for the meaning of the fields) which also carries the
+# context_color->context_order mapping derived from the order of item clicks (only for study/practice summaries; it
+# is None for the others)
+SummaryData = collections.namedtuple('SummaryData', ['summary_type', 'times', 'event_types', 'object_types',
+                                                     'locations', 'context_color_order_mapping'])
+
+
+# A bounded least-recently-used cache of parsed summary files. Entries are keyed by the path along with the size and
+# modification time of the file so a changed file is never served stale. The time spent parsing files and the number
+# of bytes parsed are counted for the run report (see RunProfile).
+class SummaryCache:
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.parse_wall_seconds = 0.0
+        self.parse_cpu_seconds = 0.0
+        self.parse_bytes = 0
+
+    # Helper function which returns the SummaryData for a path, parsing the file (or its contents, if they are given as
+    # data) only if it is not already cached
+    def get(self, path, data=None):
+        key = (path,) + tuple(get_input_file_stat(path))
+        if key in self.entries:
+            # Move the entry to the most recently used end of the cache
+            self.hits += 1
+            summary = self.entries.pop(key)
+            self.entries[key] = summary
+            return summary
+
+        self.misses += 1
+        wall, cpu = time.time(), get_cpu_time()
+        summary_type, times, event_types, object_types, locations = parse_summary_file(path, data)
+        context_color_order_mapping = None
+        if summary_type == SummaryType.study_practice:
+            context_color_order_mapping = FrozenDict(get_context_color_order_mapping(object_types, path))
+        summary = SummaryData(summary_type, tuple(times), tuple(event_types), tuple(object_types), tuple(locations),
+                              context_color_order_mapping)
+        self.parse_wall_seconds += time.time() - wall
+        self.parse_cpu_seconds += get_cpu_time() - cpu
+        self.parse_bytes += key[1]
+        self.entries[key] = summary
+        # Evict the least recently used entries beyond the maximum size
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return summary
+
+    # Helper function to log the hit/miss counters of the cache
+    def log_statistics(self):
+        logging.info("Summary cache: %d hits, %d misses (%d of %d entries in use)."
+                     % (self.hits, self.misses, len(self.entries), self.max_size))
+
+
+# The cache shared by all the parsers in this process
+summary_cache = SummaryCache()
+
+
+# Helper function which returns the (cached) SummaryData for a summary file
+def get_summary(path, data=None):
+    return summary_cache.get(path, data)
+
+
+# The number of samples of a tracked object which are collected from a raw Unity file before their trajectory
+# variables are computed together as arrays
+trajectory_chunk_size = 4096
+
+
+# This object tracks the running state (time, position, room, and items clicked) of one object logged in a raw Unity
+# file so that chunks of samples can be turned into the shared trajectory output variables with array operations
+class TrajectoryTracker:
+    def __init__(self, summary_type, summary_times, summary_event_types):
+        # Store the data from the associated summary file
+        self.summary_type = summary_type
+        self.summary_times = summary_times
+        self.summary_event_types = summary_event_types
+        self.summary_index_tracker = 0
+
+        # Initialize time and vector variables
+        self.prev_t = 0
+        self.prev_v = None
+        self.count = 0
+
+        # Initialize other output variables
+        self.items_clicked = 0
+        self.previous_context_index = None
+        self.context_number = 0
+
+    # Helper function which accepts a chunk of times (relative to the first time point) and N x 3 positions and
+    # returns arrays of t, room_by_order, room_by_color, items_clicked, distance_from_last_point, time_since_last_point
+    def update(self, times, positions):
+        t = numpy.array(times, dtype=numpy.int64)
+        positions = numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+        n = len(t)
+
+        # The first sample of the trajectory is at time 0 and sits on top of its own previous point
+        if self.count == 0:
+            t[0] = 0
+            self.prev_t = 0
+            self.prev_v = positions[0]
+            self.count += 1
+        time_since_last_point = numpy.diff(numpy.concatenate(([self.prev_t], t)))
+
+        # Use summary file to determine how many items have been placed/clicked. At most one summary event is consumed
+        # per sample (the first sample at or after the event time), so walk the events rather than the samples.
+        changes = numpy.zeros(n, dtype=int)
+        start = 0
+        while self.summary_index_tracker < len(self.summary_times) and start < n:
+            reached = t[start:] >= self.summary_times[self.summary_index_tracker]
+            i = reached.argmax()
+            if not reached[i]:
+                break
+            if self.summary_type == SummaryType.test:
+                if 'placed' in self.summary_event_types[self.summary_index_tracker].lower():
+                    changes[start + i] += 1
+                elif 'picked' in self.summary_event_types[self.summary_index_tracker].lower():
+                    changes[start + i] -= 1
+            elif self.summary_type == SummaryType.study_practice:
+                changes[start + i] += 1
+            self.summary_index_tracker += 1
+            start += i + 1
+        items_clicked = self.items_clicked + numpy.cumsum(changes)
+
+        # Calculate room color in navigation space (an index of -1 is the last color, as in nav_get_room_by_location)
+        room_indices, room_by_color = nav_get_rooms_by_locations(positions[:, [0, 2]])
+        room_indices[room_indices < 0] += len(environment_layout.room_labels)
+
+        # Iterate the context number every time the room differs from the previous room (the first sample has no
+        # previous room so it is never counted)
+        if self.previous_context_index is None:
+            self.previous_context_index = room_indices[0]
+        room_changes = numpy.diff(numpy.concatenate(([self.previous_context_index], room_indices))) != 0
+        room_by_order = self.context_number + numpy.cumsum(room_changes)
+
+        # Calculate distance on each tick. The squares of the deltas are summed in numpy.longdouble (extended precision
+        # on most x86 builds, but the same as float64 on others such as MSVC) and the root is rounded to float64. This
+        # was previously scipy.spatial.distance.euclidean, which it matches on the data checked by
+        # Holodeck_Benchmark.check_distances, though not necessarily bit for bit on every platform and BLAS.
+        deltas = numpy.diff(numpy.concatenate(([self.prev_v], positions)), axis=0).astype(numpy.longdouble)
+        distance_from_last_point = numpy.sqrt((deltas * deltas).sum(axis=1)).astype(numpy.float64)
+
+        # Update the running state for the next chunk
+        self.prev_t = t[-1]
+        self.prev_v = positions[-1]
+        self.items_clicked = items_clicked[-1]
+        self.previous_context_index = room_indices[-1]
+        self.context_number = room_by_order[-1]
+
+        return t, room_by_order, room_by_color, items_clicked, distance_from_last_point, time_since_last_point
+
+
+# The number of raw Unity time ticks in a second (times are logged as .NET DateTime ticks)
+ticks_per_second = 10000000
+
+# The rate (in Hz) the path and look outputs are resampled to, or None to output every logged sample, and the way the
+# orientation quaternions are resampled ('slerp' or 'nearest'), see TrajectoryResampler
+resample_hz = None
+resample_quaternions = 'slerp'
+
+
+# This object resamples the samples of one object logged in a raw Unity file onto a regular time grid (every
+# 1/rate seconds from the first sample), one chunk of samples at a time. Positions (and scales) are linearly
+# interpolated between the samples on either side of each grid time, and the orientation quaternions are either
+# spherically interpolated (quaternion_method='slerp') or taken from the nearest sample ('nearest'). Room and
+# items_clicked state is carried forward from the last sample at or before each grid time, so room_by_order still
+# counts every room change of the full trajectory. The distance and time since the last point are recomputed between
+# grid points. Grid times after the last sample are never produced (there is nothing to interpolate towards).
+class TrajectoryResampler:
+    def __init__(self, rate, quaternion_method='slerp'):
+        if quaternion_method not in ['slerp', 'nearest']:
+            raise ValueError("Unknown quaternion resampling method '%s'." % quaternion_method)
+        self.step = float(ticks_per_second) / rate
+        self.quaternion_method = quaternion_method
+
+        # The last sample of the previous chunk, the index of the next grid time, and the last grid point produced
+        self.prev_t = None
+        self.prev_v = None
+        self.prev_states = None
+        self.grid_index = 0
+        self.prev_grid_t = None
+        self.prev_grid_position = None
+
+    # Helper function which spherically interpolates between the rows of two N x 4 arrays of quaternions by the
+    # fractions in f (taking the shorter way around)
+    @staticmethod
+    def slerp(q0, q1, f):
+        dot = (q0 * q1).sum(axis=1)
+        q1 = numpy.where((dot < 0)[:, None], -q1, q1)
+        dot = numpy.clip(numpy.abs(dot), 0, 1)
+        theta = numpy.arccos(dot)
+        sin_theta = numpy.sin(theta)
+        # Nearly identical quaternions are linearly interpolated (and normalized) to avoid dividing by ~0
+        close = sin_theta < 1e-6
+        safe_sin_theta = numpy.where(close, 1, sin_theta)
+        s0 = numpy.where(close, 1 - f, numpy.sin((1 - f) * theta) / safe_sin_theta)
+        s1 = numpy.where(close, f, numpy.sin(f * theta) / safe_sin_theta)
+        q = s0[:, None] * q0 + s1[:, None] * q1
+        norms = numpy.sqrt((q * q).sum(axis=1))
+        return numpy.where(close[:, None], q / numpy.where(norms > 0, norms, 1)[:, None], q)
+
+    # Helper function which accepts a chunk of times (relative to the first time point), N x 10 logged vectors
+    # (position, rotation quaternion, scale) and a list of per-sample state arrays (see TrajectoryTracker.update) and
+    # returns the resampled times, vectors and states along with distance_from_last_point and time_since_last_point
+    def update(self, t, vectors, states):
+        t = numpy.asarray(t, dtype=numpy.int64)
+        vectors = numpy.asarray(vectors, dtype=numpy.float64)
+        states = [numpy.asarray(state) for state in states]
+
+        # Include the last sample of the previous chunk so grid times between the chunks can be interpolated
+        if self.prev_t is not None:
+            t = numpy.concatenate(([self.prev_t], t))
+            vectors = numpy.concatenate(([self.prev_v], vectors))
+            states = [numpy.concatenate(([prev_state], state)) for prev_state, state in zip(self.prev_states, states)]
+        self.prev_t, self.prev_v, self.prev_states = t[-1], vectors[-1], [state[-1] for state in states]
+
+        # The grid times up to the last sample of the chunk
+        count = int(numpy.floor(t[-1] / self.step)) + 1 - self.grid_index
+        grid = numpy.round((self.grid_index + numpy.arange(0, max(count, 0))) * self.step).astype(numpy.int64)
+        self.grid_index += len(grid)
+
+        # Each grid time falls between the last sample at or before it and the sample after that one
+        before = numpy.searchsorted(t, grid, side='right') - 1
+        after = numpy.minimum(before + 1, len(t) - 1)
+        span = (t[after] - t[before]).astype(numpy.float64)
+        f = numpy.where(span > 0, (grid - t[before]) / numpy.where(span > 0, span, 1), 0)
+
+        resampled = vectors[before] + f[:, None] * (vectors[after] - vectors[before])
+        if self.quaternion_method == 'slerp':
+            resampled[:, 3:7] = self.slerp(vectors[before, 3:7], vectors[after, 3:7], f)
+        else:
+            resampled[:, 3:7] = numpy.where((f < 0.5)[:, None], vectors[before, 3:7], vectors[after, 3:7])
+        resampled_states = [state[before] for state in states]
+
+        # Recompute the distances and times between consecutive grid points (the first grid point sits on itself)
+        if len(grid) > 0:
+            if self.prev_grid_t is None:
+                self.prev_grid_t = grid[0]
+                self.prev_grid_position = resampled[0, 0:3]
+            positions = numpy.concatenate(([self.prev_grid_position], resampled[:, 0:3]))
+            distance_from_last_point = numpy.sqrt((numpy.diff(positions, axis=0) ** 2).sum(axis=1))
+            time_since_last_point = numpy.diff(numpy.concatenate(([self.prev_grid_t], grid)))
+            self.prev_grid_t = grid[-1]
+            self.prev_grid_position = resampled[-1, 0:3]
+        else:
+            distance_from_last_point = numpy.zeros(0)
+            time_since_last_point = numpy.zeros(0, dtype=numpy.int64)
+
+        return grid, resampled, resampled_states, distance_from_last_point, time_since_last_point
+
+
+# This object aggregates the trajectory of the path of a raw Unity file as it is parsed, one chunk at a time, into a
+# trial summary row (the number of samples, duration, path length, number of room transitions, items clicked, and the
+# time spent in each room color) and room visit rows. A visit is a run of samples with the same room_by_order and
+# items_clicked, so the time per room visit and the time per items_clicked segment can both be totaled from the visits.
+# The time and distance of each sample (since the previous sample) count towards the sample's visit and room.
+class TrajectoryAggregator:
+    def __init__(self, subject_id, trial_number, phase):
+        self.subject_id = subject_id
+        self.trial_number = trial_number
+        self.phase = phase
+        self.samples = 0
+        self.duration = 0
+        self.path_length = 0.0
+        self.room_transitions = 0
+        self.items_clicked = 0
+        self.time_in_room = collections.OrderedDict((label, 0) for label in environment_layout.room_labels)
+        self.visits = []  # the finished visits, as room visit rows
+        self.visit = None  # the current visit, as the room visit columns from room_by_order on
+
+    # Helper function which adds a chunk of the trajectory variables (see TrajectoryTracker.update)
+    def update(self, t, room_by_order, room_by_color, items_clicked, distance_from_last_point, time_since_last_point):
+        n = len(t)
+        if n == 0:
+            return
+        self.samples += n
+        self.duration = int(t[-1])
+        self.path_length += float(distance_from_last_point.sum())
+        self.room_transitions = int(room_by_order[-1])
+        self.items_clicked = int(items_clicked[-1])
+        for label in self.time_in_room:
+            self.time_in_room[label] += int(time_since_last_point[room_by_color == label].sum())
+
+        # Run-length segmentation: a visit starts wherever the room or the items clicked change
+        starts = numpy.empty(n, dtype=bool)
+        starts[1:] = (room_by_order[1:] != room_by_order[:-1]) | (items_clicked[1:] != items_clicked[:-1])
+        starts[0] = self.visit is None or room_by_order[0] != self.visit[0] or items_clicked[0] != self.visit[2]
+        bounds = numpy.unique(numpy.concatenate(([0], numpy.flatnonzero(starts), [n])))
+        durations = numpy.add.reduceat(time_since_last_point, bounds[:-1])
+        lengths = numpy.add.reduceat(distance_from_last_point, bounds[:-1])
+        for start, end, duration, length in zip(bounds[:-1].tolist(), bounds[1:].tolist(), durations.tolist(),
+                                                lengths.tolist()):
+            if starts[start]:
+                self._finish_visit()
+                self.visit = [int(room_by_order[start]), room_by_color[start], int(items_clicked[start]),
+                              int(t[start]), int(t[end - 1]), 0, 0, 0.0]
+            self.visit[4] = int(t[end - 1])
+            self.visit[5] += duration
+            self.visit[6] += end - start
+            self.visit[7] += length
+
+    # Helper function which adds the current visit to the finished visits
+    def _finish_visit(self):
+        if self.visit is not None:
+            self.visits.append([self.subject_id, self.trial_number, self.phase] + self.visit)
+            self.visit = None
+
+    # Helper function which returns the trial summary row
+    def get_summary_row(self):
+        return [self.subject_id, self.trial_number, self.phase, self.samples, self.duration, self.path_length,
+                self.room_transitions, self.items_clicked] + self.time_in_room.values()
+
+    # Helper function which returns the room visit rows (finishing the current visit)
+    def get_visit_rows(self):
+        self._finish_visit()
+        return self.visits
+
+
+# Helper function which turns the chunks of parsed samples of a raw Unity file into a ColumnBatch of the output rows
+# of the tracked object (resampled onto a regular time grid if a TrajectoryResampler is given). Each vector is the full
+# list of logged values; position_fields selects the values written to the position columns (x, y, z and, for the
+# look output, w). If an OrientationTracker is given, the rows are look output rows with the orientation columns. The
+# full rate trajectory is added to the TrajectoryAggregator, if one is given.
+def _make_trajectory_batch(tracker, subject_id, trial_number, times, vectors, position_fields, orientation=None,
+                           resampler=None, aggregator=None):
+    t, room_by_order, room_by_color, items_clicked, distance_from_last_point, time_since_last_point = \
+        tracker.update(times, [v[0:3] for v in vectors])
+    if aggregator is not None:
+        aggregator.update(t, room_by_order, room_by_color, items_clicked, distance_from_last_point,
+                          time_since_last_point)
+    vectors = numpy.array(vectors, dtype=numpy.float64)
+    if resampler is not None:
+        t, vectors, (room_by_order, room_by_color, items_clicked), distance_from_last_point, time_since_last_point = \
+            resampler.update(t, vectors, [room_by_order, room_by_color, items_clicked])
+    values = vectors[:, position_fields]
+    columns = {'subject_id': subject_id, 'trial_number': trial_number, 'time': t, 'room_by_order': room_by_order,
+               'room_by_color': room_by_color, 'items_clicked': items_clicked,
+               'distance_from_last_point': distance_from_last_point, 'time_since_last_point': time_since_last_point}
+    for i, name in enumerate(['x', 'y', 'z', 'w'][0:values.shape[1]]):
+        columns[name] = values[:, i]
+    if orientation is not None:
+        euler, columns['heading'], columns['angular_speed'] = orientation.update(vectors[:, 3:7],
+                                                                                 time_since_last_point)
+        columns['euler_x'], columns['euler_y'], columns['euler_z'] = euler[:, 0], euler[:, 1], euler[:, 2]
+    batch = ColumnBatch(look_output_header if orientation is not None else path_output_header, len(t))
+    batch.append_columns(len(t), columns)
+    return batch
+
+
+# The names of the objects tracked in raw Unity files (the position is taken from the first and the orientation from
+# the second)
+path_object_name = 'First Person Controller'
+look_object_name = 'Main Camera'
+
+# Compiled raw log line patterns by tuple of object names (see iter_raw_log_lines)
+_raw_log_patterns = dict()
+
+
+# Helper function which memory maps a raw Unity file and yields, in order and without the line endings, only its time
+# lines (those starting with '-') and the lines of the objects whose names are given (those starting with one of the
+# names). The lines are found by a regular expression anchored on the preceding line break, which lets the regular
+# expression engine skip the lines of all the other scene objects without creating a string for each of them. If the
+# contents of the file have already been read (see FilePrefetcher), they are searched instead. Compressed files (see
+# get_input_compression) are decompressed and searched a block at a time.
+def iter_raw_log_lines(path, object_names, data=None):
+    object_names = tuple(object_names)
+    if object_names not in _raw_log_patterns:
+        _raw_log_patterns[object_names] = re.compile(
+            r'\n((?:-' + ''.join('|' + re.escape(name) for name in object_names) + r')[^\n]*)')
+    pattern = _raw_log_patterns[object_names]
+
+    # Compressed files and files inside archives can't be memory mapped, so they are read as a stream
+    compression = get_input_compression(path)
+    if compression is not None or (data is None and split_archive_path(path)[0] is not None):
+        fp = cStringIO.StringIO(data) if data is not None else open_input_stream(path)
+        try:
+            for line in _search_raw_log_stream(fp, compression, pattern):
+                yield line
+        except decompression_errors as e:
+            if compression is None:
+                raise
+            raise LogParseError("The compressed file %s could not be read (%s)." % (path, e))
+        finally:
+            fp.close()
+        return
 
-    # Initialize other output variables
-    items_clicked = 0
-    previous_context_color = None
-    context_number = 0
+    if data is not None:
+        for line in _search_raw_log_lines(data, pattern, object_names):
+            yield line
+        return
 
-    # Initialize buffer for storing output lines
-    out_lines = []
+    fp = open(path, 'rb')
+    try:
+        # An empty file can't be memory mapped (and has no lines)
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in _search_raw_log_lines(data, pattern, object_names):
+                yield line
+        finally:
+            data.close()
+    finally:
+        fp.close()
+
+
+# Helper function which yields the lines of a raw Unity file's contents (a string or memory map) found by the compiled
+# pattern of the object names (see iter_raw_log_lines)
+def _search_raw_log_lines(data, pattern, object_names):
+    # The first line has no preceding line break, so it is checked on its own
+    end = data.find('\n')
+    if end < 0:
+        end = len(data)
+    first_line = data[0:end]
+    if first_line.startswith('-') or any(first_line.startswith(name) for name in object_names):
+        yield first_line
+    for match in pattern.finditer(data, end):
+        yield match.group(1)
+
+
+# Helper function which yields the lines of a raw Unity file stream (decompressed if compression is given) found by the
+# compiled pattern of the object names (see iter_raw_log_lines). Each block is searched up to its last line break, and
+# the partial line after it is carried over to the next block.
+def _search_raw_log_stream(fp, compression, pattern, block_size=1 << 20):
+    if compression is not None:
+        blocks = iter_decompressed_blocks(fp, compression, block_size)
+    else:
+        blocks = iter(lambda: fp.read(block_size), '')
+    # The pattern finds lines by their preceding line break, so one is added before the first line
+    pending = '\n'
+    for block in blocks:
+        block = pending + block
+        end = block.rfind('\n')
+        for match in pattern.finditer(block, 0, end):
+            yield match.group(1)
+        pending = block[end:]
+    for match in pattern.finditer(pending):
+        yield match.group(1)
+
+
+# Special parser for raw Unity files which reads the file a single time and yields both the path rows
+# (if parse_path is True, see parse_path_file) and the look rows (if parse_look is True, see parse_look_file) as
+# (file_type, ColumnBatch) tuples. Only the relevant lines are read (see iter_raw_log_lines), and samples are gathered
+# in chunks of trajectory_chunk_size so the trajectory variables can be computed with array operations. If the contents
+# of the file have already been read (see FilePrefetcher), they can be given as data. If resample_hz is given, the rows
+# are resampled to that rate (see TrajectoryResampler). If aggregate is True, the trial summary row and the room visit
+# rows of the path (see TrajectoryAggregator) are yielded at the end as (FileType.trial_summary, rows) and
+# (FileType.room_visits, rows), labeled with the phase.
+def parse_raw_file_columns(path, subject_id, trial_number, summary_file_path, parse_path=True, parse_look=True,
+                           data=None, resample_hz=None, resample_quaternions='slerp', aggregate=False, phase=None):
+    # Get data from associated summary file (once for both the path and look trackers)
+    summary = get_summary(summary_file_path)
+    path_tracker = TrajectoryTracker(summary.summary_type, summary.times, summary.event_types)
+    look_tracker = TrajectoryTracker(summary.summary_type, summary.times, summary.event_types)
+    path_resampler = TrajectoryResampler(resample_hz, resample_quaternions) if resample_hz else None
+    look_resampler = TrajectoryResampler(resample_hz, resample_quaternions) if resample_hz else None
+    look_orientation = OrientationTracker()
+    aggregator = TrajectoryAggregator(subject_id, trial_number, phase) if aggregate else None
+
+    # The path is scanned for the aggregates even if its rows aren't needed
+    scan_path = parse_path or aggregate
+
+    # Initialize time variables
+    t0 = 0
+    tn = 0
 
-    for line in data:
+    # Initialize the chunks of samples (relative times and vectors) for each tracked object
+    path_times, path_vectors = [], []
+    look_times, look_vectors = [], []
+
+    # Scan the file for the time lines and the lines of the tracked objects only
+    object_names = []
+    if scan_path:
+        object_names.append(path_object_name)
+    if parse_look:
+        object_names.append(look_object_name)
+    for line in iter_raw_log_lines(path, object_names, data):
         # If this is the first time point
         if t0 == 0 and line[0] == '-':
             # Initialize the time values
@@ -478,195 +2492,86 @@ def parse_path_file(path, subject_id, trial_number, summary_file_path):
             # Otherwise, extract the current time only
             tn = int(line[0:20])
         # Extract by name the position vector
-        if 'First Person Controller' in line:
+        if scan_path and 'First Person Controller' in line:
             offset = 24
             # Add exception for test renaming
             if 'First Person Controller Test' in line:
                 offset = 29
             # Turn it into a float vector
             split_v = line[offset:].split(',')
-            v = [float(split_v[0]), float(split_v[1]), float(split_v[2]), float(split_v[3]),
-                 float(split_v[4]), float(split_v[5]), float(split_v[6]), float(split_v[7]),
-                 float(split_v[8]), float(split_v[9])]
-
-            # Calculate the relative times
-            t = tn - t0
-            if count == 0:
-                t = 0
-                prev_t = 0
-                count += 1
-            time_since_last_point = t - prev_t
-
-            # If there's not a previous vector, just use the current (first) one
-            if not prev_v:
-                prev_v = v
-
-            # Use summary file to determine how many items have been placed/clicked
-            if summary_index_tracker < len(summary_times) and t >= summary_times[summary_index_tracker]:
-                if summary_type == SummaryType.test:
-                    if 'placed' in summary_event_types[summary_index_tracker].lower():
-                        items_clicked += 1
-                    elif 'picked' in summary_event_types[summary_index_tracker].lower():
-                        items_clicked -= 1
-                elif summary_type == SummaryType.study_practice:
-                    items_clicked += 1
-                summary_index_tracker += 1
-
-            # Calculate room color in navigation space
-            index, room = nav_get_room_by_location((v[0], v[2]))
-            room_by_color = room
-
-            # Determine if this is first iteration (set previous variable to current so no counting is done)
-            if not previous_context_color:
-                previous_context_color = room_by_color
-            # If the previous room is different from the current room, iterate the context_number
-            if not (previous_context_color == room_by_color):
-                context_number += 1
-            # Update the previous context state
-            previous_context_color = room_by_color
-            # Apply the order number
-            room_by_order = context_number
-
-            # Calculate distance on this tick
-            distance_from_last_point = distance.euclidean(prev_v[0:3], v[0:3])
-
-            # Create the output line and write it to the output buffer
-            out_line = [subject_id, trial_number, t, v[0], v[1], v[2], room_by_order, room_by_color, items_clicked,
-                        distance_from_last_point, time_since_last_point]
-            out_lines.append(out_line)
-
-            # Update prev variables
-            prev_t = t
-            prev_v = v
-
-    return out_lines
+            path_vectors.append([float(split_v[0]), float(split_v[1]), float(split_v[2]), float(split_v[3]),
+                                 float(split_v[4]), float(split_v[5]), float(split_v[6]), float(split_v[7]),
+                                 float(split_v[8]), float(split_v[9])])
+            path_times.append(tn - t0)
+            if len(path_times) >= trajectory_chunk_size:
+                batch = _make_trajectory_batch(path_tracker, subject_id, trial_number, path_times, path_vectors,
+                                               slice(0, 3), None, path_resampler, aggregator)
+                if parse_path:
+                    yield FileType.path_file, batch
+                path_times, path_vectors = [], []
+        if parse_look and 'Main Camera' in line:
+            # Turn it into a float vector
+            split_v = line[12:].split(',')
+            look_vectors.append([float(split_v[0]), float(split_v[1]), float(split_v[2]), float(split_v[3]),
+                                 float(split_v[4]), float(split_v[5]), float(split_v[6]), float(split_v[7]),
+                                 float(split_v[8]), float(split_v[9])])
+            look_times.append(tn - t0)
+            if len(look_times) >= trajectory_chunk_size:
+                yield FileType.look_file, _make_trajectory_batch(look_tracker, subject_id, trial_number, look_times,
+                                                                 look_vectors, slice(3, 7), look_orientation,
+                                                                 look_resampler)
+                look_times, look_vectors = [], []
+
+    # Produce the rows of the remaining partial chunks
+    if path_times:
+        batch = _make_trajectory_batch(path_tracker, subject_id, trial_number, path_times, path_vectors, slice(0, 3),
+                                       None, path_resampler, aggregator)
+        if parse_path:
+            yield FileType.path_file, batch
+    if look_times:
+        yield FileType.look_file, _make_trajectory_batch(look_tracker, subject_id, trial_number, look_times,
+                                                         look_vectors, slice(3, 7), look_orientation, look_resampler)
+    if aggregator is not None and aggregator.samples > 0:
+        yield FileType.trial_summary, [aggregator.get_summary_row()]
+        yield FileType.room_visits, aggregator.get_visit_rows()
+
+
+# Special parser for raw Unity files which yields the path and look rows one at a time as (file_type, line) tuples
+# (see parse_raw_file_columns)
+def parse_raw_file(path, subject_id, trial_number, summary_file_path, parse_path=True, parse_look=True, data=None):
+    for file_type, batch in parse_raw_file_columns(path, subject_id, trial_number, summary_file_path, parse_path,
+                                                   parse_look, data):
+        for line in batch:
+            yield file_type, line
+
+
+# Special parser for path files (Raw Unity), yielding one line at a time
+# should produce lines with following format
+# subject_id,trial_number,time,x,y,z,room_by_order,room_by_color,items_clicked,distance_from_last_point,time_since_last_point
+def parse_path_file(path, subject_id, trial_number, summary_file_path):
+    for file_type, line in parse_raw_file(path, subject_id, trial_number, summary_file_path, parse_look=False):
+        yield line
 
 
-# Special parser for look files (Raw Unity)
+# Special parser for look files (Raw Unity), yielding one line at a time. The heading is in radians and the angular
+# speed in radians per second (see OrientationTracker)
 # should produce lines with following format
-# subject_id,trial_number,time,x,y,z,w,euler_x,euler_y,euler_z,room_by_order,room_by_color,items_clicked,distance_from_last_point,time_since_last_point
+# subject_id,trial_number,time,x,y,z,w,euler_x,euler_y,euler_z,room_by_order,room_by_color,items_clicked,distance_from_last_point,time_since_last_point,heading,angular_speed
 def parse_look_file(path, subject_id, trial_number, summary_file_path):
-    # Read the entire file into memory
-    fp = open(path, 'rb')
-    data = fp.readlines()
-    fp.close()
-
-    # Get data from associated summary file
-    summary_type, summary_times, summary_event_types, summary_object_types, summary_locations = parse_summary_file(
-        summary_file_path)
-    summary_index_tracker = 0
-
-    # Initialize time and vector variables
-    t0 = 0
-    prev_t = 0
-    tn = 0
-    prev_v = []
-    count = 0
-
-    # Initialize other output variables
-    items_clicked = 0
-    previous_context_color = None
-    context_number = 0
-
-    # Initialize buffer for storing output lines
-    out_lines = []
-
-    for line in data:
-        # If this is the first time point
-        if t0 == 0 and line[0] == '-':
-            # Initialize the time values
-            t0 = int(line[0:20])
-
-        elif not t0 == 0 and line[0] == '-':
-            # Otherwise, extract the current time only
-            tn = int(line[0:20])
-        # Extract by name the position vector
-        if 'Main Camera' in line:
-            # Turn it into a float vector
-            split_v = line[12:].split(',')
-            v = [float(split_v[0]), float(split_v[1]), float(split_v[2]), float(split_v[3]),
-                 float(split_v[4]), float(split_v[5]), float(split_v[6]), float(split_v[7]),
-                 float(split_v[8]), float(split_v[9])]
-            # Calculate the relative times
-            t = tn - t0
-            if count == 0:
-                t = 0
-                prev_t = 0
-                count += 1
-            time_since_last_point = t - prev_t
-
-            # If there's not a previous vector, just use the current (first) one
-            if not prev_v:
-                prev_v = v
-
-            # Use summary file to determine how many items have been placed/clicked
-            if summary_index_tracker < len(summary_times) and t >= summary_times[summary_index_tracker]:
-                if summary_type == SummaryType.test:
-                    if 'placed' in summary_event_types[summary_index_tracker].lower():
-                        items_clicked += 1
-                    elif 'picked' in summary_event_types[summary_index_tracker].lower():
-                        items_clicked -= 1
-                elif summary_type == SummaryType.study_practice:
-                    items_clicked += 1
-                summary_index_tracker += 1
-
-            # Calculate room color in navigation space
-            index, room = nav_get_room_by_location((v[0], v[2]))
-            room_by_color = room
-
-            # Determine if this is first iteration (set previous variable to current so no counting is done)
-            if not previous_context_color:
-                previous_context_color = room_by_color
-            # If the previous room is different from the current room, iterate the context_number
-            if not (previous_context_color == room_by_color):
-                context_number += 1
-            # Update the previous context state
-            previous_context_color = room_by_color
-            # Apply the order number
-            room_by_order = context_number
-
-            # Calculate distance on this tick
-            distance_from_last_point = distance.euclidean(prev_v[0:3], v[0:3])
-
-            ex, ey, ez = calculate_euler_vector_from_quaternion(v[3], v[4], v[5], v[6])
-
-            # Create the output line and write it to the output buffer
-            out_line = [subject_id, trial_number, t, v[3], v[4], v[5], v[6], ex, ey, ez, room_by_order, room_by_color,
-                        items_clicked, distance_from_last_point, time_since_last_point]
-            out_lines.append(out_line)
-
-            # Update prev variables
-            prev_t = t
-            prev_v = v
-
-    return out_lines
+    for file_type, line in parse_raw_file(path, subject_id, trial_number, summary_file_path, parse_path=False):
+        yield line
 
 
 # Special parser for 2d test files (2D test files)
 # should produce lines with following format
 # subject_id,trial_number,item_id,x_placed,y_placed,x_expected,y_expected,order_clicked_study,expected_room_by_order,expected_room_by_color,actual_room_by_order,actual_room_by_color
-def parse_test_2d_file(path, subject_id, trial_number, summary_file_path):
-    f = open(path, 'rb')
-
-    # Get the summary file for the test data (study summary)
-    summary_type, summary_times, summary_event_types, summary_object_types, summary_locations = parse_summary_file(
-        summary_file_path)
+def parse_test_2d_file(path, subject_id, trial_number, summary_file_path, data=None):
+    f = open_input_file(path, data)
 
-    previous_context_color = None
-    context_color_order_mapping = dict()
-    context_order_counter = 0
-    # Get from the summary file the context_color->context_order mapping via the order of item clicks
-    for t, event_type, object_type_study, loc in zip(summary_times, summary_event_types, summary_object_types,
-                                                     summary_locations):
-        index, current_context_color = nav_get_room_by_location(get_location_by_name(object_type_study, test2d=False))
-        if not previous_context_color:
-            previous_context_color = current_context_color
-            context_color_order_mapping[current_context_color] = context_order_counter
-        if not (previous_context_color == current_context_color):
-            context_order_counter += 1
-            if not (current_context_color in context_color_order_mapping):
-                context_color_order_mapping[current_context_color] = context_order_counter
-        previous_context_color = current_context_color
+    # Get the summary file for the test data (study summary) along with its context_color->context_order mapping
+    summary = get_summary(summary_file_path)
+    summary_object_types = summary.object_types
+    context_color_order_mapping = summary.context_color_order_mapping
 
     out_lines = []
 
@@ -674,151 +2579,156 @@ def parse_test_2d_file(path, subject_id, trial_number, summary_file_path):
     # noinspection PyRedeclaration
     for j in range(0, test_skip_lines):
         f.readline()
-    # Read the lines for each object
+    # Read the lines for each object, extracting the x, y points
     # noinspection PyRedeclaration
-    for j in range(0, len(test_labels)):
-        # Parse the line, extracting the x, y points
+    split_lines = []
+    for j in range(0, len(environment_layout.test_labels)):
         line = f.readline()
         split_line = line.split(',')
         if not line:
             raise LogParseError("The test 2d file had a problem parsing. There were not enough lines.")
-        x = int(split_line[3])
-        y = int(split_line[4])
+        split_lines.append(split_line)
+    points = [(int(object_line[3]), int(object_line[4])) for object_line in split_lines]
+
+    # Using the object locations, get the colors of the rooms the objects were actually placed in
+    indices, rooms = test2d_get_rooms_by_locations(points)
+
+    # The order in which each object was clicked during study time (the first click counts)
+    study_orders = dict()
+    for i, study_object in enumerate(summary_object_types):
+        study_orders.setdefault(study_object, i)
 
+    for j, split_line, (x, y), actual_room_by_color in zip(range(0, len(split_lines)), split_lines, points, rooms):
         # Get the object type and use it to determine (looking at the summary file) in what order the object was viewed
         # during study time
         object_type_test = split_line[0]
-        object_type_study = study_labels[test_labels.index(object_type_test)]  # Swap label schema for study labels
-        order_clicked_study = None
-        for i, study_object in zip(range(0, len(summary_object_types)), summary_object_types):
-            if study_object == object_type_study:
-                order_clicked_study = i
-                break
+        if object_type_test not in environment_layout.test_to_study:
+            raise LogParseError("The test 2d file contains an unknown item (%s)." % object_type_test)
+        object_type_study = environment_layout.test_to_study[object_type_test]  # Swap label schema for study labels
+        order_clicked_study = study_orders.get(object_type_study)
 
         # Using the object label, determine what color room the object should have been in
-        expected_room_by_color = None
-        object_label_index = test_labels.index(split_line[0])
-        for i, l in zip(range(0, len(context_item_indicies)), context_item_indicies):
-            if object_label_index in l:
-                expected_room_by_color = context_labels[i]
-                break
-
-        # Using the object location, get the color of the room the object was actually placed in
-        index, room = test2d_get_room_by_location((x, y))
-        actual_room_by_color = room
+        expected_room_by_color = environment_layout.item_rooms[object_type_test]
 
         # Using the name of the object, find the expected location
-        x_expected, y_expected = get_location_by_name(object_type_test, test2d=True)
+        x_expected, y_expected = environment_layout.test_locations[object_type_test]
 
         # Using the room colors and the previously generated color->order mapping, get the expected/actual room order
         expected_room_by_order = context_color_order_mapping[expected_room_by_color]
         actual_room_by_order = context_color_order_mapping[actual_room_by_color]
 
         # Generate and append the output line
-        out_line = [subject_id, trial_number, test_labels[j], x, y, x_expected, y_expected, order_clicked_study,
-                    expected_room_by_order, expected_room_by_color, actual_room_by_order, actual_room_by_color]
+        out_line = [subject_id, trial_number, environment_layout.test_labels[j], x, y, x_expected, y_expected,
+                    order_clicked_study, expected_room_by_order, expected_room_by_color, actual_room_by_order,
+                    actual_room_by_color]
         out_lines.append(out_line)
 
     return out_lines
 
 
+# Special parser for vr test files (Summary Unity Test) which makes a single pass over the placed/picked up events,
+# keeping the state of each item in dicts, and yields (file_type, row) tuples. If parse_results is True, the per-item
+# results (see parse_test_vr_file) are produced, and if parse_events is True, every event of every item is produced as
+# well with the following format
+# subject_id,trial_number,item_id,event_number,event_type,time,x,y,actual_room_by_order,actual_room_by_color
+def parse_test_vr_events(path, subject_id, trial_number, summary_file_path, parse_results=True, parse_events=False,
+                         data=None):
+    # Get data from associated summary files (the study summary includes the context_color->context_order mapping)
+    test_summary = get_summary(path, data)
+    summary = get_summary(summary_file_path)
+    context_color_order_mapping = summary.context_color_order_mapping
+
+    # The order in which each object was clicked during study time (the first click counts)
+    study_orders = dict()
+    for i, study_object in enumerate(summary.object_types):
+        study_orders.setdefault(study_object, i)
+
+    # Walk the events once, keeping the first event, the last event, and the event count of each item (items are
+    # reported in the order they first appear)
+    item_order = []
+    first_events = dict()
+    last_events = dict()
+    event_counts = dict()
+    event_rows = []
+    for t, event_type, object_type, loc in zip(test_summary.times, test_summary.event_types,
+                                               test_summary.object_types, test_summary.locations):
+        if object_type not in first_events:
+            item_order.append(object_type)
+            first_events[object_type] = (t, event_type, object_type, loc)
+            event_counts[object_type] = 0
+        last_events[object_type] = (t, event_type, object_type, loc)
+        event_counts[object_type] += 1
+        if parse_events:
+            x, y = get_test_vr_placement(loc)
+            event_rows.append([subject_id, trial_number, object_type, event_counts[object_type], event_type, t, x, y,
+                               None, None])
+
+    if parse_results:
+        out_rows = []
+        for object_type in item_order:
+            last_placed_values = last_events[object_type]
+            # Every event after the first one is half of a replacement (picked up then placed again); an item which
+            # was never moved has an integer 0 replacements
+            replacements = 0.5 * (event_counts[object_type] - 1) if event_counts[object_type] > 1 else 0
+
+            # Using the object label, determine what color room the object should have been in
+            if object_type not in environment_layout.study_to_test:
+                raise LogParseError("The vr test summary contains an unknown item (%s)." % object_type)
+            expected_room_by_color = environment_layout.item_rooms[object_type]
+
+            # The placement reported is the location of the first event of the item (the location of the last event
+            # is only checked for validity)
+            get_test_vr_placement(last_placed_values[3])
+            x_placed, y_placed = get_test_vr_placement(first_events[object_type][3])
+
+            # Using the name of the object, find the expected location
+            x_expected, y_expected = environment_layout.study_locations[object_type]
+
+            # Using the room colors and the previously generated color->order mapping, get the expected room order
+            expected_room_by_order = context_color_order_mapping[expected_room_by_color]
+
+            # Generate and append the output line (the actual room is filled in below for all the objects at once)
+            out_rows.append(
+                [subject_id, trial_number, object_type, x_placed, y_placed, x_expected, y_expected,
+                 study_orders.get(object_type), expected_room_by_order, expected_room_by_color, None, None,
+                 replacements, last_placed_values[0]])
+
+        # Using the object locations, get the colors of the rooms the objects were actually placed in and use the
+        # previously generated color->order mapping to get the actual room order
+        indices, rooms = nav_get_rooms_by_locations([(row[3], row[4]) for row in out_rows])
+        for row, actual_room_by_color in zip(out_rows, rooms):
+            row[10] = context_color_order_mapping[actual_room_by_color]
+            row[11] = actual_room_by_color
+            yield FileType.test_file_vr, row
+
+    if parse_events:
+        indices, rooms = nav_get_rooms_by_locations([(row[6], row[7]) for row in event_rows])
+        for row, actual_room_by_color in zip(event_rows, rooms):
+            row[8] = context_color_order_mapping[actual_room_by_color]
+            row[9] = actual_room_by_color
+            yield FileType.test_file_vr_events, row
+
+
+# Helper function which gets the (x, y) placement on the floor of a vr test event location, which is either an (x, y)
+# pair or an (x, y, z) point (where y is the height)
+def get_test_vr_placement(loc):
+    if len(loc) == 2:
+        return loc[0], loc[1]
+    elif len(loc) == 3:
+        return loc[0], loc[2]
+    else:
+        raise LogParseError("The test vr file had a problem parsing. A location had neither 2 or 3 points.")
+
+
 # Special parser for vr test files (Summary Unity Test)
 # should produce lines with following format
 # subject_id,trial_number,item_id,x_placed,y_placed,x_expected,y_expected,order_clicked_study,expected_room_by_order,expected_room_by_color,actual_room_by_order,actual_room_by_color,number_of_replacements,time_placed
 def parse_test_vr_file(path, subject_id, trial_number, summary_file_path):
-    # Get data from associated summary files
-    test_type, test_times, test_event_types, test_object_types, test_locations = parse_summary_file(path)
-    summary_type, summary_times, summary_event_types, summary_object_types, summary_locations = parse_summary_file(
-        summary_file_path)
-
-    previous_context_color = None
-    context_color_order_mapping = dict()
-    context_order_counter = 0
-    # Get from the summary file the context_color->context_order mapping via the order of item clicks
-    for t, event_type, object_type, loc in zip(summary_times, summary_event_types, summary_object_types,
-                                               summary_locations):
-        index, current_context_color = nav_get_room_by_location(get_location_by_name(object_type, test2d=False))
-        if not previous_context_color:
-            previous_context_color = current_context_color
-            context_color_order_mapping[current_context_color] = context_order_counter
-        if not (previous_context_color == current_context_color):
-            context_order_counter += 1
-            if not (current_context_color in context_color_order_mapping):
-                context_color_order_mapping[current_context_color] = context_order_counter
-        previous_context_color = current_context_color
-
-    already_processed_item_ids = []
-
-    out_rows = []
-
-    # Iterate through the test file
-    count = 0
-    for t, event_type, object_type, loc in zip(test_times, test_event_types, test_object_types, test_locations):
-        # If the object has already been processed, skip it (we're going in order down the file, but we're processing
-        # the entirety of each object as we come to it
-        if object_type in already_processed_item_ids:
-            count += 1
-            continue
-        placed_state = True
-        last_placed_values = (t, event_type, object_type, loc)
-        replacements = 0
-        count += 1
-        # Iterate through all lines after the current one and find the number of replacements and final position value
-        for i in range(count, len(test_times)):
-            if test_object_types[i] == object_type:
-                placed_state = not placed_state
-                last_placed_values = (test_times[i], test_event_types[i], test_object_types[i], test_locations[i])
-                replacements += 0.5
-        # Add the object to the already processed list so we don't process it again
-        already_processed_item_ids.append(object_type)
-
-        # Get the object type and use it to determine (looking at the summary file) in what order the object was viewed
-        # during study time
-        order_clicked_study = None
-        for i, study_object in zip(range(0, len(summary_object_types)), summary_object_types):
-            if study_object == object_type:
-                order_clicked_study = i
-                break
-
-        # Using the object label, determine what color room the object should have been in
-        expected_room_by_color = None
-        object_label_index = study_labels.index(object_type)
-        for i, l in zip(range(0, len(context_item_indicies)), context_item_indicies):
-            if object_label_index in l:
-                expected_room_by_color = context_labels[i]
-                break
-
-        if len(last_placed_values[3]) == 2:
-            x_placed = loc[0]
-            y_placed = loc[1]
-        elif len(last_placed_values[3]) == 3:
-            x_placed = loc[0]
-            y_placed = loc[2]
-        else:
-            raise LogParseError("The test vr file had a problem parsing. A location had neither 2 or 3 points.")
-
-        # Using the object location, get the color of the room the object was actually placed in
-        index, room = nav_get_room_by_location((x_placed, y_placed))
-        actual_room_by_color = room
-
-        # Using the name of the object, find the expected location
-        x_expected, y_expected = get_location_by_name(object_type, test2d=False)
-
-        # Using the room colors and the previously generated color->order mapping, get the expected/actual room order
-        expected_room_by_order = context_color_order_mapping[expected_room_by_color]
-        actual_room_by_order = context_color_order_mapping[actual_room_by_color]
-
-        # Generate and append the output line
-        out_rows.append(
-            [subject_id, trial_number, object_type, x_placed, y_placed, x_expected, y_expected, order_clicked_study,
-             expected_room_by_order, expected_room_by_color, actual_room_by_order, actual_room_by_color,
-             replacements, last_placed_values[0]])
-
-    return out_rows
+    return [row for file_type, row in parse_test_vr_events(path, subject_id, trial_number, summary_file_path)]
 
 
 # Helper function for closing a csv writer (this, in combination with the open and parse functions, prevents the
-# external application from needing an import csv reference
+# external application from needing an import csv reference. The output script closes its AsyncTableWriters instead.
 def close_writer(file_pointer):
     try:
         file_pointer.close()
@@ -835,6 +2745,67 @@ def calculate_euler_vector_from_quaternion(q0, q1, q2, q3):
     return x, y, z
 
 
+# Helper function to convert an N x 4 array of quaternions into an N x 3 array of euler vectors, with the same formula
+# as calculate_euler_vector_from_quaternion
+def calculate_euler_vectors_from_quaternions(quaternions):
+    q = numpy.asarray(quaternions, dtype=numpy.float64).reshape(-1, 4)
+    q0, q1, q2, q3 = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    euler = numpy.empty((len(q), 3), dtype=numpy.float64)
+    euler[:, 0] = numpy.arctan2(2 * ((q0 * q1) + (q2 + q3)), 1 - (2 * ((q1 * q1) + (q2 * q2))))
+    euler[:, 1] = numpy.arcsin(numpy.clip(2 * ((q0 * q2) - (q3 * q1)), -1.0, 1.0))
+    euler[:, 2] = numpy.arctan2(2 * ((q0 * q3) + (q1 * q2)), 1 - (2 * ((q2 * q2) + (q3 * q3))))
+    return euler
+
+
+# Helper function to get the heading (the yaw about the vertical axis, in radians from -pi to pi) of an N x 4 array of
+# Unity (x, y, z, w) quaternions
+def calculate_headings_from_quaternions(quaternions):
+    q = numpy.asarray(quaternions, dtype=numpy.float64).reshape(-1, 4)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return numpy.arctan2(2 * ((w * y) + (x * z)), 1 - (2 * ((x * x) + (y * y))))
+
+
+# Helper function to get the angle (in radians from 0 to pi) of the rotation between each pair of rows of two N x 4
+# arrays of quaternions. The quaternions are normalized first, and q and -q are the same orientation.
+def calculate_angles_between_quaternions(a, b):
+    a = numpy.asarray(a, dtype=numpy.float64).reshape(-1, 4)
+    b = numpy.asarray(b, dtype=numpy.float64).reshape(-1, 4)
+    a = a / numpy.linalg.norm(a, axis=1)[:, numpy.newaxis]
+    b = b / numpy.linalg.norm(b, axis=1)[:, numpy.newaxis]
+    b = b * numpy.where(numpy.sum(a * b, axis=1) < 0, -1.0, 1.0)[:, numpy.newaxis]
+    # The angle between the quaternions (half the rotation angle) is twice the angle whose tangent is the ratio of their
+    # difference and sum, which is more accurate than arccos of their dot product for small angles
+    return 4 * numpy.arctan2(numpy.linalg.norm(a - b, axis=1), numpy.linalg.norm(a + b, axis=1))
+
+
+# This object computes the orientation columns of the look output from chunks of consecutive quaternions, keeping the
+# last quaternion of each chunk so the angular speed of the first sample of the next chunk is measured from it
+class OrientationTracker:
+    def __init__(self):
+        self.previous_quaternion = None
+
+    # Helper function which accepts an N x 4 array of quaternions and the time since the last point of each (in ticks)
+    # and returns the N x 3 euler vectors, the headings (see calculate_headings_from_quaternions), and the angular
+    # speeds (radians per second turned since the previous sample, 0 for the first sample and for repeated times)
+    def update(self, quaternions, time_since_last_point):
+        quaternions = numpy.asarray(quaternions, dtype=numpy.float64).reshape(-1, 4)
+        euler = calculate_euler_vectors_from_quaternions(quaternions)
+        heading = calculate_headings_from_quaternions(quaternions)
+        angular_speed = numpy.zeros(len(quaternions), dtype=numpy.float64)
+        if len(quaternions) == 0:
+            return euler, heading, angular_speed
+
+        previous = numpy.empty_like(quaternions)
+        previous[0] = quaternions[0] if self.previous_quaternion is None else self.previous_quaternion
+        previous[1:] = quaternions[:-1]
+        self.previous_quaternion = quaternions[-1].copy()
+        seconds = numpy.asarray(time_since_last_point, dtype=numpy.float64) / ticks_per_second
+        moving = seconds > 0
+        angular_speed[moving] = calculate_angles_between_quaternions(quaternions[moving],
+                                                                     previous[moving]) / seconds[moving]
+        return euler, heading, angular_speed
+
+
 # This helper function will return true if the point given is within the rectangle given (point is (x,y), rectangle
 # is (dictionary 'x', 'y', 'w', 'h')
 def point_is_in_rectangle(point, rectangle):
@@ -842,32 +2813,199 @@ def point_is_in_rectangle(point, rectangle):
             rectangle['y'] < point[1] < (rectangle['y'] + rectangle['h']))
 
 
+# This object is a precomputed spatial index of a list of room boundaries (dictionaries 'x', 'y', 'w', 'h' as used by
+# point_is_in_rectangle) which classifies many points at once. The edges of all the rectangles split the plane into a
+# grid whose cells (including the edge lines themselves, since the rectangles are open) each belong to a single room,
+# so a point is classified by two binary searches and a table lookup.
+class RoomIndex:
+    def __init__(self, boundaries):
+        self.x_edges = numpy.unique([float(b['x']) for b in boundaries] + [float(b['x'] + b['w']) for b in boundaries])
+        self.y_edges = numpy.unique([float(b['y']) for b in boundaries] + [float(b['y'] + b['h']) for b in boundaries])
+
+        # Label each cell with the first room which contains a representative point of the cell (-1 if no room does)
+        x_points = self._get_representative_points(self.x_edges)
+        y_points = self._get_representative_points(self.y_edges)
+        self.table = numpy.full((len(x_points), len(y_points)), -1, dtype=int)
+        for i in reversed(range(0, len(boundaries))):
+            for j, x in enumerate(x_points):
+                for k, y in enumerate(y_points):
+                    if point_is_in_rectangle((x, y), boundaries[i]):
+                        self.table[j, k] = i
+
+    # Helper function which returns a point in every cell along an axis (alternating open intervals and edges)
+    @staticmethod
+    def _get_representative_points(edges):
+        points = [edges[0] - 1]
+        for i in range(0, len(edges)):
+            points.append(edges[i])
+            if i + 1 < len(edges):
+                points.append((edges[i] + edges[i + 1]) / 2)
+        points.append(edges[-1] + 1)
+        return points
+
+    # Helper function which returns the cell along an axis of each value (even cells are open intervals between edges
+    # and odd cells are the edges)
+    @staticmethod
+    def _get_cells(edges, values):
+        cells = numpy.searchsorted(edges, values, side='left')
+        on_edge = edges[numpy.minimum(cells, len(edges) - 1)] == values
+        return 2 * cells + on_edge
+
+    # Helper function which accepts an N x 2 array of (x,y) points and returns the array of the indices of the rooms
+    # which contain them (-1 if no room contains the point)
+    def get_room_indices(self, points):
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        return self.table[self._get_cells(self.x_edges, points[:, 0]), self._get_cells(self.y_edges, points[:, 1])]
+
+
+# This object is the compiled layout of the environment: the items (each with a label in the 2d test and in the vr
+# navigation environment, an expected location in both spaces, and the room it belongs in) and the rooms (each with a
+# color label and a boundary in both spaces). It is compiled once so every lookup by label is a dictionary lookup, and
+# the expected navigation locations are also kept as an N x 2 array (in item order) for batch use.
+class EnvironmentLayout:
+    def __init__(self, test_labels, study_labels, test_locations, study_locations, room_labels, room_item_indices,
+                 test_room_boundaries, study_room_boundaries):
+        if not len(test_labels) == len(study_labels) == len(test_locations) == len(study_locations):
+            raise ValueError("The layout must have a test label, study label, test location and study location for " +
+                             "every item.")
+        if not len(room_labels) == len(room_item_indices) == len(test_room_boundaries) == len(study_room_boundaries):
+            raise ValueError("The layout must have a label, item list, test boundary and study boundary for every " +
+                             "room.")
+        self.test_labels = list(test_labels)
+        self.study_labels = list(study_labels)
+        self.room_labels = list(room_labels)
+        self.room_item_indices = [list(indices) for indices in room_item_indices]
+        self.test_room_boundaries = [dict(boundary) for boundary in test_room_boundaries]
+        self.study_room_boundaries = [dict(boundary) for boundary in study_room_boundaries]
+
+        # Label schema swaps
+        self.test_to_study = dict(zip(self.test_labels, self.study_labels))
+        self.study_to_test = dict(zip(self.study_labels, self.test_labels))
+
+        # Expected locations by label (and as an array in navigation space)
+        self.test_locations = dict(zip(self.test_labels, [tuple(location) for location in test_locations]))
+        self.study_locations = dict(zip(self.study_labels, [tuple(location) for location in study_locations]))
+        self.study_positions = numpy.array(study_locations, dtype=numpy.float64).reshape(-1, 2)
+
+        # The color of the room each item belongs in (the first room listing it), by label in either schema (None if
+        # no room lists the item)
+        self.item_rooms = dict((label, None) for label in self.test_labels + self.study_labels)
+        for i in reversed(range(0, len(self.room_item_indices))):
+            for index in self.room_item_indices[i]:
+                self.item_rooms[self.test_labels[index]] = self.room_labels[i]
+                self.item_rooms[self.study_labels[index]] = self.room_labels[i]
+
+        # The compiled room indices for the 2d test image space and the vr navigation environment, and the color of
+        # the room containing the expected location of each study item (see nav_get_room_by_location)
+        self.room_label_array = numpy.array(self.room_labels, dtype=object)
+        self.test_room_index = RoomIndex(self.test_room_boundaries)
+        self.study_room_index = RoomIndex(self.study_room_boundaries)
+        self.study_location_rooms = dict(zip(self.study_labels, self.room_label_array[
+            self.study_room_index.get_room_indices(self.study_positions)]))
+
+    # Helper function which makes a layout from a dictionary in the format written by to_dict
+    @classmethod
+    def from_dict(cls, data):
+        items = data['items']
+        room_labels = [room['label'] for room in data['rooms']]
+        room_item_indices = [[i for i, item in enumerate(items) if item['room'] == label] for label in room_labels]
+        return cls([item['test_label'] for item in items], [item['study_label'] for item in items],
+                   [item['test_location'] for item in items], [item['study_location'] for item in items],
+                   room_labels, room_item_indices, [room['test_boundary'] for room in data['rooms']],
+                   [room['study_boundary'] for room in data['rooms']])
+
+    # Helper function which returns the layout as a dictionary of rooms (label, test_boundary, study_boundary) and
+    # items (test_label, study_label, test_location, study_location, room), which is the format of layout files
+    def to_dict(self):
+        rooms = [collections.OrderedDict([('label', label), ('test_boundary', test_boundary),
+                                          ('study_boundary', study_boundary)])
+                 for label, test_boundary, study_boundary in zip(self.room_labels, self.test_room_boundaries,
+                                                                 self.study_room_boundaries)]
+        items = [collections.OrderedDict([('test_label', test_label), ('study_label', study_label),
+                                          ('test_location', list(self.test_locations[test_label])),
+                                          ('study_location', list(self.study_locations[study_label])),
+                                          ('room', self.item_rooms[test_label])])
+                 for test_label, study_label in zip(self.test_labels, self.study_labels)]
+        return collections.OrderedDict([('rooms', rooms), ('items', items)])
+
+    # Helper function which returns the expected location of an item in either test (2d test) or navigation space
+    def get_location(self, name, test2d=True):
+        return self.test_locations[name] if test2d else self.study_locations[name]
+
+
+# The layout of the environment the task was built with
+default_environment_layout = EnvironmentLayout(test_labels, study_labels, zip(test_realX, test_realY),
+                                               zip(study_realX, study_realY), context_labels, context_item_indicies,
+                                               test_context_boundries, study_context_boundries)
+
+# The layout used by the parsers (see set_environment_layout)
+environment_layout = default_environment_layout
+
+
+# Helper function which loads a layout from a JSON (or, if PyYAML is installed, a YAML) file in the format written by
+# EnvironmentLayout.to_dict
+def load_environment_layout(path):
+    with open(path, 'rb') as fp:
+        if os.path.splitext(path)[1].lower() in ['.yaml', '.yml']:
+            if yaml is None:
+                raise LogParseError("The PyYAML package is needed to read the layout file %s." % path)
+            data = yaml.safe_load(fp)
+        else:
+            data = json.load(fp)
+    try:
+        return EnvironmentLayout.from_dict(data)
+    except (KeyError, TypeError, IndexError, ValueError), e:
+        raise LogParseError("The layout file %s is not valid (%s: %s)." % (path, type(e).__name__, e))
+
+
+# Helper function which sets the layout used by the parsers. The time_in_<room> columns of trial_summary follow the
+# room labels of the layout, and summaries cached with the previous layout are discarded.
+def set_environment_layout(layout):
+    global environment_layout
+    environment_layout = layout
+    filename, header = output_files['trial_summary']
+    header = [column for column in header if not column.startswith('time_in_')]
+    output_files['trial_summary'] = (filename, header + ["time_in_" + label for label in layout.room_labels])
+    output_column_types.update(('time_in_' + label, 'int64') for label in layout.room_labels)
+    summary_cache.entries.clear()
+
+
+# This helper function will get the rooms in the 2d test image space in which each of an N x 2 array of (x,y) points is
+# contained. It returns the array of room indices and the array of room colors, with the same semantics as
+# test2d_get_room_by_location.
+def test2d_get_rooms_by_locations(locations):
+    indices = environment_layout.test_room_index.get_room_indices(locations)
+    return indices, environment_layout.room_label_array[indices]
+
+
+# This helper function will get the rooms in the vr navigation environment in which each of an N x 2 array of (x,y) aka
+# (x,z) points is contained. It returns the array of room indices and the array of room colors, with the same semantics
+# as nav_get_room_by_location.
+def nav_get_rooms_by_locations(locations):
+    indices = environment_layout.study_room_index.get_room_indices(locations)
+    return indices, environment_layout.room_label_array[indices]
+
+
 # This helper function will get the room in the 2d test image space in which an (x,y) point is contained
 def test2d_get_room_by_location(location):  # Accepts (x,y)
     index = -1
-    for i, context_boundary in zip(range(0, len(test_context_boundries)), test_context_boundries):
+    for i, context_boundary in enumerate(environment_layout.test_room_boundaries):
         if point_is_in_rectangle(location, context_boundary):
             index = i
             break
-    return index, context_labels[index]
+    return index, environment_layout.room_labels[index]
 
 
 # This helper function will get the room in the vr navigation environment in which an (x,y) point is contained
 def nav_get_room_by_location(location):  # Accepts (x,y) aka (x,z)
     index = -1
-    for i, context_boundary in zip(range(0, len(study_context_boundries)), study_context_boundries):
+    for i, context_boundary in enumerate(environment_layout.study_room_boundaries):
         if point_is_in_rectangle(location, context_boundary):
             index = i
             break
-    return index, context_labels[index]
+    return index, environment_layout.room_labels[index]
 
 
 # This helper function will get the expected location in either test (2d test) or navigation space
 def get_location_by_name(name, test2d=True):
-    name = name.strip()
-    if test2d:
-        index = test_labels.index(name)
-        return test_realX[index], test_realY[index]
-    else:
-        index = study_labels.index(name)
-        return study_realX[index], study_realY[index]
+    return environment_layout.get_location(name.strip(), test2d)
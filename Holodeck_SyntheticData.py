@@ -0,0 +1,229 @@
+import os
+import math
+import random
+import datetime
+import Holodeck_HelperFunctions
+
+# The number of raw Unity time ticks in a second (times are logged as .NET DateTime ticks)
+ticks_per_second = Holodeck_HelperFunctions.ticks_per_second
+
+# The time of the first sample of generated logs (a negative 19 digit tick count like the ones Unity writes)
+default_start_ticks = -8587000000000000000
+
+# The date and time of the first trial of the first subject of generated datasets
+default_start_datetime = datetime.datetime(2016, 1, 20, 9, 0, 0)
+
+# The names of the untracked scene objects written to generated raw logs alongside the tracked objects
+other_object_names = ['Directional Light', 'Floor', 'Ceiling', 'WallNorth', 'WallSouth', 'WallEast', 'WallWest',
+                      'DoorFrame', 'Table', 'Chair', 'Lamp', 'Shelf', 'Painting', 'Rug', 'Plant', 'Window',
+                      'Clock', 'Vase', 'Bench', 'Sign']
+
+# The number of items clicked in a practice phase (half of the study items, see parse_summary_file)
+practice_item_count = len(Holodeck_HelperFunctions.study_labels) / 2
+
+
+# Helper function which formats a tick count as the time line of a raw or summary log
+def format_time_line(ticks):
+    return '-%019d\n' % -ticks if ticks < 0 else '%020d\n' % ticks
+
+
+# Helper function which formats a raw log line for an object with a position, rotation quaternion, and scale
+def format_object_line(name, position, rotation, scale=(1.0, 1.0, 1.0)):
+    return '%s:%s\n' % (name, ','.join(repr(float(value)) for value in list(position) + list(rotation) + list(scale)))
+
+
+# Helper function which gets the bounds (left, right, bottom, top) of the navigation environment
+def get_environment_bounds():
+    boundaries = Holodeck_HelperFunctions.study_context_boundries
+    return (min(b['x'] for b in boundaries), max(b['x'] + b['w'] for b in boundaries),
+            min(b['y'] for b in boundaries), max(b['y'] + b['h'] for b in boundaries))
+
+
+# Helper function which writes a synthetic raw Unity log of the given length. The First Person Controller walks to each
+# of the (x, z) waypoints in turn (or takes a random walk through the navigation environment if there are none) and the
+# Main Camera follows it while looking around. Every frame also logs other_objects untracked scene objects, which is
+# what makes real raw logs large. The walking speed is chosen so every waypoint is reached within the log, and the tick
+# at which each waypoint is reached is returned.
+def write_raw_log(path, seconds=60, samples_per_second=90, other_objects=20, test=False, seed=0,
+                  start_ticks=default_start_ticks, waypoints=None):
+    rng = random.Random(seed)
+    left, right, bottom, top = get_environment_bounds()
+    controller_name = 'First Person Controller Test' if test else 'First Person Controller'
+    names = [other_object_names[i % len(other_object_names)] + (' (%d)' % (i // len(other_object_names)) if
+                                                               i >= len(other_object_names) else '')
+             for i in range(0, other_objects)]
+    samples = int(seconds * samples_per_second)
+    waypoints = list(waypoints or [])
+
+    x, z = rng.uniform(left, right), rng.uniform(bottom, top)
+    speed = 0.05
+    if waypoints:
+        x, z = (left + right) / 2.0, (bottom + top) / 2.0
+        # Walk the whole route in about 80% of the log (leaving some slack for the wobble in the heading)
+        route = [(x, z)] + waypoints
+        length = sum(math.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(route[:-1], route[1:]))
+        speed = max(speed, length / (0.8 * samples))
+    heading = rng.uniform(-math.pi, math.pi)
+    arrival_ticks = []
+    ticks = start_ticks
+    step = ticks_per_second // samples_per_second
+    with open(path, 'wb') as fp:
+        fp.write('Synthetic Holodeck raw log\n')
+        for i in range(0, samples):
+            fp.write(format_time_line(ticks))
+
+            if len(arrival_ticks) < len(waypoints):
+                # Head to the next waypoint (with a little wobble) and move on to the one after when it is reached
+                target_x, target_z = waypoints[len(arrival_ticks)]
+                heading = math.atan2(target_z - z, target_x - x) + rng.gauss(0, 0.1)
+                if math.hypot(target_x - x, target_z - z) < max(speed, 0.5):
+                    arrival_ticks.append(ticks)
+            else:
+                # Walk forward, turning a little every frame and turning back at the walls
+                heading += rng.gauss(0, 0.05)
+            x += speed * math.cos(heading)
+            z += speed * math.sin(heading)
+            if not (left < x < right and bottom < z < top):
+                heading += math.pi
+                x = min(max(x, left + 0.1), right - 0.1)
+                z = min(max(z, bottom + 0.1), top - 0.1)
+            yaw = (math.cos(heading / 2), math.sin(heading / 2))
+
+            fp.write(format_object_line(controller_name, (x, 1.0, z), (0.0, yaw[1], 0.0, yaw[0])))
+            pitch = rng.gauss(0, 0.05)
+            fp.write(format_object_line('Main Camera', (x, 1.8, z), (pitch, yaw[1], 0.0, yaw[0])))
+            for name in names:
+                fp.write(format_object_line(name, (rng.uniform(left, right), 0.0, rng.uniform(bottom, top)),
+                                            (0.0, 0.0, 0.0, 1.0)))
+            ticks += step + rng.randint(-step // 20, step // 20)
+
+    # Waypoints which weren't reached are reached at the end of the log
+    arrival_ticks.extend([ticks] * (len(waypoints) - len(arrival_ticks)))
+    return arrival_ticks
+
+
+# Helper function which writes a synthetic study/practice SummaryLog in which the objects are clicked at the given
+# ticks
+def write_study_summary(path, object_names, click_ticks):
+    with open(path, 'wb') as fp:
+        fp.write('Synthetic Holodeck summary log\n')
+        for name, ticks in zip(object_names, click_ticks):
+            fp.write(format_time_line(ticks))
+            fp.write('ChangeTextureEvent_ObjectClicked, %s, Clicked\n' % name)
+
+
+# Helper function which writes a synthetic test SummaryLog from a list of (ticks, event_type, object_name, (x, y, z))
+# events
+def write_test_summary(path, events):
+    with open(path, 'wb') as fp:
+        fp.write('Synthetic Holodeck summary log\n')
+        for ticks, event_type, name, location in events:
+            fp.write(format_time_line(ticks))
+            fp.write('%s, %s : (%r, %r, %r)\n' % ((event_type, name) + tuple(float(value) for value in location)))
+
+
+# Helper function which writes a synthetic GMDA _Raw.csv 2D test file in which each object is placed at its true
+# location plus gaussian noise with a standard deviation of error pixels
+def write_test_2d_file(path, seed=0, error=60):
+    rng = random.Random(seed)
+    with open(path, 'wb') as fp:
+        # The header lines are skipped by the parser (see parse_test_2d_file)
+        for i in range(0, Holodeck_HelperFunctions.test_skip_lines):
+            fp.write('Header,%d,Synthetic Holodeck 2D test\n' % i)
+        for name, x, y in zip(Holodeck_HelperFunctions.test_labels, Holodeck_HelperFunctions.test_realX,
+                              Holodeck_HelperFunctions.test_realY):
+            fp.write('%s,0,0,%d,%d\n' % (name, min(max(int(rng.gauss(x, error)), -374), 374),
+                                         min(max(int(rng.gauss(y, error)), -374), 374)))
+
+
+# Helper function which orders objects the way a participant clicks them during study: room by room (in a random room
+# order), and in a random order within each room
+def get_study_click_order(rng, item_count=None):
+    rooms = list(Holodeck_HelperFunctions.context_item_indicies)
+    rng.shuffle(rooms)
+    order = []
+    for indices in rooms:
+        indices = list(indices)
+        rng.shuffle(indices)
+        order.extend(Holodeck_HelperFunctions.study_labels[i] for i in indices)
+    return order[0:item_count] if item_count else order
+
+
+# Helper function which writes the raw log and summary log of a study or practice phase, with the raw log walking to
+# each clicked object
+def write_study_phase(raw_path, summary_path, rng, item_count=None, **raw_log_options):
+    object_names = get_study_click_order(rng, item_count)
+    waypoints = [Holodeck_HelperFunctions.get_location_by_name(name, test2d=False) for name in object_names]
+    click_ticks = write_raw_log(raw_path, waypoints=waypoints, seed=rng.random(), **raw_log_options)
+    write_study_summary(summary_path, object_names, click_ticks)
+
+
+# Helper function which writes the raw log and summary log of a VR test phase. Each object is placed near its true
+# location (in the neighbouring room with probability misplacement_rate) and some are picked up and placed again later.
+def write_test_phase(raw_path, summary_path, rng, misplacement_rate=0.2, replacement_rate=0.3, **raw_log_options):
+    placements = []
+    for name in get_study_click_order(rng):
+        x, z = Holodeck_HelperFunctions.get_location_by_name(name, test2d=False)
+        if rng.random() < misplacement_rate:
+            # Move the object to the same spot in the room beside its own
+            x = x + 40 if x < 27.5 else x - 40
+        placements.append((name, (rng.gauss(x, 2), 0.5, rng.gauss(z, 2))))
+    replacements = [(name, (location[0] + rng.gauss(0, 3), location[1], location[2] + rng.gauss(0, 3)))
+                    for name, location in placements if rng.random() < replacement_rate]
+
+    waypoints = [(location[0], location[2]) for name, location in placements + replacements]
+    arrival_ticks = write_raw_log(raw_path, waypoints=waypoints, test=True, seed=rng.random(), **raw_log_options)
+
+    # An object is placed when its waypoint is reached; a replacement picks the object up from its last location just
+    # before placing it again
+    events = []
+    last_locations = dict()
+    for (name, location), ticks in zip(placements + replacements, arrival_ticks):
+        if name in last_locations:
+            events.append((ticks - ticks_per_second, 'Object_PickedUp', name, last_locations[name]))
+        events.append((ticks, 'Object_Placed', name, location))
+        last_locations[name] = location
+    events.sort(key=lambda event: event[0])
+    write_test_summary(summary_path, events)
+
+
+# Helper function which writes a complete synthetic Holodeck dataset under root, with the same directory layout and
+# filenames as the real data: <subject>/Practice, Study and Test (RawLog and SummaryLog files) and <subject>/2D (GMDA
+# _Raw.csv files). Each subject has the given number of trials (the first one with a practice phase), one per hour
+# starting at start_datetime (one day later for each subject). Raw logs are seconds long at samples_per_second, with
+# other_objects untracked objects logged every sample. The paths of the files written are returned.
+def write_dataset(root, subjects=3, trials=4, seconds=60, samples_per_second=90, other_objects=20, seed=0,
+                  start_datetime=default_start_datetime):
+    rng = random.Random(seed)
+    raw_log_options = {'seconds': seconds, 'samples_per_second': samples_per_second, 'other_objects': other_objects}
+    paths = []
+    for subject in range(0, subjects):
+        subject_id = '%03d' % (subject + 1)
+        for trial in range(0, trials):
+            trial_datetime = start_datetime + datetime.timedelta(days=subject, hours=trial)
+            for phase_index, phase in enumerate(['Practice', 'Study', 'Test']):
+                if phase == 'Practice' and trial > 0:
+                    continue
+                directory = os.path.join(root, subject_id, phase)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                stamp = (trial_datetime + datetime.timedelta(minutes=10 * phase_index)).strftime('%H_%M_%S_%d-%m-%Y')
+                raw_path = os.path.join(directory, 'RawLog_Sub%s_%s.txt' % (subject_id, stamp))
+                summary_path = os.path.join(directory, 'SummaryLog_Sub%s_%s.txt' % (subject_id, stamp))
+                start_ticks = default_start_ticks + rng.randint(0, 10 ** 12)
+                if phase == 'Test':
+                    write_test_phase(raw_path, summary_path, rng, start_ticks=start_ticks, **raw_log_options)
+                else:
+                    write_study_phase(raw_path, summary_path, rng,
+                                      practice_item_count if phase == 'Practice' else None,
+                                      start_ticks=start_ticks, **raw_log_options)
+                paths.extend([raw_path, summary_path])
+
+            directory = os.path.join(root, subject_id, '2D')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            stamp = (trial_datetime + datetime.timedelta(minutes=40)).strftime('%Y-%m-%d_%I-%M-%S-%p')
+            test_2d_path = os.path.join(directory, 'GMDA_%s_%s_Raw.csv' % (subject_id, stamp))
+            write_test_2d_file(test_2d_path, seed=rng.random())
+            paths.append(test_2d_path)
+    return paths